@@ -1,18 +1,141 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import User, Media, MediaBatch
-from django.utils.html import format_html
+from .models import User, Media, MediaBatch, RequestProfile
+from django.utils.html import format_html, format_html_join
 
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib import admin
 from .models import User  # Ensure correct import
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.core.paginator import Paginator
+from django.http import Http404, HttpResponse
+from django.urls import path, reverse
+from django.db import connections
+from django.db.models import Q
+from django.db.models.functions import Upper
+from django.utils.functional import cached_property
+import json
 
-class UserAdmin(BaseUserAdmin):
+from .search import _prefix_range, search_queryset
+
+# Above this many rows the changelist shows the planner's estimate instead of COUNT(*)
+ESTIMATED_COUNT_THRESHOLD = 10000
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that asks the PostgreSQL planner for the row count and only
+    runs an exact COUNT(*) when the estimate is small. Other backends count.
+    """
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return super().count
+
+        sql, params = queryset.order_by().values('pk').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+        if estimate < ESTIMATED_COUNT_THRESHOLD:
+            return super().count
+        return estimate
+
+
+class AutocompleteFilter(admin.ListFilter):
+    """
+    Sidebar filter for a foreign key that uses the admin's autocomplete
+    endpoint instead of rendering one link per related row.
+    """
+    template = 'admin/api/autocomplete_filter.html'
+    field_name = None
+
+    def __init__(self, request, params, model, model_admin):
+        super().__init__(request, params, model, model_admin)
+        self.model = model
+        self.parameter_name = f'{self.field_name}__id__exact'
+        if self.parameter_name in params:
+            value = params.pop(self.parameter_name)[-1]
+            if value.isdigit():
+                self.used_parameters[self.parameter_name] = value
+
+    def value(self):
+        return self.used_parameters.get(self.parameter_name)
+
+    def has_output(self):
+        return True
+
+    def expected_parameters(self):
+        return [self.parameter_name]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(**{f'{self.field_name}_id': self.value()})
+        return queryset
+
+    def choices(self, changelist):
+        field = self.model._meta.get_field(self.field_name)
+        selected = None
+        if self.value():
+            selected = field.related_model._default_manager.filter(pk=self.value()).first()
+        yield {
+            'app_label': self.model._meta.app_label,
+            'model_name': self.model._meta.model_name,
+            'field_name': self.field_name,
+            'parameter_name': self.parameter_name,
+            'value': self.value(),
+            'selected': selected,
+            'clear_query_string': changelist.get_query_string(remove=[self.parameter_name]),
+        }
+
+
+class OwnerFilter(AutocompleteFilter):
+    title = 'owner'
+    field_name = 'owner'
+
+
+class BatchFilter(AutocompleteFilter):
+    title = 'batch'
+    field_name = 'batch'
+
+
+class ScalableAdminMixin:
+    """
+    Changelist settings for tables with millions of rows: estimated counts,
+    no second COUNT(*) for the unfiltered total, and the autocomplete assets
+    used by AutocompleteFilter.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    @property
+    def media(self):
+        media = super().media
+        for list_filter in self.list_filter:
+            if isinstance(list_filter, type) and issubclass(list_filter, AutocompleteFilter):
+                field = self.model._meta.get_field(list_filter.field_name)
+                return media + AutocompleteSelect(field, self.admin_site).media
+        return media
+
+
+class IndexedSearchMixin:
+    """Admin search through the full-text index in api/search.py."""
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term.strip():
+            return queryset, False
+        return search_queryset(queryset, search_term), False
+
+class UserAdmin(ScalableAdminMixin, BaseUserAdmin):
     # Display these fields in the admin list view
     list_display = ('username', 'email', 'employee_id', 'full_name', 'phone_number', 'role', 'is_staff', 'is_active')
     
-    # Fields that can be searched
-    search_fields = ('username', 'email', 'employee_id', 'full_name', 'phone_number')
+    # Fields that can be searched: '^' by prefix, '=' exactly, both ignoring case.
+    # get_search_results() matches them against the UPPER() indexes on User.
+    search_fields = ('^username', '=email', '^employee_id', '^full_name', '=phone_number')
     
     # Filters on the side
     list_filter = ('role', 'is_staff', 'is_active')
@@ -37,28 +160,122 @@ class UserAdmin(BaseUserAdmin):
     
     ordering = ('username',)
 
-class MediaBatchAdmin(admin.ModelAdmin):
-    list_display = ('referral_id', 'title', 'owner', 'created_at', 'media_count')
-    list_filter = ('owner', 'created_at')
-    search_fields = ('referral_id', 'title', 'owner__username')
-    readonly_fields = ('referral_id',)
+    def get_search_results(self, request, queryset, search_term):
+        # The stock istartswith/iexact lookups compile to UPPER(col) LIKE on
+        # PostgreSQL, which no b-tree index serves; compare ranges and equality
+        # on the indexed UPPER() expressions instead
+        term = search_term.strip().upper()
+        if not term:
+            return queryset, False
+        aliases, condition = {}, Q()
+        for field in self.search_fields:
+            name = field.lstrip('^=')
+            alias = f'{name}_upper'
+            aliases[alias] = Upper(name)
+            condition |= Q(**(_prefix_range(alias, term) if field.startswith('^') else {alias: term}))
+        return queryset.alias(**aliases).filter(condition), False
 
-    def media_count(self, obj):
-        return obj.media_files.count()
-    media_count.short_description = 'Number of Files'
+class MediaBatchAdmin(ScalableAdminMixin, IndexedSearchMixin, admin.ModelAdmin):
+    list_display = ('referral_id', 'title', 'owner', 'created_at', 'media_count', 'total_bytes', 'last_media_at')
+    list_filter = (OwnerFilter, 'created_at')
+    list_select_related = ('owner',)
+    search_fields = ('referral_id', 'title', 'owner__username')
+    search_help_text = 'Title words, or a REF-ID-/EP-ID- code prefix'
+    readonly_fields = ('referral_id', 'media_count', 'total_bytes', 'last_media_at')
+    raw_id_fields = ('owner',)
 
-class MediaAdmin(admin.ModelAdmin):
+class MediaAdmin(ScalableAdminMixin, IndexedSearchMixin, admin.ModelAdmin):
     list_display = ('file_preview', 'title', 'owner', 'batch', 'uploaded_at')
-    list_filter = ('owner', 'batch', 'uploaded_at')
+    list_filter = (OwnerFilter, BatchFilter, 'uploaded_at')
+    list_select_related = ('owner', 'batch')
     search_fields = ('file', 'title', 'owner__username', 'batch__referral_id')
+    search_help_text = 'Title or file name words, or a REF-ID-/EP-ID- code prefix'
+    raw_id_fields = ('owner', 'batch', 'duplicate_of')
+
+    def get_queryset(self, request):
+        # Never load the stored original bytes for a listing
+        return super().get_queryset(request).defer('file_data', 'search_document')
     
     def file_preview(self, obj):
-        if obj.file and hasattr(obj.file, 'url'):
-            return format_html('<img src="{}" width="50" height="50" />', obj.file.url)
+        # Previews use the small thumbnail rendition, never the original
+        if obj.thumbnail:
+            return format_html('<img src="{}" width="50" height="50" loading="lazy" />', obj.thumbnail.url)
         return "No preview"
     file_preview.short_description = 'File Preview'
 
+class RequestProfileAdmin(admin.ModelAdmin):
+    """Profiles recorded by api.profiling, read-only, with downloads."""
+    list_display = ('created_at', 'method', 'path', 'status_code', 'duration_ms', 'query_count', 'query_ms', 'user')
+    list_filter = ('method', 'created_at')
+    list_select_related = ('user',)
+    search_fields = ('path',)
+    fields = ('created_at', 'user', 'method', 'path', 'status_code', 'duration_ms', 'query_count', 'query_ms',
+              'downloads', 'slowest_queries', 'serializer_fields', 'functions')
+    readonly_fields = fields
+
+    # The file name and content type of each download
+    DOWNLOADS = {
+        'pstats': ('request-{pk}.pstats', 'application/octet-stream'),
+        'stacks': ('request-{pk}.collapsed.txt', 'text/plain; charset=utf-8'),
+    }
+
+    def get_queryset(self, request):
+        # The listing never needs the dumps
+        return super().get_queryset(request).defer('stats', 'stacks', 'report')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path('<int:pk>/download/<str:kind>/', self.admin_site.admin_view(self.download),
+                 name='api_requestprofile_download'),
+        ] + super().get_urls()
+
+    def download(self, request, pk, kind):
+        profile = RequestProfile.objects.filter(pk=pk).first()
+        if profile is None or kind not in self.DOWNLOADS or not self.has_view_permission(request, profile):
+            raise Http404
+        name, content_type = self.DOWNLOADS[kind]
+        content = bytes(profile.stats) if kind == 'pstats' else profile.stacks
+        response = HttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{name.format(pk=pk)}"'
+        return response
+
+    def downloads(self, obj):
+        return format_html(
+            '<a href="{}">pstats</a> (<code>python -m pstats</code>, snakeviz) &middot; '
+            '<a href="{}">collapsed stacks</a> (flamegraph.pl, speedscope)',
+            reverse('admin:api_requestprofile_download', args=[obj.pk, 'pstats']),
+            reverse('admin:api_requestprofile_download', args=[obj.pk, 'stacks']),
+        )
+
+    def slowest_queries(self, obj):
+        queries = sorted(obj.report.get('queries', []), key=lambda query: query['duration_ms'], reverse=True)[:25]
+        if not queries:
+            return 'No queries'
+        return format_html('<table>{}</table>', format_html_join(
+            '', '<tr><td>{}ms</td><td>{}</td><td><code>{}</code></td></tr>',
+            ((query['duration_ms'], query['alias'], query['sql']) for query in queries),
+        ))
+
+    def serializer_fields(self, obj):
+        fields = obj.report.get('serializer_fields', [])[:25]
+        if not fields:
+            return 'No serializer fields rendered'
+        return format_html('<table>{}</table>', format_html_join(
+            '', '<tr><td>{}ms</td><td>{} calls</td><td>{}</td></tr>',
+            ((field['total_ms'], field['calls'], field['field']) for field in fields),
+        ))
+
+    def functions(self, obj):
+        return format_html('<pre>{}</pre>', obj.report.get('functions', ''))
+
 # Register your models here
 admin.site.register(User, UserAdmin)
 admin.site.register(MediaBatch, MediaBatchAdmin)
-admin.site.register(Media, MediaAdmin)
\ No newline at end of file
+admin.site.register(Media, MediaAdmin)
+admin.site.register(RequestProfile, RequestProfileAdmin)
\ No newline at end of file
@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.models.signals import post_migrate
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from . import signals
+        from .caching import require_shared_cache
+        from .fragments import fragment_cache_enabled
+
+        if fragment_cache_enabled():
+            require_shared_cache(getattr(settings, 'FRAGMENT_CACHE_ALIAS', 'default'), 'FRAGMENT_CACHE_ENABLED')
+        post_migrate.connect(signals.install_search_indexes, sender=self)
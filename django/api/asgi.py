@@ -0,0 +1,33 @@
+"""
+ASGI middleware wrapped around the Django application in ``backend/asgi.py``.
+"""
+import json
+
+from .throttling import upload_size_error
+
+
+def reject_oversized_uploads(app):
+    """
+    Answer multipart requests whose ``Content-Length`` is missing or above
+    ``UPLOAD_MAX_BYTES`` before Django starts receiving the body.
+    """
+    async def wrapper(scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] in ('POST', 'PUT', 'PATCH'):
+            headers = dict(scope['headers'])
+            if headers.get(b'content-type', b'').startswith(b'multipart/form-data'):
+                error = upload_size_error(headers.get(b'content-length', b'').decode('latin-1'))
+                if error:
+                    body = json.dumps({'detail': error[1]}).encode()
+                    await send({
+                        'type': 'http.response.start',
+                        'status': error[0],
+                        'headers': [
+                            (b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode()),
+                            (b'connection', b'close'),
+                        ],
+                    })
+                    await send({'type': 'http.response.body', 'body': body})
+                    return
+        await app(scope, receive, send)
+    return wrapper
@@ -0,0 +1,276 @@
+"""
+Async upload, download and export views for the ASGI entry point.
+
+Under ``backend.asgi`` Django receives request bodies on the event loop, so a
+slow mobile upload costs a socket and a little memory instead of a worker.
+These views keep it that way: file and storage I/O runs on the default
+executor, image hashing, thumbnails and PDF rendering run on a bounded
+executor (``ASYNC_CPU_WORKERS`` threads) so they cannot starve the loop, and
+ORM calls use the async query API or ``sync_to_async``. Token and session
+authentication, the rate limits and the concurrency caps of the sync views
+apply here too. ``change_stream`` serves the change feed as Server-Sent
+Events, holding only a coroutine per connected client.
+"""
+import asyncio
+import json
+import mimetypes
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.authtoken.models import Token
+
+from . import changefeed
+from .exports import batch_pdf
+from .imaging import dhash, make_thumbnail, read_metadata
+from .models import Media, MediaBatch
+from .serializers import MediaSerializer
+from .throttling import (
+    ExportRateThrottle, UploadRateThrottle, acquire_slots, release_slots, upload_size_error,
+)
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+cpu_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'ASYNC_CPU_WORKERS', None) or os.cpu_count(),
+    thread_name_prefix='async-cpu',
+)
+
+
+async def run_cpu(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, partial(func, *args))
+
+
+async def run_io(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args))
+
+
+def error(detail, status):
+    return JsonResponse({'detail': detail}, status=status)
+
+
+async def authenticate(request):
+    """The user behind a ``Token`` header or the session, or None."""
+    keyword, _, key = request.headers.get('Authorization', '').partition(' ')
+    if keyword == 'Token' and key.strip():
+        token = await Token.objects.select_related('user').filter(key=key.strip()).afirst()
+        return token.user if token and token.user.is_active else None
+    user = await request.auser()
+    return user if user.is_authenticated else None
+
+
+def admit(request, scope, throttle_class):
+    """
+    Apply the scope's rate limit and concurrency cap. Returns ``(response,
+    slots)``; ``response`` is the 429 to send when the request is refused.
+    """
+    throttle = throttle_class()
+    if not throttle.allow_request(request, None):
+        wait = throttle.wait()
+        response = error('Request was throttled.', 429)
+        if wait is not None:
+            response['Retry-After'] = str(int(wait) + 1)
+        return response, []
+    slots = acquire_slots(scope, request.user)
+    if slots is None:
+        response = error('Too many requests of this kind are running. Try again shortly.', 429)
+        response['Retry-After'] = str(getattr(settings, 'CONCURRENCY_RETRY_AFTER', 5))
+        return response, []
+    return None, slots
+
+
+def can_view(user, obj):
+    return user.role in ['admin', 'editor', 'viewer'] or obj.owner_id == user.pk
+
+
+def analyse_image(data):
+    return dhash(data), make_thumbnail(data), read_metadata(data)
+
+
+def save_upload(user, batch, upload, data, phash, thumbnail, metadata, title):
+    media = Media(owner=user, batch=batch, file=upload, file_data=data, perceptual_hash=phash, title=title)
+    media.set_metadata(metadata)
+    if thumbnail:
+        name = os.path.splitext(os.path.basename(upload.name))[0] + '.jpg'
+        media.thumbnail.save(name, ContentFile(thumbnail), save=False)
+    media.save()
+    return media
+
+
+@csrf_exempt
+async def upload_media(request):
+    """
+    ``POST`` one ``file`` (multipart), optionally with ``batch`` (an id) and
+    ``title``. Returns the new media like ``MediaSerializer``.
+    """
+    if request.method != 'POST':
+        return error('Method not allowed', 405)
+    size_error = upload_size_error(request.META.get('CONTENT_LENGTH'))
+    if size_error:
+        return error(size_error[1], size_error[0])
+    request.user = user = await authenticate(request)
+    if user is None:
+        return error('Authentication credentials were not provided.', 401)
+
+    rejected, slots = await sync_to_async(admit)(request, 'uploads', UploadRateThrottle)
+    if rejected:
+        return rejected
+    try:
+        # Parsing reads the spooled body from disk
+        files, post = await run_io(lambda: (request.FILES, request.POST))
+        upload = files.get('file')
+        if upload is None:
+            return error('No file uploaded', 400)
+
+        batch = None
+        if post.get('batch'):
+            batch = await MediaBatch.objects.filter(pk=post['batch']).afirst() if post['batch'].isdigit() else None
+            if batch is None:
+                return error('Batch not found', 404)
+            if user.role not in ['admin', 'editor'] and batch.owner_id != user.pk:
+                return error('You do not have permission to add to this batch', 403)
+
+        data = await run_io(upload.read)
+        phash, thumbnail, metadata = await run_cpu(analyse_image, data)
+        media = await sync_to_async(save_upload)(user, batch, upload, data, phash, thumbnail, metadata, post.get('title'))
+        payload = await sync_to_async(lambda: MediaSerializer(media, context={'request': request}).data)()
+        return JsonResponse(payload, status=201)
+    finally:
+        await sync_to_async(release_slots)(slots)
+
+
+async def stream_file(handle):
+    try:
+        while True:
+            chunk = await run_io(handle.read, DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        await run_io(handle.close)
+
+
+async def download_media(request, pk):
+    """Stream the original file of a media item."""
+    if request.method not in ('GET', 'HEAD'):
+        return error('Method not allowed', 405)
+    user = await authenticate(request)
+    if user is None:
+        return error('Authentication credentials were not provided.', 401)
+
+    media = await Media.objects.only('pk', 'owner_id', 'file').filter(pk=pk).afirst()
+    if media is None or not media.file:
+        return error('Media not found', 404)
+    if not can_view(user, media):
+        return error('You do not have permission to access this media', 403)
+
+    name = media.file.name
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    storage = media.file.storage
+    try:
+        handle = await run_io(storage.open, name, 'rb')
+        size = await run_io(storage.size, name)
+    except OSError:
+        # Fall back to the copy kept in the database
+        data = await Media.objects.filter(pk=pk).values_list('file_data', flat=True).afirst()
+        if not data:
+            return error('File is missing', 404)
+        response = HttpResponse(bytes(data), content_type=content_type)
+    else:
+        response = StreamingHttpResponse(stream_file(handle), content_type=content_type)
+        response['Content-Length'] = str(size)
+    response['Content-Disposition'] = f'attachment; filename="{os.path.basename(name)}"'
+    return response
+
+
+async def export_batch_pdf(request, batch_id):
+    """Render the batch report on the CPU executor and return the PDF."""
+    if request.method != 'GET':
+        return error('Method not allowed', 405)
+    request.user = user = await authenticate(request)
+    if user is None:
+        return error('Authentication credentials were not provided.', 401)
+
+    batch = await MediaBatch.objects.filter(pk=batch_id).afirst()
+    if batch is None:
+        return error('Batch not found', 404)
+    if not can_view(user, batch):
+        return error('You do not have permission to access this batch', 403)
+
+    rejected, slots = await sync_to_async(admit)(request, 'exports', ExportRateThrottle)
+    if rejected:
+        return rejected
+    try:
+        media_files = [media async for media in batch.media_files.defer('file_data', 'search_document')]
+        if not media_files:
+            return error('No images in this batch to export', 400)
+        pdf = await run_cpu(batch_pdf, batch, media_files)
+    finally:
+        await sync_to_async(release_slots)(slots)
+
+    response = HttpResponse(pdf, content_type='application/pdf')
+    response['Content-Disposition'] = f'attachment; filename="batch_{batch.id}.pdf"'
+    return response
+
+
+def sse_message(event, data, event_id=None):
+    lines = [f'id: {event_id}'] if event_id is not None else []
+    lines += [f'event: {event}', f'data: {json.dumps(data)}']
+    return '\n'.join(lines) + '\n\n'
+
+
+async def change_stream(request):
+    """
+    Server-Sent Events stream of the change feed (api/changefeed.py),
+    resuming after ``Last-Event-ID`` or ``?cursor=``. Sends a comment every
+    ``CHANGE_FEED_HEARTBEAT`` seconds and ends after
+    ``CHANGE_FEED_STREAM_SECONDS``; EventSource reconnects on its own.
+    """
+    if request.method != 'GET':
+        return error('Method not allowed', 405)
+    user = await authenticate(request)
+    if user is None:
+        return error('Authentication credentials were not provided.', 401)
+    try:
+        cursor = changefeed.parse_cursor(request.headers.get('Last-Event-ID') or request.GET.get('cursor'))
+    except ValueError:
+        return error('Invalid cursor', 400)
+
+    owner_id = changefeed.feed_owner(user)
+    heartbeat = getattr(settings, 'CHANGE_FEED_HEARTBEAT', 15)
+    duration = getattr(settings, 'CHANGE_FEED_STREAM_SECONDS', 300)
+
+    async def events(cursor):
+        deadline = time.monotonic() + duration
+        if cursor is None:
+            cursor = await sync_to_async(changefeed.latest_event_id)()
+            yield sse_message('ready', {'cursor': cursor}, cursor)
+        elif await sync_to_async(changefeed.cursor_expired)(cursor):
+            cursor = await sync_to_async(changefeed.latest_event_id)()
+            yield sse_message('reset', {'cursor': cursor}, cursor)
+
+        while time.monotonic() < deadline:
+            sequence = changefeed.hub.sequence
+            batch, settling = await sync_to_async(changefeed.fetch_events)(owner_id, cursor)
+            for event in batch:
+                yield sse_message('change', event, event['id'])
+            if batch:
+                cursor = batch[-1]['id']
+                continue
+            timeout = min(heartbeat, deadline - time.monotonic())
+            if settling:
+                await asyncio.sleep(max(min(changefeed.settle_seconds(), timeout), 0))
+            elif not await changefeed.hub.await_change(owner_id, sequence, max(timeout, 0)):
+                yield ': keep-alive\n\n'
+
+    response = StreamingHttpResponse(events(cursor), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Don't let nginx buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
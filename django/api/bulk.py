@@ -0,0 +1,202 @@
+"""
+Set-based Media operations that keep the MediaBatch counters exact.
+
+Each helper locks the affected Media rows, aggregates the per-batch deltas,
+applies the change with one statement per chunk and adjusts the counters
+with F() updates, all in one transaction. Per-row signal bookkeeping is
+suspended while they run, so the helpers also bump the cached
+representations (api/fragments.py) of everything they touch and record
+change feed events (api/changefeed.py) for it.
+"""
+from contextvars import ContextVar
+
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+
+from .models import Media, MediaBatch
+from .search import reindex_objects
+from .fragments import bump_versions
+from . import changefeed
+
+CHUNK_SIZE = 1000
+
+_counters_suspended = ContextVar('counters_suspended', default=False)
+
+
+def counters_suspended():
+    return _counters_suspended.get()
+
+
+def _chunks(items, size=CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _batch_deltas(pks):
+    return Media.objects.filter(pk__in=pks).order_by().values('batch_id').annotate(
+        count=Count('pk'), size=Sum('file_size'), latest=Max('uploaded_at')
+    )
+
+
+def bulk_create_media(objs, batch_size=CHUNK_SIZE):
+    """
+    Insert prepared Media objects and bump their batches' counters.
+    ``Media.save()`` is bypassed, so ``file_size``, hashes, thumbnails and
+    ``search_document`` must already be filled in.
+    """
+    with transaction.atomic():
+        created = Media.objects.bulk_create(objs, batch_size=batch_size)
+        deltas = {}
+        for media in created:
+            count, size, latest = deltas.get(media.batch_id, (0, 0, None))
+            deltas[media.batch_id] = (count + 1, size + media.file_size,
+                                      max(latest, media.uploaded_at) if latest else media.uploaded_at)
+        for batch_id, (count, size, latest) in deltas.items():
+            MediaBatch.adjust_counters(batch_id, count, size, latest)
+        bump_versions(MediaBatch, deltas)
+        for chunk in _chunks([media.pk for media in created]):
+            reindex_objects(Media, chunk)
+        changefeed.record('media', 'created', [(media.pk, media.batch_id, media.owner_id) for media in created])
+    return created
+
+
+def bulk_move_media(queryset, batch):
+    """Move every Media in ``queryset`` to ``batch``. Returns the number moved."""
+    moved = 0
+    with transaction.atomic():
+        rows = list(queryset.exclude(batch=batch).select_for_update().order_by('pk').values_list('pk', 'owner_id'))
+        for rows_chunk in _chunks(rows):
+            chunk = [pk for pk, _ in rows_chunk]
+            deltas = list(_batch_deltas(chunk))
+            Media.objects.filter(pk__in=chunk).update(batch=batch)
+            latest = None
+            for delta in deltas:
+                MediaBatch.adjust_counters(delta['batch_id'], -delta['count'], -(delta['size'] or 0))
+                latest = max(latest, delta['latest']) if latest else delta['latest']
+                moved += delta['count']
+            MediaBatch.adjust_counters(batch.pk, sum(d['count'] for d in deltas),
+                                       sum(d['size'] or 0 for d in deltas), latest)
+            bump_versions(Media, chunk)
+            bump_versions(MediaBatch, [batch.pk] + [d['batch_id'] for d in deltas])
+            changefeed.record('media', 'updated', [(pk, batch.pk, owner_id) for pk, owner_id in rows_chunk])
+            # The media events name the new batch; the batches they left changed too
+            sources = MediaBatch.all_objects.filter(pk__in=[d['batch_id'] for d in deltas]).values_list('pk', 'owner_id')
+            changefeed.record('batch', 'updated', [(pk, pk, owner_id) for pk, owner_id in sources])
+    return moved
+
+
+def bulk_delete_media(queryset):
+    """Delete every Media in ``queryset``. Returns the number deleted."""
+    deleted = 0
+    with transaction.atomic():
+        rows = list(queryset.select_for_update().order_by('pk').values_list('pk', 'batch_id', 'owner_id'))
+        token = _counters_suspended.set(True)
+        try:
+            for rows_chunk in _chunks(rows):
+                chunk = [row[0] for row in rows_chunk]
+                deltas = list(_batch_deltas(chunk))
+                Media.objects.filter(pk__in=chunk).delete()
+                for delta in deltas:
+                    MediaBatch.adjust_counters(delta['batch_id'], -delta['count'], -(delta['size'] or 0))
+                    deleted += delta['count']
+                bump_versions(MediaBatch, [d['batch_id'] for d in deltas])
+                changefeed.record('media', 'deleted', rows_chunk)
+        finally:
+            _counters_suspended.reset(token)
+    return deleted
+
+
+def bulk_set_title(queryset, title):
+    """
+    Set the title of every Media in ``queryset`` and rebuild its search
+    document. Returns the number updated.
+    """
+    updated = 0
+    with transaction.atomic():
+        rows = list(queryset.select_for_update().order_by('pk').only('pk', 'batch_id', 'owner_id', 'file'))
+        for chunk in _chunks(rows):
+            for media in chunk:
+                media.title = title
+                media.search_document = media.build_search_document()
+            # One CASE ... WHEN UPDATE per chunk
+            updated += Media.objects.bulk_update(chunk, ['title', 'search_document'])
+            reindex_objects(Media, [media.pk for media in chunk])
+            bump_versions(Media, [media.pk for media in chunk])
+            bump_versions(MediaBatch, [media.batch_id for media in chunk])
+            changefeed.record('media', 'updated', [(media.pk, media.batch_id, media.owner_id) for media in chunk])
+    return updated
+
+
+def soft_delete_media(queryset):
+    """
+    Hide every live Media in ``queryset`` and take it off its batch's
+    counters. Rows and files are removed later by api/reaper.py. Returns the
+    number hidden.
+    """
+    deleted = 0
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(queryset.filter(deleted_at__isnull=True).select_for_update().order_by('pk').values_list('pk', 'batch_id', 'owner_id'))
+        for rows_chunk in _chunks(rows):
+            chunk = [row[0] for row in rows_chunk]
+            deltas = list(_batch_deltas(chunk))
+            Media.objects.filter(pk__in=chunk).update(deleted_at=now)
+            for delta in deltas:
+                MediaBatch.adjust_counters(delta['batch_id'], -delta['count'], -(delta['size'] or 0))
+                deleted += delta['count']
+            bump_versions(MediaBatch, [d['batch_id'] for d in deltas])
+            changefeed.record('media', 'deleted', rows_chunk)
+    return deleted
+
+
+def soft_delete_batches(queryset):
+    """
+    Hide every live batch in ``queryset`` together with its media. Returns
+    the number of batches hidden.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(queryset.filter(deleted_at__isnull=True).select_for_update().order_by('pk').values_list('pk', 'owner_id'))
+        for rows_chunk in _chunks(rows):
+            chunk = [pk for pk, _ in rows_chunk]
+            MediaBatch.objects.filter(pk__in=chunk).update(deleted_at=now)
+            Media.objects.filter(batch_id__in=chunk).update(deleted_at=now)
+            bump_versions(MediaBatch, chunk)
+            # A deleted batch implies its media
+            changefeed.record('batch', 'deleted', [(pk, pk, owner_id) for pk, owner_id in rows_chunk])
+    return len(rows)
+
+
+def reconcile_batch_counters(queryset=None, chunk_size=CHUNK_SIZE):
+    """
+    Recompute the counters of every batch in ``queryset`` from its Media
+    rows and repair any drift. Returns the number of batches corrected.
+    """
+    queryset = (queryset if queryset is not None else MediaBatch.objects.all()).order_by('pk')
+    pks = list(queryset.values_list('pk', flat=True))
+    fixed = 0
+    for chunk in _chunks(pks, chunk_size):
+        with transaction.atomic():
+            # Lock the batches so concurrent F() updates apply after the repair
+            batches = list(MediaBatch.objects.select_for_update().filter(pk__in=chunk).only(
+                'pk', 'owner_id', 'media_count', 'total_bytes', 'last_media_at'
+            ))
+            actual = {
+                row['batch_id']: row for row in
+                Media.objects.filter(batch_id__in=chunk).order_by().values('batch_id').annotate(
+                    count=Count('pk'), size=Sum('file_size'), latest=Max('uploaded_at')
+                )
+            }
+            drifted = []
+            for batch in batches:
+                row = actual.get(batch.pk, {'count': 0, 'size': 0, 'latest': None})
+                values = (row['count'], row['size'] or 0, row['latest'])
+                if (batch.media_count, batch.total_bytes, batch.last_media_at) != values:
+                    batch.media_count, batch.total_bytes, batch.last_media_at = values
+                    drifted.append(batch)
+            MediaBatch.objects.bulk_update(drifted, ['media_count', 'total_bytes', 'last_media_at'])
+            bump_versions(MediaBatch, [batch.pk for batch in drifted])
+            changefeed.record('batch', 'updated', [(batch.pk, batch.pk, batch.owner_id) for batch in drifted])
+            fixed += len(drifted)
+    return fixed
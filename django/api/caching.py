@@ -0,0 +1,26 @@
+"""
+Checks for state kept in Django's cache that every worker must see.
+
+A per-process cache (``LocMemCache``) or no cache at all (``DummyCache``)
+gives each worker its own copy, so fragment versions, replica pins or
+rate limits kept there silently diverge between workers.
+"""
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+PROCESS_LOCAL_BACKENDS = (LocMemCache, DummyCache)
+
+
+def is_shared_cache(alias='default'):
+    """True when every worker sees the same entries in cache ``alias``."""
+    return not isinstance(caches[alias], PROCESS_LOCAL_BACKENDS)
+
+
+def require_shared_cache(alias, feature):
+    if not is_shared_cache(alias):
+        raise ImproperlyConfigured(
+            f'{feature} needs a cache shared by all workers, but the {alias!r} cache is '
+            f'{type(caches[alias]).__name__}. Set CACHE_URL (see backend/cache.py).'
+        )
@@ -0,0 +1,264 @@
+"""
+Change feed of Media and MediaBatch events, so clients fetch only what
+changed instead of re-listing after every action.
+
+``record`` writes ``ChangeEvent`` rows once the surrounding transaction
+commits, each insert in its own short transaction. The signal handlers in
+api/signals.py cover single-object saves and deletes, and the set-based
+helpers in api/bulk.py record their rows themselves. A media event carries
+its batch id, so clients refresh the batch (counters, cover) from it too;
+a deleted batch implies its media.
+
+Readers follow the feed with the event id as cursor: the long-poll view in
+api/views.py and the Server-Sent Events stream in api/async_views.py. Ids
+are handed out before commit, so an event can become visible after one with
+a higher id. Readers therefore only get events older (by database time) than
+``CHANGE_FEED_SETTLE_SECONDS`` and stop at the first younger one, which
+assumes an event's insert commits within that window. Staff
+roles see every event, other users only the events of their own objects.
+While nothing is new they wait on ``hub``: writes in this process wake the
+matching waiters directly, and a single poller thread per process checks
+the newest event id every ``CHANGE_FEED_POLL_INTERVAL`` seconds to pick up
+writes from other workers.
+"""
+import asyncio
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import BooleanField, ExpressionWrapper, Max, Q
+from django.db.models.functions import Now
+from django.utils import timezone
+
+from .models import ChangeEvent
+
+logger = logging.getLogger(__name__)
+
+STAFF_ROLES = ('admin', 'editor', 'viewer')
+
+
+def feed_owner(user):
+    """The owner whose events ``user`` sees, or None for every owner."""
+    return None if user.role in STAFF_ROLES else user.pk
+
+
+def record(kind, action, rows, using='default'):
+    """
+    Record ``action`` for ``rows`` of ``(object_id, batch_id, owner_id)``
+    once the transaction on ``using`` commits.
+    """
+    rows = list(rows)
+    if not rows:
+        return
+
+    def write():
+        events = ChangeEvent.objects.using(DEFAULT_DB_ALIAS).bulk_create([
+            ChangeEvent(owner_id=owner_id, kind=kind, action=action, object_id=object_id, batch_id=batch_id)
+            for object_id, batch_id, owner_id in rows
+        ])
+        hub.publish(max(event.pk for event in events), {event.owner_id for event in events})
+    transaction.on_commit(write, using=using)
+
+
+def serialize_event(event):
+    return {
+        'id': event.pk,
+        'kind': event.kind,
+        'action': event.action,
+        'object_id': event.object_id,
+        'batch_id': event.batch_id,
+        'created_at': event.created_at.isoformat(),
+    }
+
+
+def latest_event_id():
+    return ChangeEvent.objects.using(DEFAULT_DB_ALIAS).aggregate(latest=Max('id'))['latest'] or 0
+
+
+def cursor_expired(cursor):
+    """True when events after ``cursor`` may have been purged already."""
+    oldest = ChangeEvent.objects.using(DEFAULT_DB_ALIAS).order_by('id').values_list('id', flat=True).first()
+    return oldest is not None and cursor < oldest - 1
+
+
+def settle_seconds():
+    return getattr(settings, 'CHANGE_FEED_SETTLE_SECONDS', 1)
+
+
+def fetch_events(owner_id, cursor, limit=None):
+    """
+    Serialized settled events after ``cursor`` visible to ``owner_id``,
+    oldest first, and whether newer events are still settling.
+    """
+    # Always the primary: a lagging replica would let the cursor skip events
+    queryset = ChangeEvent.objects.using(DEFAULT_DB_ALIAS).filter(id__gt=cursor)
+    if owner_id is not None:
+        queryset = queryset.filter(owner_id=owner_id)
+    settle = settle_seconds()
+    if settle:
+        # Compared in the database so the workers' clocks don't matter
+        queryset = queryset.annotate(settled=ExpressionWrapper(
+            Q(created_at__lte=Now() - timedelta(seconds=settle)), output_field=BooleanField(),
+        ))
+    limit = limit or getattr(settings, 'CHANGE_FEED_BATCH_LIMIT', 500)
+
+    events = []
+    for event in queryset.order_by('id')[:limit]:
+        if settle and not event.settled:
+            return events, True
+        events.append(serialize_event(event))
+    return events, False
+
+
+def parse_cursor(value):
+    """A cursor from a query parameter or ``Last-Event-ID``; None when absent. Raises ValueError."""
+    if value in (None, ''):
+        return None
+    cursor = int(value)
+    if cursor < 0:
+        raise ValueError('cursor must not be negative')
+    return cursor
+
+
+def long_poll(owner_id, cursor, timeout):
+    """
+    Events after ``cursor``, waiting up to ``timeout`` seconds for the first
+    one. Without a cursor, returns the current one so the client can start
+    following from now. ``reset`` tells the client to reload everything.
+    """
+    if cursor is None:
+        return {'cursor': latest_event_id(), 'events': [], 'reset': False}
+    if cursor_expired(cursor):
+        return {'cursor': latest_event_id(), 'events': [], 'reset': True}
+
+    deadline = time.monotonic() + timeout
+    while True:
+        sequence = hub.sequence
+        events, settling = fetch_events(owner_id, cursor)
+        remaining = deadline - time.monotonic()
+        if events or remaining <= 0:
+            break
+        if settling:
+            time.sleep(min(settle_seconds(), remaining))
+        elif not hub.wait(owner_id, sequence, remaining):
+            break
+    return {'cursor': events[-1]['id'] if events else cursor, 'events': events, 'reset': False}
+
+
+def purge_events(older_than=None):
+    """Delete events past ``CHANGE_FEED_RETENTION``. Returns the number deleted."""
+    if older_than is None:
+        older_than = timedelta(seconds=getattr(settings, 'CHANGE_FEED_RETENTION', 7 * 24 * 60 * 60))
+    deleted, _ = ChangeEvent.objects.filter(created_at__lt=timezone.now() - older_than).delete()
+    return deleted
+
+
+class Waiter:
+    """A reader waiting for events of ``owner_id`` (None: any owner)."""
+
+    def __init__(self, owner_id, loop=None):
+        self.owner_id = owner_id
+        self.loop = loop
+        self.event = asyncio.Event() if loop else threading.Event()
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            # The loop is already closed
+            pass
+
+
+class ChangeHub:
+    """
+    In-process fan-out of new events to waiting readers. ``sequence``
+    increases with every publish; a reader takes it before querying so a
+    publish that lands between the query and the wait is not missed.
+    """
+
+    def __init__(self):
+        self.sequence = 0
+        self._waiters = set()
+        self._lock = threading.Lock()
+        self._poller = None
+        self._polled_id = None
+
+    def publish(self, event_id, owner_ids=None):
+        """Wake the waiters interested in ``owner_ids`` (None: everyone)."""
+        with self._lock:
+            self.sequence += 1
+            if self._polled_id is not None:
+                self._polled_id = max(self._polled_id, event_id)
+            waiters = [
+                waiter for waiter in self._waiters
+                if owner_ids is None or waiter.owner_id is None or waiter.owner_id in owner_ids
+            ]
+        for waiter in waiters:
+            waiter.wake()
+
+    def _register(self, waiter, sequence):
+        with self._lock:
+            self._waiters.add(waiter)
+            if self.sequence != sequence:
+                waiter.wake()
+            if getattr(settings, 'CHANGE_FEED_POLL_INTERVAL', 2) and self._poller is None:
+                self._poller = threading.Thread(target=self._poll, name='change-feed-poller', daemon=True)
+                self._poller.start()
+
+    def _unregister(self, waiter):
+        with self._lock:
+            self._waiters.discard(waiter)
+
+    def wait(self, owner_id, sequence, timeout):
+        """Block until an event for ``owner_id`` may be available, or ``timeout``."""
+        waiter = Waiter(owner_id)
+        self._register(waiter, sequence)
+        try:
+            return waiter.event.wait(timeout)
+        finally:
+            self._unregister(waiter)
+
+    async def await_change(self, owner_id, sequence, timeout):
+        """Async ``wait`` for readers on the event loop."""
+        waiter = Waiter(owner_id, asyncio.get_running_loop())
+        self._register(waiter, sequence)
+        try:
+            await asyncio.wait_for(waiter.event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._unregister(waiter)
+
+    def _poll(self):
+        """Wake everyone when another worker wrote events. Runs while anyone waits."""
+        interval = getattr(settings, 'CHANGE_FEED_POLL_INTERVAL', 2)
+        try:
+            while True:
+                try:
+                    latest = latest_event_id()
+                except Exception as e:
+                    logger.warning(f"Change feed poll failed: {str(e)}")
+                    latest = None
+                with self._lock:
+                    changed = latest is not None and self._polled_id is not None and latest > self._polled_id
+                    if latest is not None:
+                        self._polled_id = max(self._polled_id or 0, latest)
+                    if not self._waiters:
+                        self._poller = None
+                        self._polled_id = None
+                        return
+                if changed:
+                    self.publish(latest)
+                time.sleep(interval)
+        finally:
+            connections.close_all()
+
+
+hub = ChangeHub()
@@ -0,0 +1,56 @@
+"""
+Database router that sends reads from safe requests to read replicas.
+
+Replicas are the ``replica_*`` aliases built from ``DATABASE_REPLICA_URLS``.
+Reads only go to a replica while ``ReadReplicaMiddleware`` has marked the
+current request as replica-safe: a GET/HEAD/OPTIONS request from a client that
+has not written anything in the last ``REPLICA_STICKY_SECONDS``. Everything
+else, including management commands and the shell, uses ``default``.
+"""
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+
+_read_from_replica = ContextVar('read_from_replica', default=False)
+
+
+def replica_aliases():
+    return [alias for alias in settings.DATABASES if alias.startswith('replica_')]
+
+
+def read_from_replica(enabled):
+    """Set the flag for the current request; returns a token for ``reset``."""
+    return _read_from_replica.set(enabled)
+
+
+def reset(token):
+    _read_from_replica.reset(token)
+
+
+def reading_from_replica():
+    """True while reads of the current request may be served by a replica."""
+    return bool(replica_aliases()) and _read_from_replica.get()
+
+
+class ReplicaRouter:
+    def __init__(self):
+        self.replicas = replica_aliases()
+        self.aliases = {'default', *self.replicas}
+
+    def db_for_read(self, model, **hints):
+        # Django's database cache must see the latest entries
+        if model._meta.app_label == 'django_cache':
+            return 'default'
+        if self.replicas and _read_from_replica.get():
+            return random.choice(self.replicas)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        if obj1._state.db in self.aliases and obj2._state.db in self.aliases:
+            return True
+        return None
@@ -0,0 +1,182 @@
+"""
+Near-duplicate detection on top of the perceptual hashes stored on Media.
+
+Database lookups use the multi-index hash bands (``phash_band_0..3``): a match
+within ``d`` bits differs in at most ``d // HASH_BANDS`` bits in at least one
+band, so each lookup probes every band for the values that close to its own
+(an indexed ``IN`` list) instead of scanning pairwise. Hashes that are
+not in the database yet (files earlier in the same upload, or a batch being
+audited in memory) go into a BK-tree.
+"""
+from functools import lru_cache
+from itertools import combinations
+
+from django.db.models import Q
+
+from .imaging import BAND_BITS, HASH_BANDS, dhash, hamming, hash_bands
+from .models import Media
+
+# Bits flipped per band when probing; 2 means 137 values per 16-bit band
+MAX_PROBE_RADIUS = 2
+# Largest distance the band index can answer exactly
+MAX_DISTANCE = HASH_BANDS * (MAX_PROBE_RADIUS + 1) - 1
+# Answered with one equality probe per band
+DEFAULT_MAX_DISTANCE = HASH_BANDS - 1
+
+DUPLICATE_ACTIONS = ('allow', 'flag', 'skip')
+DUPLICATE_SCOPES = ('batch', 'library')
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over Hamming distance. Each node is
+    ``[hash, item, {distance: child}]``.
+    """
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = [value, item, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, item, {}]
+                return
+            node = child
+
+    def find(self, value, max_distance):
+        """Return ``(distance, item)`` pairs within ``max_distance``, closest first."""
+        if self.root is None:
+            return []
+        matches = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                matches.append((distance, node[1]))
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(matches, key=lambda match: match[0])
+
+
+def check_max_distance(max_distance):
+    if not 0 <= max_distance <= MAX_DISTANCE:
+        raise ValueError(f'max_distance must be between 0 and {MAX_DISTANCE}')
+    return max_distance
+
+
+@lru_cache(maxsize=None)
+def flip_masks(radius):
+    """Every BAND_BITS-bit mask with at most ``radius`` bits set."""
+    return tuple(
+        sum(1 << bit for bit in bits)
+        for count in range(radius + 1)
+        for bits in combinations(range(BAND_BITS), count)
+    )
+
+
+def find_near_duplicates(queryset, phash, max_distance=DEFAULT_MAX_DISTANCE, exclude_pk=None):
+    """
+    Return ``(distance, media_id)`` pairs from ``queryset`` whose hash is
+    within ``max_distance`` of ``phash``, closest first. Raises ValueError
+    above ``MAX_DISTANCE``.
+    """
+    masks = flip_masks(check_max_distance(max_distance) // HASH_BANDS)
+    condition = Q()
+    for i, band in enumerate(hash_bands(phash)):
+        condition |= Q(**{f'phash_band_{i}__in': [band ^ mask for mask in masks]})
+    candidates = queryset.filter(condition)
+    if exclude_pk is not None:
+        candidates = candidates.exclude(pk=exclude_pk)
+
+    matches = []
+    for pk, other in candidates.values_list('pk', 'perceptual_hash'):
+        distance = hamming(phash, other)
+        if distance <= max_distance:
+            matches.append((distance, pk))
+    return sorted(matches)
+
+
+class DuplicateDetector:
+    """
+    Checks incoming uploads against a scope (a batch or a user's library) and
+    against files already accepted earlier in the same request.
+    """
+    def __init__(self, queryset, action='flag', max_distance=DEFAULT_MAX_DISTANCE):
+        self.queryset = queryset
+        self.action = action
+        self.max_distance = check_max_distance(max_distance)
+        self.seen = BKTree()
+
+    @classmethod
+    def from_request(cls, request, batch=None):
+        """
+        Build a detector from the ``duplicates`` (allow/flag/skip) and
+        ``duplicate_scope`` (batch/library) request parameters. Returns None
+        when duplicates are allowed.
+        """
+        action = request.data.get('duplicates', 'flag')
+        if action not in DUPLICATE_ACTIONS:
+            raise ValueError(f'duplicates must be one of: {", ".join(DUPLICATE_ACTIONS)}')
+        scope = request.data.get('duplicate_scope', 'library')
+        if scope not in DUPLICATE_SCOPES:
+            raise ValueError(f'duplicate_scope must be one of: {", ".join(DUPLICATE_SCOPES)}')
+        if action == 'allow':
+            return None
+
+        if scope == 'batch' and batch is not None:
+            queryset = Media.objects.filter(batch=batch)
+        else:
+            queryset = Media.objects.filter(owner=request.user)
+        return cls(queryset, action=action)
+
+    def check(self, uploaded_file):
+        """
+        Hash ``uploaded_file`` and look for a near-duplicate. Returns
+        ``(phash, duplicate_id, distance)``; the last two are None when the
+        file is unique or not an image.
+        """
+        uploaded_file.seek(0)
+        phash = dhash(uploaded_file.read())
+        uploaded_file.seek(0)
+        duplicate_id, distance = self.check_hash(phash)
+        return phash, duplicate_id, distance
+
+    def check_hash(self, phash):
+        """Like ``check`` for an already computed hash: ``(duplicate_id, distance)``."""
+        if phash is None:
+            return None, None
+
+        matches = self.seen.find(phash, self.max_distance)
+        matches += find_near_duplicates(self.queryset, phash, self.max_distance)
+        if not matches:
+            return None, None
+        distance, duplicate_id = min(matches)
+        return duplicate_id, distance
+
+    def add(self, phash, media):
+        if phash is not None:
+            self.seen.add(phash, media.pk)
+
+
+def batch_duplicate_groups(batch, max_distance=DEFAULT_MAX_DISTANCE):
+    """
+    Group near-duplicate images inside ``batch`` using an in-memory BK-tree.
+    Each group is a list of media ids, oldest first.
+    """
+    tree = BKTree()
+    groups = {}
+    media = batch.media_files.exclude(perceptual_hash=None).order_by('pk').values_list('pk', 'perceptual_hash')
+    for pk, phash in media:
+        matches = tree.find(phash, max_distance)
+        if matches:
+            groups.setdefault(matches[0][1], []).append(pk)
+        else:
+            tree.add(phash, pk)
+    return [[original] + duplicates for original, duplicates in groups.items()]
@@ -0,0 +1,189 @@
+"""
+PDF report of a batch, shared by the sync and async export views.
+
+``build_batch_pdf`` only reads files from storage, not the database, so the
+async view can run it on its CPU executor with rows it fetched beforehand.
+``batch_pdf`` keeps each report in the ``exports`` storage under a name
+derived from everything it shows, so any node serves a repeated export
+without rendering it again, and a changed batch gets a new name.
+
+Images come from the thumbnails, which are already small, upright and free
+of EXIF, so the originals are only opened for media without one. ReportLab
+and Pillow are imported on first use: together they take longer to import
+than the rest of the API, and most workers never render a PDF.
+"""
+import hashlib
+import logging
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import storages
+
+logger = logging.getLogger(__name__)
+
+IMAGE_BOX = 200
+
+# Bump when the layout of build_batch_pdf changes, so stored reports are rebuilt
+EXPORT_FORMAT = 1
+
+
+def fit_box(width, height, box=IMAGE_BOX):
+    """Size that fits ``width`` x ``height`` in a ``box`` square, keeping the aspect ratio."""
+    if not width or not height:
+        return box, box
+    scale = box / max(width, height)
+    return width * scale, height * scale
+
+
+def pdf_image(media):
+    """A reportlab image of ``media``, upright and scaled to fit ``IMAGE_BOX``."""
+    from PIL import Image, ImageOps
+    from reportlab.platypus import Image as RLImage
+
+    if media.thumbnail:
+        # Read through the storage, and its disk cache on object storage
+        with media.thumbnail.open('rb') as f:
+            data = f.read()
+        if media.width and media.height:
+            width, height = fit_box(media.width, media.height)
+        else:
+            with Image.open(BytesIO(data)) as img:
+                width, height = fit_box(*img.size)
+        return RLImage(BytesIO(data), width=width, height=height)
+
+    with media.file.open('rb') as f:
+        img = Image.open(f)
+        img.load()
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((300, 300))
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    img_buffer = BytesIO()
+    img.save(img_buffer, format='JPEG')
+    img_buffer.seek(0)
+    width, height = fit_box(*img.size)
+    return RLImage(img_buffer, width=width, height=height)
+
+
+def build_batch_pdf(batch, media_files):
+    """
+    PDF bytes listing ``batch`` with a grid of its ``media_files``, and the
+    media whose image could not be read, which are left out of the grid.
+    """
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+
+    buffer = BytesIO()
+
+    doc = SimpleDocTemplate(
+        buffer,
+        pagesize=letter,
+        rightMargin=72,
+        leftMargin=72,
+        topMargin=72,
+        bottomMargin=72
+    )
+
+    elements = []
+    styles = getSampleStyleSheet()
+
+    # Add title
+    title_style = ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Heading1'],
+        fontSize=24,
+        spaceAfter=30
+    )
+    elements.append(Paragraph("Batch Report", title_style))
+
+    # Add batch information
+    elements.append(Paragraph(f"Batch ID: {batch.id}", styles['Heading2']))
+    elements.append(Paragraph(f"Title: {batch.title}", styles['Heading2']))
+    elements.append(Paragraph(f"Created: {batch.created_at.strftime('%Y-%m-%d %H:%M')}", styles['Normal']))
+    elements.append(Spacer(1, 12))
+
+    # Add images
+    elements.append(Paragraph("Images:", styles['Heading2']))
+    elements.append(Spacer(1, 12))
+
+    # Create image table
+    image_data = []
+    current_row = []
+    skipped = []
+
+    for media in media_files:
+        try:
+            # Add image and details to table
+            current_row.append([
+                pdf_image(media),
+                Paragraph(f"File: {os.path.basename(media.file.name)}", styles['Normal']),
+                Paragraph(f"Uploaded: {media.created_at.strftime('%Y-%m-%d')}", styles['Normal'])
+            ])
+
+            if len(current_row) == 2:
+                image_data.append(current_row)
+                current_row = []
+
+        except Exception as e:
+            logger.warning(f"Error processing image {media.file.name}: {str(e)}")
+            skipped.append(media)
+            continue
+
+    # Add remaining images
+    if current_row:
+        image_data.append(current_row)
+
+    # Create table for images
+    for row in image_data:
+        table = Table(row, colWidths=[250, 250])
+        table.setStyle(TableStyle([
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black),
+            ('PADDING', (0, 0), (-1, -1), 6),
+        ]))
+        elements.append(table)
+        elements.append(Spacer(1, 12))
+
+    doc.build(elements)
+    return buffer.getvalue(), skipped
+
+
+def export_name(batch, media_files):
+    """Name of the stored report of ``batch`` with exactly these ``media_files``."""
+    content = [EXPORT_FORMAT, batch.pk, batch.title, batch.created_at.isoformat()]
+    for media in media_files:
+        content.append([
+            media.pk, media.file.name, media.thumbnail.name or '', media.content_hash,
+            media.width, media.height, media.created_at.isoformat(),
+        ])
+    digest = hashlib.sha256(repr(content).encode()).hexdigest()
+    return f'batch_{batch.pk}_{digest[:16]}.pdf'
+
+
+def batch_pdf(batch, media_files):
+    """
+    PDF bytes of the batch report, from the exports storage when already
+    rendered. A report missing images (say, a storage hiccup) is returned
+    but not stored, so the next export tries again.
+    """
+    storage = storages['exports']
+    name = export_name(batch, media_files)
+    try:
+        with storage.open(name, 'rb') as f:
+            return f.read()
+    except OSError:
+        pass
+
+    pdf, skipped = build_batch_pdf(batch, media_files)
+    if skipped:
+        logger.warning(f"Not storing export {name}: {len(skipped)} of {len(media_files)} images were left out")
+        return pdf
+    try:
+        storage.save(name, ContentFile(pdf))
+    except OSError as e:
+        logger.warning(f"Could not store export {name}: {str(e)}")
+    return pdf
@@ -0,0 +1,126 @@
+"""
+Filtering and ordering of Media on the metadata read at ingest. Every
+filter and ordering field has an index (see ``Media.Meta.indexes``):
+
+- ``captured_after`` / ``captured_before``: ISO date or datetime
+- ``min_width`` / ``max_width`` / ``min_height`` / ``max_height``: pixels, upright
+- ``orientation``: ``landscape``, ``portrait`` or ``square``
+- ``camera``: exact camera name as returned by the API
+- ``has_location``: ``true`` or ``false``
+- ``bbox``: ``min_lon,min_lat,max_lon,max_lat``
+- ``ordering``: comma-separated fields from ``MEDIA_ORDERING_FIELDS``, ``-`` for descending
+
+Media without a value for the ordering field (non-images, photos without
+EXIF) sort as if it were the largest: last ascending, first descending. That
+is PostgreSQL's own NULL order, so both directions are plain forward or
+backward scans of the ascending indexes; SQLite gets the same order.
+"""
+from datetime import datetime, time
+
+from django.db.models import F
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils import timezone
+from rest_framework.exceptions import ParseError
+from rest_framework.filters import BaseFilterBackend
+
+MEDIA_ORDERING_FIELDS = ('captured_at', 'uploaded_at', 'width', 'height', 'file_size', 'title', 'camera')
+
+TRUE_VALUES = ('1', 'true', 'yes')
+FALSE_VALUES = ('0', 'false', 'no')
+
+
+def _parse_moment(name, value, end_of_day=False):
+    try:
+        day = parse_date(value)
+        # A bare date covers the whole day
+        moment = datetime.combine(day, time.max if end_of_day else time.min) if day else parse_datetime(value)
+    except ValueError:
+        moment = None
+    if moment is None:
+        raise ParseError(f'{name} must be an ISO date or datetime')
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment, timezone.get_default_timezone())
+    return moment
+
+
+def _parse_int(name, value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise ParseError(f'{name} must be an integer')
+    if number < 0:
+        raise ParseError(f'{name} must not be negative')
+    return number
+
+
+def filter_media(queryset, params):
+    """Apply the metadata filters in ``params`` (query parameters) to ``queryset``."""
+    if params.get('captured_after'):
+        queryset = queryset.filter(captured_at__gte=_parse_moment('captured_after', params['captured_after']))
+    if params.get('captured_before'):
+        queryset = queryset.filter(captured_at__lte=_parse_moment('captured_before', params['captured_before'], end_of_day=True))
+
+    for param, lookup in (('min_width', 'width__gte'), ('max_width', 'width__lte'),
+                          ('min_height', 'height__gte'), ('max_height', 'height__lte')):
+        if params.get(param):
+            queryset = queryset.filter(**{lookup: _parse_int(param, params[param])})
+
+    orientation = params.get('orientation')
+    if orientation:
+        if orientation == 'landscape':
+            queryset = queryset.filter(width__gt=F('height'))
+        elif orientation == 'portrait':
+            queryset = queryset.filter(height__gt=F('width'))
+        elif orientation == 'square':
+            queryset = queryset.filter(width=F('height'))
+        else:
+            raise ParseError('orientation must be one of landscape, portrait, square')
+
+    if params.get('camera'):
+        queryset = queryset.filter(camera=params['camera'])
+
+    has_location = params.get('has_location', '').lower()
+    if has_location in TRUE_VALUES:
+        queryset = queryset.filter(latitude__isnull=False)
+    elif has_location in FALSE_VALUES:
+        queryset = queryset.filter(latitude__isnull=True)
+    elif has_location:
+        raise ParseError('has_location must be true or false')
+
+    if params.get('bbox'):
+        try:
+            min_lon, min_lat, max_lon, max_lat = (float(part) for part in params['bbox'].split(','))
+        except ValueError:
+            raise ParseError('bbox must be min_lon,min_lat,max_lon,max_lat')
+        queryset = queryset.filter(latitude__range=(min_lat, max_lat))
+        if min_lon <= max_lon:
+            queryset = queryset.filter(longitude__range=(min_lon, max_lon))
+        else:
+            # The box crosses the antimeridian
+            queryset = queryset.filter(longitude__gte=min_lon) | queryset.filter(longitude__lte=max_lon)
+    return queryset
+
+
+def order_media(queryset, ordering, default=('pk',)):
+    """Order ``queryset`` by the comma-separated ``ordering`` parameter, nulls as largest."""
+    if not ordering:
+        return queryset.order_by(*default)
+    expressions = []
+    for term in ordering.split(','):
+        term = term.strip()
+        name = term.lstrip('-')
+        if name not in MEDIA_ORDERING_FIELDS:
+            raise ParseError(f'ordering must use {", ".join(MEDIA_ORDERING_FIELDS)}')
+        field = F(name)
+        expressions.append(field.desc(nulls_first=True) if term.startswith('-') else field.asc(nulls_last=True))
+    # A unique tie-breaker keeps pages stable
+    expressions.append(F('pk').desc() if ordering.strip().startswith('-') else F('pk').asc())
+    return queryset.order_by(*expressions)
+
+
+class MediaMetadataFilter(BaseFilterBackend):
+    """Filter backend exposing ``filter_media`` and ``order_media`` on list views."""
+
+    def filter_queryset(self, request, queryset, view):
+        queryset = filter_media(queryset, request.query_params)
+        return order_media(queryset, request.query_params.get('ordering'))
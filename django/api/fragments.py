@@ -0,0 +1,194 @@
+"""
+Cache of serialized representations ("fragments") of Media, MediaBatch and
+User objects.
+
+A fragment is stored under ``(model, pk, version, variant)``. The variant
+covers the serializer class and the request's scheme and host, which end up
+in absolute URLs. Versions live in Django's cache and are replaced with a
+fresh random token whenever an object changes, by the signal handlers in
+``api/signals.py`` and by the set-based helpers in ``api/bulk.py``, so a
+stale fragment is never looked up again and simply ages out. A version that
+was evicted is re-created with a new token, which can only cause a miss.
+
+``CachedRepresentationMixin`` caches single objects and, through
+``CachedListSerializer``, resolves a whole page with one ``get_many`` for
+the versions and one for the fragments, rendering only the misses. A small
+LRU in each process sits in front of Django's cache so hot fragments skip
+the cache round trip and unpickling.
+
+The versions must be shared by every worker, so ``FRAGMENT_CACHE_ENABLED``
+refuses to start on a per-process cache. Objects rendered while the request
+reads from a replica are served but not stored: a lagging replica could
+still return the row a version bump has just replaced.
+"""
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework import serializers
+
+from .db_routers import reading_from_replica
+
+VERSION_PREFIX = 'fragment-version'
+FRAGMENT_PREFIX = 'fragment'
+
+
+def _cache():
+    return caches[getattr(settings, 'FRAGMENT_CACHE_ALIAS', 'default')]
+
+
+class LocalLRU:
+    """Thread-safe, size-bounded in-process tier."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    self._data.move_to_end(key)
+                    found[key] = self._data[key]
+        return found
+
+    def set_many(self, items):
+        if not self.max_size:
+            return
+        with self._lock:
+            for key, value in items.items():
+                self._data[key] = value
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+local_cache = LocalLRU(getattr(settings, 'FRAGMENT_CACHE_LOCAL_SIZE', 5000))
+
+
+def _label(model):
+    return model._meta.label_lower
+
+
+def _version_key(model, pk):
+    return f'{VERSION_PREFIX}:{_label(model)}:{pk}'
+
+
+def _new_version():
+    return uuid.uuid4().hex[:16]
+
+
+def get_versions(model, pks):
+    """
+    Current version token of each pk, creating missing ones. A pk whose
+    token could not be stored (say, evicted at once) is left out.
+    """
+    cache = _cache()
+    keys = {pk: _version_key(model, pk) for pk in pks}
+    found = cache.get_many(list(keys.values()))
+    missing = [key for key in keys.values() if key not in found]
+    if missing:
+        # add() never replaces a token a concurrent bump_versions just stored,
+        # so read back whichever token won
+        for key in missing:
+            cache.add(key, _new_version(), timeout=None)
+        found.update(cache.get_many(missing))
+    return {pk: found[key] for pk, key in keys.items() if key in found}
+
+
+def bump_versions(model, pks, using='default'):
+    """
+    Invalidate the fragments of ``pks`` once the surrounding transaction
+    commits, so nothing can cache the old rows under the new version.
+    """
+    pks = {pk for pk in pks if pk is not None}
+    if not pks:
+        return
+
+    def bump():
+        _cache().set_many({_version_key(model, pk): _new_version() for pk in pks}, timeout=None)
+    transaction.on_commit(bump, using=using)
+
+
+def fragment_timeout():
+    return getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 24 * 60 * 60)
+
+
+def fragment_cache_enabled():
+    return getattr(settings, 'FRAGMENT_CACHE_ENABLED', False)
+
+
+class CachedListSerializer(serializers.ListSerializer):
+    """Renders a list from cached fragments, serializing only the misses."""
+
+    def to_representation(self, data):
+        iterable = data.all() if hasattr(data, 'all') else data
+        items = list(iterable)
+        if not fragment_cache_enabled():
+            return [self.child.render(item) for item in items]
+        return self.child.cached_representations(items)
+
+
+class CachedRepresentationMixin:
+    """
+    Serve ``to_representation`` from the fragment cache. Pair it with
+    ``Meta.list_serializer_class = CachedListSerializer``. Everything the
+    output depends on must bump the object's version when it changes.
+    """
+
+    def render(self, instance):
+        return super().to_representation(instance)
+
+    def fragment_variant(self):
+        request = self.context.get('request')
+        base = request.build_absolute_uri('/') if request else ''
+        name = f'{type(self).__module__}.{type(self).__qualname__}:{base}'
+        return hashlib.md5(name.encode()).hexdigest()[:12]
+
+    def to_representation(self, instance):
+        if not fragment_cache_enabled() or instance.pk is None:
+            return self.render(instance)
+        return self.cached_representations([instance])[0]
+
+    def cached_representations(self, instances):
+        model = self.Meta.model
+        variant = self.fragment_variant()
+        versions = get_versions(model, [instance.pk for instance in instances])
+        # An object whose version could not be stored is rendered, never cached
+        keys = [
+            f'{FRAGMENT_PREFIX}:{_label(model)}:{instance.pk}:{versions[instance.pk]}:{variant}'
+            if instance.pk in versions else None
+            for instance in instances
+        ]
+
+        cacheable = [key for key in keys if key is not None]
+        found = local_cache.get_many(cacheable)
+        remaining = [key for key in cacheable if key not in found]
+        if remaining:
+            shared = _cache().get_many(remaining)
+            local_cache.set_many(shared)
+            found.update(shared)
+
+        rendered = {}
+        results = []
+        for key, instance in zip(keys, instances):
+            if key is None:
+                results.append(self.render(instance))
+                continue
+            if key not in found:
+                rendered[key] = found[key] = self.render(instance)
+            results.append(found[key])
+        if rendered and not reading_from_replica():
+            _cache().set_many(rendered, timeout=fragment_timeout())
+            local_cache.set_many(rendered)
+        return results
@@ -0,0 +1,163 @@
+"""
+``Idempotency-Key`` support for the upload endpoints.
+
+The first request with a given key claims an ``IdempotencyKey`` row and runs
+the view; its response (anything below 500) is stored on the row. A retry
+with the same key gets the stored response back without running the view or
+touching storage. A duplicate that arrives while the original is still
+running polls the row until the response is stored, or gets a 409 with
+``Retry-After`` once ``IDEMPOTENCY_WAIT_SECONDS`` pass. Keys are scoped to
+the user, expire after ``IDEMPOTENCY_KEY_TTL`` seconds and are removed by
+``manage.py purge_idempotency_keys``.
+"""
+import hashlib
+import logging
+import time
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+POLL_INTERVAL = 0.25
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def request_fingerprint(request):
+    """
+    Hash of what makes two requests "the same": method, path, form fields and
+    the name and size of every uploaded file. Files are not read.
+    """
+    digest = hashlib.sha256(f'{request.method} {request.path}'.encode())
+    data = request.data
+    for name in sorted(data.keys()):
+        if name in request.FILES:
+            continue
+        for value in data.getlist(name) if hasattr(data, 'getlist') else [data[name]]:
+            digest.update(f'\0{name}={value}'.encode())
+    for name in sorted(request.FILES.keys()):
+        for upload in request.FILES.getlist(name):
+            digest.update(f'\0{name}:{upload.name}:{upload.size}'.encode())
+    return digest.hexdigest()
+
+
+def _claim(user, key, fingerprint):
+    """
+    Return ``(record, claimed)``. ``claimed`` is True when this request owns
+    the key and must run the view. ``record`` is None when the key kept
+    changing hands and could be neither claimed nor read.
+    """
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=_setting('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+    stale_before = now - timedelta(seconds=_setting('IDEMPOTENCY_PENDING_TIMEOUT', 10 * 60))
+
+    for _ in range(3):
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(
+                    user=user, key=key, fingerprint=fingerprint, created_at=now, expires_at=expires_at
+                )
+            return record, True
+        except IntegrityError:
+            pass
+
+        record = IdempotencyKey.objects.filter(user=user, key=key).first()
+        if record is None:
+            # Released by a failed request in the meantime
+            continue
+        abandoned = record.response_status is None and record.created_at < stale_before
+        if record.expires_at > now and not abandoned:
+            return record, False
+
+        # Expired, or its request died: take it over. Matching on created_at
+        # makes this a compare-and-set, so only one contender wins.
+        taken = IdempotencyKey.objects.filter(pk=record.pk, created_at=record.created_at).update(
+            fingerprint=fingerprint, created_at=now, expires_at=expires_at,
+            response_status=None, response_body=None,
+        )
+        if taken:
+            record.fingerprint, record.created_at, record.expires_at = fingerprint, now, expires_at
+            record.response_status = record.response_body = None
+            return record, True
+    return None, False
+
+
+def _wait_for_response(record):
+    deadline = time.monotonic() + _setting('IDEMPOTENCY_WAIT_SECONDS', 30)
+    while record.response_status is None:
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(POLL_INTERVAL)
+        record = IdempotencyKey.objects.filter(pk=record.pk).first()
+        if record is None:
+            return None
+    return record
+
+
+def in_progress(retry_after):
+    return Response({'detail': 'A request with this key is still in progress'},
+                    status=status.HTTP_409_CONFLICT, headers={'Retry-After': str(retry_after)})
+
+
+def idempotent(view):
+    """
+    Make a DRF view function (or, through ``method_decorator``, an APIView
+    method) honour the ``Idempotency-Key`` header. Apply it closest to the
+    function so authentication has already run.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None or not request.user.is_authenticated:
+            return view(request, *args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return Response({'detail': f'{HEADER} must be 1 to {MAX_KEY_LENGTH} characters'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        fingerprint = request_fingerprint(request)
+        record, claimed = _claim(request.user, key, fingerprint)
+        if record is None:
+            return in_progress(retry_after=1)
+        if not claimed:
+            if record.fingerprint != fingerprint:
+                return Response({'detail': f'{HEADER} was already used for a different request'},
+                                status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+            finished = _wait_for_response(record)
+            if finished is None:
+                return in_progress(retry_after=_setting('IDEMPOTENCY_WAIT_SECONDS', 30))
+            return Response(finished.response_body, status=finished.response_status,
+                            headers={'Idempotent-Replayed': 'true'})
+
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            IdempotencyKey.objects.filter(pk=record.pk).delete()
+            raise
+
+        if response.status_code >= 500 or not hasattr(response, 'data'):
+            # Let the client retry server errors for real
+            IdempotencyKey.objects.filter(pk=record.pk).delete()
+        else:
+            IdempotencyKey.objects.filter(pk=record.pk).update(
+                response_status=response.status_code, response_body=response.data
+            )
+        return response
+    return wrapper
+
+
+def purge_expired_keys():
+    """Delete expired keys. Returns the number deleted."""
+    deleted, _ = IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
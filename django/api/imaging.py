@@ -0,0 +1,177 @@
+"""
+Image helpers. Pillow is imported inside the functions so that modules which
+only store or list media do not pay for it.
+"""
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+HASH_BANDS = 4
+BAND_BITS = HASH_BITS // HASH_BANDS
+HASH_MASK = (1 << HASH_BITS) - 1
+
+# EXIF tags read by read_metadata
+TAG_MAKE = 0x010F
+TAG_MODEL = 0x0110
+TAG_ORIENTATION = 0x0112
+TAG_DATETIME = 0x0132
+IFD_EXIF = 0x8769
+IFD_GPS = 0x8825
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_OFFSET_TIME_ORIGINAL = 0x9011
+
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_QUALITY = 80
+
+
+def dhash(data):
+    """
+    64-bit difference hash of the image in ``data`` (bytes), returned as a
+    signed integer so it fits a database BIGINT. Returns None for anything
+    Pillow cannot decode.
+    """
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with Image.open(BytesIO(data)) as img:
+            # Let the JPEG decoder downscale while decoding
+            img.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))
+            img = img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+            pixels = list(img.getdata())
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None
+
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def hash_bands(value):
+    """
+    Split a hash into HASH_BANDS equal bands. Two hashes within
+    HASH_BANDS - 1 bits of each other share at least one band exactly.
+    """
+    band_mask = (1 << BAND_BITS) - 1
+    return [(value >> (i * BAND_BITS)) & band_mask for i in range(HASH_BANDS)]
+
+
+def hamming(a, b):
+    return bin((a ^ b) & HASH_MASK).count('1')
+
+
+def _exif_text(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    return value.strip('\x00 ') if isinstance(value, str) else ''
+
+
+def _exif_datetime(value, offset=None):
+    """EXIF ``YYYY:MM:DD HH:MM:SS`` as an aware datetime; UTC unless ``offset`` says otherwise."""
+    try:
+        parsed = datetime.strptime(_exif_text(value)[:19], '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        return None
+    tz = timezone.utc
+    offset = _exif_text(offset)
+    if len(offset) == 6 and offset[0] in '+-' and offset[3] == ':':
+        try:
+            minutes = int(offset[1:3]) * 60 + int(offset[4:6])
+            tz = timezone(timedelta(minutes=-minutes if offset[0] == '-' else minutes))
+        except ValueError:
+            pass
+    return parsed.replace(tzinfo=tz)
+
+
+def _gps_coordinate(value, ref, limit):
+    try:
+        degrees, minutes, seconds = (float(part) for part in value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    coordinate = degrees + minutes / 60 + seconds / 3600
+    if _exif_text(ref).upper() in ('S', 'W'):
+        coordinate = -coordinate
+    return round(coordinate, 7) if abs(coordinate) <= limit else None
+
+
+def read_metadata(data):
+    """
+    Capture time, display dimensions, EXIF orientation, camera and GPS
+    position of the image in ``data``, read from the header only (the pixels
+    are never decoded). Returns an empty dict for anything Pillow cannot open;
+    missing values are None.
+    """
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with Image.open(BytesIO(data)) as img:
+            width, height = img.size
+            if img.format == 'PNG':
+                # PngImageFile.getexif() decodes the image to find a trailing eXIf chunk
+                exif = Image.Exif()
+                if 'exif' in img.info:
+                    exif.load(img.info['exif'])
+            else:
+                exif = img.getexif()
+            exif_ifd = exif.get_ifd(IFD_EXIF)
+            gps_ifd = exif.get_ifd(IFD_GPS)
+    except (UnidentifiedImageError, OSError, ValueError, SyntaxError):
+        return {}
+
+    orientation = exif.get(TAG_ORIENTATION)
+    orientation = orientation if orientation in range(1, 9) else None
+    # Orientations 5-8 are rotated by 90 degrees: report the upright size
+    if orientation and orientation >= 5:
+        width, height = height, width
+
+    make, model = _exif_text(exif.get(TAG_MAKE)), _exif_text(exif.get(TAG_MODEL))
+    camera = model if model.lower().startswith(make.lower()) else f'{make} {model}'.strip()
+
+    captured_at = None
+    if TAG_DATETIME_ORIGINAL in exif_ifd:
+        captured_at = _exif_datetime(exif_ifd[TAG_DATETIME_ORIGINAL], exif_ifd.get(TAG_OFFSET_TIME_ORIGINAL))
+    if captured_at is None and TAG_DATETIME in exif:
+        captured_at = _exif_datetime(exif[TAG_DATETIME])
+
+    latitude = longitude = None
+    if 2 in gps_ifd and 4 in gps_ifd:
+        latitude = _gps_coordinate(gps_ifd[2], gps_ifd.get(1), 90)
+        longitude = _gps_coordinate(gps_ifd[4], gps_ifd.get(3), 180)
+        if latitude is None or longitude is None:
+            latitude = longitude = None
+
+    return {
+        'captured_at': captured_at,
+        'width': width,
+        'height': height,
+        'orientation': orientation,
+        'camera': camera[:255],
+        'latitude': latitude,
+        'longitude': longitude,
+    }
+
+
+def make_thumbnail(data, size=THUMBNAIL_SIZE):
+    """
+    JPEG bytes of an upright thumbnail of the image in ``data`` that fits in
+    ``size``, or None if ``data`` is not an image. EXIF and other metadata are
+    left out; only the colour profile is kept.
+    """
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    try:
+        with Image.open(BytesIO(data)) as img:
+            img.draft('RGB', size)
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail(size)
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            output = BytesIO()
+            img.save(output, format='JPEG', quality=THUMBNAIL_QUALITY, optimize=True,
+                     icc_profile=img.info.get('icc_profile'))
+            return output.getvalue()
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None
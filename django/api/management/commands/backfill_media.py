@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from api.fragments import bump_versions
+from api.models import Media, MediaBatch, User, file_hash
+
+
+class Command(BaseCommand):
+    help = 'Compute file sizes, content hashes, image metadata, perceptual hashes and thumbnails for media uploaded before ingest processing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        fields = [
+            'file_size', 'content_hash', 'thumbnail',
+            'perceptual_hash', 'phash_band_0', 'phash_band_1', 'phash_band_2', 'phash_band_3',
+            *Media.METADATA_FIELDS,
+        ]
+        updated = skipped = 0
+        pending = []
+
+        missing = Q(content_hash='') | Q(perceptual_hash=None) | Q(width=None) | Q(thumbnail='') | Q(thumbnail=None) | Q(file_size=0)
+        for media in Media.objects.filter(missing).order_by('pk').iterator(chunk_size=chunk_size):
+            data = media.file_data
+            if not data and media.file:
+                try:
+                    with media.file.open('rb') as f:
+                        data = f.read()
+                except OSError:
+                    data = None
+            if not data:
+                skipped += 1
+                continue
+
+            media.process_file_data(bytes(data))
+            media.set_hash_bands()
+            pending.append(media)
+            if len(pending) >= chunk_size:
+                updated += self.save_chunk(pending, fields)
+                pending = []
+        if pending:
+            updated += self.save_chunk(pending, fields)
+
+        # Profile photos get a content hash for their versioned URL too
+        photos = 0
+        for user in User.objects.exclude(profile_photo='').exclude(profile_photo=None).filter(profile_photo_hash=''):
+            try:
+                user.profile_photo_hash = file_hash(user.profile_photo)
+            except OSError:
+                continue
+            finally:
+                user.profile_photo.close()
+            User.objects.filter(pk=user.pk).update(profile_photo_hash=user.profile_photo_hash)
+            bump_versions(User, [user.pk])
+            photos += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Updated {updated} files and {photos} profile photos, skipped {skipped} missing files'
+        ))
+
+    def save_chunk(self, media, fields):
+        updated = Media.objects.bulk_update(media, fields)
+        # File URLs and metadata are part of the cached representations
+        bump_versions(Media, [item.pk for item in media])
+        bump_versions(MediaBatch, [item.batch_id for item in media])
+        return updated
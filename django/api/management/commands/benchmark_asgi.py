@@ -0,0 +1,173 @@
+import asyncio
+import io
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from rest_framework.authtoken.models import Token
+
+from api.models import Media, User
+
+BENCHMARK_USERNAME = 'asgi-benchmark'
+BOUNDARY = 'benchmark-boundary'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def sample_image():
+    from PIL import Image
+
+    output = io.BytesIO()
+    Image.new('RGB', (640, 480), (90, 120, 200)).save(output, format='JPEG')
+    return output.getvalue()
+
+
+def multipart_body(image):
+    return (
+        f'--{BOUNDARY}\r\n'
+        'Content-Disposition: form-data; name="file"; filename="benchmark.jpg"\r\n'
+        'Content-Type: image/jpeg\r\n\r\n'
+    ).encode() + image + f'\r\n--{BOUNDARY}--\r\n'.encode()
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the WSGI (gunicorn sync workers) and ASGI (one uvicorn process) '
+        'deployments while many clients trickle uploads to /api/async/upload/, '
+        'measuring how quickly a normal API request is still answered'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--slow-clients', type=int, default=200)
+        parser.add_argument('--trickle-seconds', type=float, default=10.0,
+                            help='How long each slow client takes to send its body')
+        parser.add_argument('--wsgi-workers', type=int, default=4)
+        parser.add_argument('--probe-path', default='/api/batches/')
+        parser.add_argument('--probe-timeout', type=float, default=5.0)
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(username=BENCHMARK_USERNAME, defaults={'role': 'user'})
+        token, _ = Token.objects.get_or_create(user=user)
+        body = multipart_body(sample_image())
+        servers = {
+            'wsgi': [sys.executable, '-m', 'gunicorn', 'backend.wsgi:application',
+                     '--workers', str(options['wsgi_workers']), '--timeout', '300', '--log-level', 'warning'],
+            'asgi': [sys.executable, '-m', 'uvicorn', 'backend.asgi:application',
+                     '--log-level', 'warning', '--backlog', '4096'],
+        }
+        try:
+            for name, command in servers.items():
+                port = free_port()
+                bind = ['--bind', f'127.0.0.1:{port}'] if name == 'wsgi' else ['--host', '127.0.0.1', '--port', str(port)]
+                process = self.start_server(command + bind, port)
+                try:
+                    result = asyncio.run(self.run(port, token.key, body, options))
+                finally:
+                    process.terminate()
+                    process.wait(timeout=30)
+                self.report(name, result, options)
+        finally:
+            for media in Media.all_objects.filter(owner=user):
+                media.delete()
+            user.delete()
+
+    def start_server(self, command, port):
+        env = dict(
+            os.environ,
+            # Measure the server, not the per-user admission control
+            THROTTLE_RATE_UPLOADS='1000000/min',
+            CONCURRENCY_UPLOADS_PER_USER='0',
+            CONCURRENCY_UPLOADS_TOTAL='0',
+        )
+        process = subprocess.Popen(command, cwd=settings.BASE_DIR, env=env)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return process
+            except OSError:
+                time.sleep(0.2)
+        process.terminate()
+        raise RuntimeError(f'Server did not start: {" ".join(command)}')
+
+    async def run(self, port, token, body, options):
+        stop = asyncio.Event()
+        uploads = [
+            asyncio.create_task(self.slow_upload(port, token, body, options['trickle_seconds']))
+            for _ in range(options['slow_clients'])
+        ]
+        # Let the slow clients connect before probing
+        await asyncio.sleep(1)
+        probe = asyncio.create_task(self.probe(port, token, options['probe_path'], options['probe_timeout'], stop))
+        statuses = await asyncio.gather(*uploads, return_exceptions=True)
+        stop.set()
+        latencies, failures = await probe
+        return statuses, latencies, failures
+
+    async def slow_upload(self, port, token, body, seconds):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            writer.write((
+                'POST /api/async/upload/ HTTP/1.1\r\nHost: localhost\r\n'
+                f'Authorization: Token {token}\r\n'
+                f'Content-Type: multipart/form-data; boundary={BOUNDARY}\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+            ).encode())
+            pieces = 20
+            step = -(-len(body) // pieces)
+            for start in range(0, len(body), step):
+                writer.write(body[start:start + step])
+                await writer.drain()
+                await asyncio.sleep(seconds / pieces)
+            status_line = await reader.readline()
+            return int(status_line.split()[1])
+        finally:
+            writer.close()
+
+    async def probe(self, port, token, path, timeout, stop):
+        latencies, failures = [], 0
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(self.get(port, token, path), timeout)
+                latencies.append((time.perf_counter() - start) * 1000)
+            except (asyncio.TimeoutError, OSError):
+                failures += 1
+            await asyncio.sleep(0.2)
+        return latencies, failures
+
+    async def get(self, port, token, path):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            writer.write((
+                f'GET {path} HTTP/1.1\r\nHost: localhost\r\n'
+                f'Authorization: Token {token}\r\nConnection: close\r\n\r\n'
+            ).encode())
+            await writer.drain()
+            await reader.read()
+        finally:
+            writer.close()
+
+    def report(self, name, result, options):
+        statuses, latencies, failures = result
+        created = sum(1 for status in statuses if status == 201)
+        self.stdout.write(
+            f'{name}: {created}/{len(statuses)} slow uploads succeeded; '
+            f'probe {options["probe_path"]}: {len(latencies)} answered, {failures} timed out (>{options["probe_timeout"]}s)'
+        )
+        if latencies:
+            latencies.sort()
+            p95 = latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+            self.stdout.write(
+                f'  probe latency: p50 {statistics.median(latencies):.1f}ms, '
+                f'p95 {p95:.1f}ms, max {latencies[-1]:.1f}ms'
+            )
@@ -0,0 +1,104 @@
+import statistics
+import threading
+import time
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, close_old_connections, connection, connections, transaction
+from django.test import RequestFactory
+from rest_framework.authtoken.models import Token
+
+from api.models import MediaBatch, User
+
+BENCHMARK_USERNAME = 'db-benchmark'
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure request latency with per-request connections (CONN_MAX_AGE=0) '
+        'against the configured persistent connections, and concurrent write '
+        'throughput under the configured database options'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--path', default='/api/batches/')
+        parser.add_argument('--writers', type=int, default=8, help='Concurrent writer threads')
+        parser.add_argument('--writes', type=int, default=50, help='Writes per thread')
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(username=BENCHMARK_USERNAME, defaults={'role': 'user'})
+        token, _ = Token.objects.get_or_create(user=user)
+        try:
+            self.stdout.write(f"Database: {connection.vendor} ({connection.settings_dict['NAME']})")
+            configured = connection.settings_dict['CONN_MAX_AGE']
+            for label, conn_max_age in (('per-request connections', 0), ('configured', configured)):
+                timings = self.run_requests(options['path'], token.key, options['requests'], conn_max_age)
+                self.report(f'{label} (CONN_MAX_AGE={conn_max_age})', timings)
+            connection.settings_dict['CONN_MAX_AGE'] = configured
+
+            if options['writers']:
+                self.run_writers(user, options['writers'], options['writes'])
+        finally:
+            MediaBatch.objects.filter(owner=user).delete()
+            user.delete()
+
+    def run_requests(self, path, token, count, conn_max_age):
+        # Go through the real WSGI handler so request_started/request_finished
+        # close or keep connections exactly as in production
+        handler = WSGIHandler()
+        factory = RequestFactory()
+        connection.settings_dict['CONN_MAX_AGE'] = conn_max_age
+        connection.close()
+
+        timings = []
+        for _ in range(count):
+            environ = factory.get(path, HTTP_AUTHORIZATION=f'Token {token}', SERVER_NAME='localhost').environ
+            start = time.perf_counter()
+            response = handler(environ, lambda status, headers: None)
+            b''.join(response)
+            response.close()
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def run_writers(self, user, writers, writes):
+        errors = []
+        barrier = threading.Barrier(writers)
+
+        def writer():
+            barrier.wait()
+            try:
+                for i in range(writes):
+                    try:
+                        # The referral id is read and written in one transaction
+                        with transaction.atomic():
+                            MediaBatch.objects.create(owner=user, title=f'benchmark {i}')
+                    except DatabaseError as e:
+                        errors.append(str(e))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=writer) for _ in range(writers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        total = writers * writes
+        self.stdout.write(
+            f'concurrent writes: {writers} threads x {writes} = {total} inserts in {elapsed:.2f}s '
+            f'({(total - len(errors)) / elapsed:.0f}/s), {len(errors)} errors'
+        )
+        if errors:
+            self.stdout.write(self.style.WARNING(f'first error: {errors[0]}'))
+
+    def report(self, label, timings):
+        timings.sort()
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        self.stdout.write(
+            f'{label}: mean {statistics.mean(timings):.2f}ms, '
+            f'p50 {statistics.median(timings):.2f}ms, p95 {p95:.2f}ms'
+        )
+        close_old_connections()
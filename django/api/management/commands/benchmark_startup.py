@@ -0,0 +1,139 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# Boots the project like a fresh worker (settings, apps, URLconf and views)
+BOOT = """
+import os, resource
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+import backend.wsgi
+from django.urls import get_resolver
+get_resolver().url_patterns
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+# Forks WORKERS processes, either after preloading the app in the parent or
+# before importing anything, has each load what a busy worker ends up with,
+# and prints their memory from /proc/<pid>/smaps_rollup as JSON.
+WORKERS = r"""
+import json, os, sys, time
+preload, count = sys.argv[1] == 'preload', int(sys.argv[2])
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+
+def boot(preload):
+    import importlib
+    from backend.wsgi import create_application
+    create_application(preload=preload)
+    from django.conf import settings
+    from django.urls import get_resolver
+    get_resolver().url_patterns
+    for module in settings.PRELOAD_MODULES:
+        importlib.import_module(module)
+
+if preload:
+    boot(True)
+pids, ready = [], []
+for _ in range(count):
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        if not preload:
+            boot(False)
+        os.write(write_end, b'1')
+        time.sleep(600)
+        os._exit(0)
+    os.close(write_end)
+    pids.append(pid)
+    ready.append(read_end)
+for fd in ready:
+    os.read(fd, 1)
+
+def rollup(pid):
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1])
+    return values
+
+stats = [rollup(pid) for pid in pids]
+for pid in pids:
+    os.kill(pid, 9)
+    os.waitpid(pid, 0)
+print(json.dumps(stats))
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure worker start-up: boot time and import time (python -X importtime) of '
+        'a fresh process by package, and per-worker memory with and without '
+        'preloading the app before forking'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5)
+        parser.add_argument('--top', type=int, default=15, help='Packages to list by import time')
+        parser.add_argument('--workers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        self.boot_time(options['runs'], options['top'])
+        if os.path.exists('/proc/self/smaps_rollup'):
+            self.worker_memory(options['workers'])
+        else:
+            self.stdout.write('Per-worker memory needs /proc/<pid>/smaps_rollup (Linux); skipped')
+
+    def run(self, *args):
+        return subprocess.run(
+            [sys.executable, *args], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        )
+
+    def boot_time(self, runs, top):
+        walls, imports, rss = [], [], []
+        packages = {}
+        for _ in range(runs):
+            start = time.perf_counter()
+            result = self.run('-X', 'importtime', '-c', BOOT)
+            walls.append((time.perf_counter() - start) * 1000)
+            rss.append(int(result.stdout.split()[-1]) / 1024)
+            totals = {}
+            for line in result.stderr.splitlines():
+                if not line.startswith('import time:') or 'self [us]' in line:
+                    continue
+                head, _, name = line.split('|')
+                package = name.strip().split('.')[0]
+                totals[package] = totals.get(package, 0) + int(head.split(':')[1])
+            imports.append(sum(totals.values()) / 1000)
+            for package, total in totals.items():
+                packages.setdefault(package, []).append(total)
+
+        self.stdout.write(
+            f'Boot ({runs} runs): wall {statistics.median(walls):.0f}ms, '
+            f'imports {statistics.median(imports):.0f}ms, max RSS {statistics.median(rss):.1f}MB'
+        )
+        heavy = [name for name in ('reportlab', 'PIL', 'firebase_admin', 'google') if name in packages]
+        self.stdout.write(f'Heavy libraries imported at boot: {", ".join(heavy) or "none"}')
+        self.stdout.write('Import time by package (median):')
+        slowest = sorted(packages.items(), key=lambda item: statistics.median(item[1]), reverse=True)[:top]
+        for name, times in slowest:
+            self.stdout.write(f'  {statistics.median(times) / 1000:8.1f}ms  {name}')
+
+    def worker_memory(self, workers):
+        for mode in ('lazy', 'preload'):
+            stats = json.loads(self.run('-c', WORKERS, mode, str(workers)).stdout.strip().splitlines()[-1])
+            mean = {
+                key: statistics.mean(stat.get(key, 0) for stat in stats) / 1024
+                for key in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty')
+            }
+            self.stdout.write(
+                f'{workers} workers, {mode}: per worker RSS {mean["Rss"]:.1f}MB, '
+                f'PSS {mean["Pss"]:.1f}MB, private {mean["Private_Clean"] + mean["Private_Dirty"]:.1f}MB'
+            )
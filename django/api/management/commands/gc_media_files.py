@@ -0,0 +1,82 @@
+import time
+
+from django.core.files.storage import storages
+from django.core.management.base import BaseCommand
+
+from api.models import Media, User
+from api.storage import list_files
+
+# Directories of the default storage and the columns that reference their files
+MEDIA_DIRS = {
+    'uploaded_media/': (Media.all_objects, 'file'),
+    'thumbnails/': (Media.all_objects, 'thumbnail'),
+    'profile_photos/': (User.objects, 'profile_photo'),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete stored files that no Media or User row references, and batch '
+        'PDFs in the exports storage older than --export-max-age'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=3600,
+                            help='Only consider files older than this many seconds, so in-flight uploads are kept')
+        parser.add_argument('--export-max-age', type=int, default=7 * 24 * 60 * 60,
+                            help='Remove stored batch PDFs older than this many seconds; they are rendered again on demand')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        cutoff = time.time() - options['min_age']
+        scanned = removed = freed = 0
+
+        for directory, (manager, field) in MEDIA_DIRS.items():
+            storage = manager.model._meta.get_field(field).storage
+            chunk = {}
+            for name, size, modified in list_files(storage, directory):
+                if modified > cutoff:
+                    continue
+                scanned += 1
+                chunk[name] = size
+                if len(chunk) >= options['chunk_size']:
+                    count, size = self.collect(storage, chunk, manager, field, options['dry_run'])
+                    removed, freed, chunk = removed + count, freed + size, {}
+            if chunk:
+                count, size = self.collect(storage, chunk, manager, field, options['dry_run'])
+                removed, freed = removed + count, freed + size
+
+        exports = storages['exports']
+        export_cutoff = time.time() - options['export_max_age']
+        for name, size, modified in list_files(exports, ''):
+            scanned += 1
+            if modified <= export_cutoff:
+                removed, freed = removed + 1, freed + size
+                self.remove(exports, name, options['dry_run'])
+
+        verb = 'Would remove' if options['dry_run'] else 'Removed'
+        self.stdout.write(self.style.SUCCESS(
+            f'Scanned {scanned} files. {verb} {removed} orphans ({freed / (1024 * 1024):.1f} MB)'
+        ))
+
+    def collect(self, storage, sizes, manager, field, dry_run):
+        referenced = set(manager.filter(**{f'{field}__in': list(sizes)}).values_list(field, flat=True))
+
+        count = size = 0
+        for name, file_size in sizes.items():
+            if name in referenced:
+                continue
+            count += 1
+            size += file_size
+            self.remove(storage, name, dry_run)
+        return count, size
+
+    def remove(self, storage, name, dry_run):
+        if dry_run:
+            self.stdout.write(f'orphan: {name}')
+            return
+        try:
+            storage.delete(name)
+        except OSError as e:
+            self.stderr.write(f'Could not delete {name}: {str(e)}')
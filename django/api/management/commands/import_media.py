@@ -0,0 +1,268 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+import zipfile
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from api.bulk import bulk_create_media
+from api.dedup import DUPLICATE_ACTIONS, BKTree, DuplicateDetector
+from api.imaging import dhash, make_thumbnail, read_metadata
+from api.models import Media, MediaBatch, User
+
+DEFAULT_EXTENSIONS = 'jpg,jpeg,png,gif,webp,bmp,tif,tiff,heic'
+
+# Opened once per worker process when importing from a ZIP
+_archive = None
+
+
+def _open_archive(path):
+    global _archive
+    _archive = zipfile.ZipFile(path)
+
+
+def ingest(task):
+    """
+    Worker: read one file and compute everything that costs CPU. Returns a
+    dict, with ``error`` set instead when the file cannot be read.
+    """
+    name, location = task
+    try:
+        if _archive is not None:
+            data = _archive.read(location)
+        else:
+            with open(location, 'rb') as f:
+                data = f.read()
+    except (OSError, KeyError, zipfile.BadZipFile) as e:
+        return {'name': name, 'error': str(e)}
+    return {
+        'name': name,
+        'data': data,
+        'sha256': hashlib.sha256(data).hexdigest(),
+        'phash': dhash(data),
+        'metadata': read_metadata(data),
+        'thumbnail': make_thumbnail(data),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'Import a directory tree or ZIP of photos. Top-level folders become batches '
+        '(or <owner>/<batch> with --layout owner/batch); files are hashed and '
+        'thumbnailed in parallel and inserted in bulk. Re-running resumes from the manifest.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='Directory or .zip file')
+        parser.add_argument('--owner', help='Username that owns the batches (layout "batch")')
+        parser.add_argument('--layout', choices=['batch', 'owner/batch'], default='batch')
+        parser.add_argument('--default-batch', help='Batch for files outside any folder (default: source name)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--chunk-size', type=int, default=50, help='Files per insert transaction')
+        parser.add_argument('--duplicates', choices=DUPLICATE_ACTIONS, default='flag',
+                            help='What to do with near-duplicates of the owner\'s existing media')
+        parser.add_argument('--extensions', default=DEFAULT_EXTENSIONS)
+        parser.add_argument('--manifest', help='Resume manifest (default: <source>.import-manifest.jsonl)')
+
+    def handle(self, *args, **options):
+        source = os.path.abspath(options['source'])
+        is_zip = zipfile.is_zipfile(source) if os.path.isfile(source) else False
+        if not is_zip and not os.path.isdir(source):
+            raise CommandError(f'{source} is neither a directory nor a ZIP file')
+
+        manifest_path = options['manifest'] or f'{source.rstrip(os.sep)}.import-manifest.jsonl'
+        done = self.read_manifest(manifest_path)
+        extensions = {f'.{ext.strip().lower().lstrip(".")}' for ext in options['extensions'].split(',')}
+        default_batch = options['default_batch'] or os.path.splitext(os.path.basename(source))[0]
+
+        tasks = [
+            (name, location) for name, location in self.list_files(source, is_zip)
+            if os.path.splitext(name)[1].lower() in extensions and name not in done
+        ]
+        targets = self.resolve_targets([name for name, _ in tasks], options, default_batch)
+        self.stdout.write(f'{len(tasks)} files to import ({len(done)} already in the manifest)')
+        if not tasks:
+            return
+
+        self.detectors = {}
+        self.seen_content = set()
+        self.counts = {'imported': 0, 'duplicates': 0, 'failed': 0}
+        self.bytes = 0
+        pending = []
+        start = time.monotonic()
+
+        # Workers never touch the database; don't let them inherit connections
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        initializer, initargs = (_open_archive, (source,)) if is_zip else (None, ())
+        with open(manifest_path, 'a') as manifest, \
+                context.Pool(options['workers'], initializer=initializer, initargs=initargs) as pool:
+            for processed, result in enumerate(pool.imap_unordered(ingest, tasks, chunksize=4), start=1):
+                pending.append(result)
+                if len(pending) >= options['chunk_size']:
+                    self.flush(pending, targets, options['duplicates'], manifest)
+                    pending = []
+                self.progress(processed, len(tasks), start)
+            if pending:
+                self.flush(pending, targets, options['duplicates'], manifest)
+
+        elapsed = time.monotonic() - start
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {self.counts['imported']} files, skipped {self.counts['duplicates']} duplicates, "
+            f"{self.counts['failed']} failed in {elapsed:.1f}s "
+            f"({len(tasks) / elapsed:.1f} files/s, {self.bytes / elapsed / (1024 * 1024):.1f} MB/s)"
+        ))
+
+    def read_manifest(self, path):
+        done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    # Failed files are retried on the next run
+                    if entry.get('status') != 'failed':
+                        done.add(entry['path'])
+        return done
+
+    def list_files(self, source, is_zip):
+        if is_zip:
+            with zipfile.ZipFile(source) as archive:
+                for info in archive.infolist():
+                    name = info.filename
+                    if info.is_dir() or name.startswith('__MACOSX/') or os.path.basename(name).startswith('.'):
+                        continue
+                    yield name, name
+            return
+        for root, dirs, files in os.walk(source):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for file_name in sorted(files):
+                if file_name.startswith('.'):
+                    continue
+                path = os.path.join(root, file_name)
+                yield os.path.relpath(path, source).replace(os.sep, '/'), path
+
+    def resolve_targets(self, names, options, default_batch):
+        """Map every file to its ``(owner, batch)``, creating missing batches."""
+        owners = {}
+        if options['layout'] == 'batch':
+            if not options['owner']:
+                raise CommandError('--owner is required with --layout batch')
+            usernames = {options['owner']}
+        else:
+            usernames = {name.split('/')[0] for name in names if '/' in name}
+        for user in User.objects.filter(username__in=usernames):
+            owners[user.username] = user
+        missing = usernames - set(owners)
+        if missing:
+            raise CommandError(f'Unknown owners: {", ".join(sorted(missing))}')
+
+        keys = {}
+        for name in names:
+            parts = name.split('/')
+            if options['layout'] == 'batch':
+                owner, title = options['owner'], parts[0] if len(parts) > 1 else default_batch
+            else:
+                if len(parts) < 2:
+                    raise CommandError(f'{name} is not inside an <owner>/ folder')
+                owner, title = parts[0], parts[1] if len(parts) > 2 else default_batch
+            keys[name] = (owner, title)
+
+        batches = {}
+        for owner, title in set(keys.values()):
+            batch = MediaBatch.objects.filter(owner=owners[owner], title=title).order_by('pk').first()
+            if batch is None:
+                batch = MediaBatch.objects.create(owner=owners[owner], title=title)
+            batches[(owner, title)] = batch
+        return {name: (owners[key[0]], batches[key]) for name, key in keys.items()}
+
+    def detector(self, owner, action):
+        if action == 'allow':
+            return None
+        if owner.pk not in self.detectors:
+            self.detectors[owner.pk] = DuplicateDetector(Media.objects.filter(owner=owner), action=action)
+        return self.detectors[owner.pk]
+
+    def flush(self, results, targets, action, manifest):
+        """Store the files of one chunk and insert their rows in one transaction."""
+        objs, entries = [], []
+        # Near-duplicates among files of this chunk, which are not saved yet
+        chunk_tree, chunk_duplicates = BKTree(), []
+        for result in results:
+            name = result['name']
+            if 'error' in result:
+                self.counts['failed'] += 1
+                entries.append({'path': name, 'status': 'failed', 'error': result['error']})
+                continue
+
+            owner, batch = targets[name]
+            detector = self.detector(owner, action)
+            duplicate_id, _ = detector.check_hash(result['phash']) if detector else (None, None)
+            chunk_match = None
+            if detector and duplicate_id is None and result['phash'] is not None:
+                matches = chunk_tree.find(result['phash'], detector.max_distance)
+                chunk_match = matches[0][1] if matches else None
+            exact_copy = result['sha256'] in self.seen_content
+            near_copy = duplicate_id is not None or chunk_match is not None
+            if exact_copy or (near_copy and action == 'skip'):
+                self.counts['duplicates'] += 1
+                entries.append({'path': name, 'status': 'duplicate', 'duplicate_of': duplicate_id})
+                continue
+            self.seen_content.add(result['sha256'])
+
+            data = result['data']
+            base_name = os.path.basename(name)
+            media = Media(
+                owner=owner, batch=batch, title=base_name, file_data=data, file_size=len(data),
+                perceptual_hash=result['phash'], content_hash=result['sha256'], duplicate_of_id=duplicate_id,
+            )
+            media.file.name = default_storage.save(f'uploaded_media/{base_name}', ContentFile(data))
+            if result['thumbnail']:
+                thumbnail_name = os.path.splitext(base_name)[0] + '.jpg'
+                media.thumbnail.name = default_storage.save(f'thumbnails/{thumbnail_name}', ContentFile(result['thumbnail']))
+            media.set_metadata(result['metadata'])
+            media.set_hash_bands()
+            media.search_document = media.build_search_document()
+            if chunk_match is not None:
+                chunk_duplicates.append((media, chunk_match))
+            if detector and result['phash'] is not None:
+                chunk_tree.add(result['phash'], media)
+            objs.append(media)
+            entries.append({'path': name, 'status': 'imported'})
+            self.bytes += len(data)
+
+        with transaction.atomic():
+            created = bulk_create_media(objs) if objs else []
+            for media, original in chunk_duplicates:
+                media.duplicate_of_id = original.pk
+            if chunk_duplicates:
+                Media.objects.bulk_update([media for media, _ in chunk_duplicates], ['duplicate_of'])
+        for media in created:
+            detector = self.detector(media.owner, action)
+            if detector:
+                detector.add(media.perceptual_hash, media)
+        self.counts['imported'] += len(created)
+
+        # Only record what is committed, so an interrupted run resumes cleanly
+        imported = iter(created)
+        for entry in entries:
+            if entry['status'] == 'imported':
+                entry['media'] = next(imported).pk
+            manifest.write(json.dumps(entry) + '\n')
+        manifest.flush()
+
+    def progress(self, processed, total, start):
+        elapsed = time.monotonic() - start
+        rate = processed / elapsed if elapsed else 0
+        remaining = (total - processed) / rate if rate else 0
+        self.stdout.write(
+            f'\r{processed}/{total} files ({processed * 100 // total}%), '
+            f'{rate:.1f} files/s, ETA {remaining:.0f}s ',
+            ending='',
+        )
+        self.stdout.flush()
@@ -0,0 +1,17 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from api.changefeed import purge_events
+
+
+class Command(BaseCommand):
+    help = 'Delete change feed events older than CHANGE_FEED_RETENTION'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, help='Age in seconds (default: CHANGE_FEED_RETENTION)')
+
+    def handle(self, *args, **options):
+        older_than = timedelta(seconds=options['older_than']) if options['older_than'] is not None else None
+        deleted = purge_events(older_than)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} change events'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from api.throttling import purge_throttle_state
+
+
+class Command(BaseCommand):
+    help = 'Delete idle throttle buckets and concurrency slots left by crashed workers'
+
+    def handle(self, *args, **options):
+        deleted = purge_throttle_state()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} throttle records'))
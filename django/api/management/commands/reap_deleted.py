@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.reaper import REAP_CHUNK_SIZE, reap
+
+
+class Command(BaseCommand):
+    help = 'Remove soft-deleted media and batches and unlink their files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=REAP_CHUNK_SIZE)
+        parser.add_argument('--loop', action='store_true', help='Keep running, polling every --interval seconds')
+        parser.add_argument('--interval', type=int, default=30)
+
+    def handle(self, *args, **options):
+        while True:
+            media, batches = reap(chunk_size=options['chunk_size'])
+            self.stdout.write(f'Removed {media} media and {batches} batches')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
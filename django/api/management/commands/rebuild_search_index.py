@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Media, MediaBatch
+from api import search
+
+
+class Command(BaseCommand):
+    help = 'Recompute search documents for batches and media and rebuild the search index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        using = options['database']
+        search.install_search_indexes(using=using)
+
+        for model in (MediaBatch, Media):
+            queryset = model.objects.using(using)
+            if model is Media:
+                # The original bytes are not needed to rebuild the document
+                queryset = queryset.defer('file_data')
+            changed = []
+            updated = 0
+            for obj in queryset.order_by('pk').iterator(chunk_size=chunk_size):
+                document = obj.build_search_document()
+                if document != obj.search_document:
+                    obj.search_document = document
+                    changed.append(obj)
+                if len(changed) >= chunk_size:
+                    updated += model.objects.using(using).bulk_update(changed, ['search_document'])
+                    changed = []
+            if changed:
+                updated += model.objects.using(using).bulk_update(changed, ['search_document'])
+
+            search.rebuild_fts(model, using=using)
+            self.stdout.write(self.style.SUCCESS(
+                f'{model.__name__}: {updated} search documents updated'
+            ))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from api.bulk import reconcile_batch_counters
+
+
+class Command(BaseCommand):
+    help = 'Recompute media_count, total_bytes and last_media_at for every batch and repair drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        fixed = reconcile_batch_counters(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Corrected counters on {fixed} batches'))
@@ -0,0 +1,96 @@
+"""
+Immutable URLs for media files, thumbnails and profile photos.
+
+Each URL embeds the first ``VERSION_LENGTH`` hex digits of the SHA-256 of
+the content (``Media.content_hash``, ``User.profile_photo_hash``), so a
+changed file always gets a new URL and a URL never changes content. That
+lets ``serve_file`` answer with ``Cache-Control: public, max-age=31536000,
+immutable`` and a strong ETag: clients and proxies fetch each image once.
+A URL whose version no longer matches the stored file is a 404, never the
+new content. Objects without a hash yet (older rows, until
+``backfill_media`` ran) keep their plain ``MEDIA_URL`` address.
+"""
+import mimetypes
+import os
+
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotAllowed, HttpResponseNotModified
+from django.urls import reverse
+from django.utils.http import parse_etags
+
+from .models import Media, User
+
+VERSION_LENGTH = 16
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+ROUTES = {
+    'file': 'media-file',
+    'thumbnail': 'media-thumbnail',
+    'profile_photo': 'profile-photo',
+}
+
+
+def versioned_url(request, kind, pk, digest, name):
+    """Absolute (given ``request``) immutable URL of a file, or None without a hash."""
+    if not digest or not name:
+        return None
+    path = reverse(ROUTES[kind], kwargs={
+        'pk': pk, 'version': digest[:VERSION_LENGTH], 'filename': os.path.basename(name),
+    })
+    return request.build_absolute_uri(path) if request else path
+
+
+def plain_url(request, field_file):
+    return request.build_absolute_uri(field_file.url) if request else field_file.url
+
+
+def media_file_url(request, media):
+    if not media.file:
+        return None
+    return versioned_url(request, 'file', media.pk, media.content_hash, media.file.name) or plain_url(request, media.file)
+
+
+def thumbnail_url(request, media):
+    if not media.thumbnail:
+        return None
+    return versioned_url(request, 'thumbnail', media.pk, media.content_hash, media.thumbnail.name) or plain_url(request, media.thumbnail)
+
+
+def profile_photo_url(request, user):
+    if not user.profile_photo:
+        return None
+    return versioned_url(request, 'profile_photo', user.pk, user.profile_photo_hash, user.profile_photo.name) or plain_url(request, user.profile_photo)
+
+
+def serve_file(request, kind, pk, version, filename):
+    """Serve the file behind a versioned URL with immutable caching headers."""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    if kind == 'profile_photo':
+        row = User.objects.filter(pk=pk).values_list('profile_photo', 'profile_photo_hash').first()
+    else:
+        row = Media.objects.filter(pk=pk).values_list(kind, 'content_hash').first()
+    if not row or not row[0] or not row[1] or len(version) != VERSION_LENGTH or not row[1].startswith(version):
+        raise Http404('No such file version')
+    name, digest = row
+    if filename != os.path.basename(name):
+        raise Http404('No such file version')
+
+    # The thumbnail is derived from the original, so it shares its hash
+    etag = f'"{digest}-thumbnail"' if kind == 'thumbnail' else f'"{digest}"'
+    if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+    if etag in if_none_match or '*' in if_none_match:
+        response = HttpResponseNotModified()
+    else:
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        field = User._meta.get_field('profile_photo') if kind == 'profile_photo' else Media._meta.get_field(kind)
+        try:
+            response = FileResponse(field.storage.open(name, 'rb'), content_type=content_type)
+        except OSError:
+            # The original also lives in the database
+            data = Media.objects.filter(pk=pk).values_list('file_data', flat=True).first() if kind == 'file' else None
+            if not data:
+                raise Http404('File is missing')
+            response = HttpResponse(bytes(data), content_type=content_type)
+    response['ETag'] = etag
+    response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
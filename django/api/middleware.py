@@ -0,0 +1,175 @@
+import gzip
+import hashlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import patch_vary_headers
+from django.utils.regex_helper import _lazy_re_compile
+
+from . import db_routers
+from .caching import is_shared_cache
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; fall back to gzip only
+    brotli = None
+
+re_accepts_gzip = _lazy_re_compile(r'\bgzip\b')
+re_accepts_brotli = _lazy_re_compile(r'\bbr\b')
+
+# Content that is already compressed gains nothing from another pass
+DEFAULT_UNCOMPRESSIBLE_TYPES = (
+    'image/', 'video/', 'audio/', 'application/pdf', 'application/zip',
+    'application/gzip', 'application/octet-stream',
+)
+
+
+class AsyncCapableMiddleware:
+    """
+    Base for middleware that works on both entry points, so async views under
+    ASGI are not pushed back onto a thread. Subclasses implement
+    ``process(request, response)`` and, to wrap the view call, ``before``
+    returning state that ``after`` receives once the view returned.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        state = self.before(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            self.after(state)
+        return self.process(request, response)
+
+    async def __acall__(self, request):
+        state = self.before(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            self.after(state)
+        return self.process(request, response)
+
+    def before(self, request):
+        return None
+
+    def after(self, state):
+        pass
+
+    def process(self, request, response):
+        return response
+
+
+class CompressionMiddleware(AsyncCapableMiddleware):
+    """
+    Compress API responses with brotli or gzip when the client accepts it.
+    Responses smaller than ``COMPRESSION_MIN_SIZE`` bytes, streaming responses
+    (file downloads) and already compressed media types are left alone.
+    """
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.min_size = getattr(settings, 'COMPRESSION_MIN_SIZE', 1024)
+        self.uncompressible_types = tuple(
+            getattr(settings, 'COMPRESSION_UNCOMPRESSIBLE_TYPES', DEFAULT_UNCOMPRESSIBLE_TYPES)
+        )
+        self.gzip_level = getattr(settings, 'COMPRESSION_GZIP_LEVEL', 6)
+        self.brotli_quality = getattr(settings, 'COMPRESSION_BROTLI_QUALITY', 5)
+
+    def process(self, request, response):
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+        if len(response.content) < self.min_size:
+            return response
+        content_type = response.get('Content-Type', '')
+        if content_type.startswith(self.uncompressible_types):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+        if brotli is not None and re_accepts_brotli.search(accept_encoding):
+            encoding = 'br'
+            compressed = brotli.compress(response.content, quality=self.brotli_quality)
+        elif re_accepts_gzip.search(accept_encoding):
+            encoding = 'gzip'
+            compressed = gzip.compress(response.content, compresslevel=self.gzip_level, mtime=0)
+        else:
+            return response
+
+        # Return the compressed content only if it's actually shorter
+        if len(compressed) >= len(response.content):
+            return response
+
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+
+        # The representation changed, so a strong ETag no longer applies
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
+
+
+class ReadReplicaMiddleware(AsyncCapableMiddleware):
+    """
+    Let safe requests read from replicas, except for clients that wrote
+    something in the last ``REPLICA_STICKY_SECONDS`` so they always see their
+    own changes. A successful write sets a short-lived signed cookie, which
+    pins every client that keeps cookies. With a shared cache the client's
+    Authorization header or session cookie is pinned there too, for token
+    clients that drop cookies; a per-process cache would only pin it in the
+    worker that handled the write.
+    """
+    safe_methods = ('GET', 'HEAD', 'OPTIONS')
+    pin_cookie = 'replica_pin'
+    pin_salt = 'api.middleware.ReadReplicaMiddleware'
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.enabled = bool(db_routers.replica_aliases())
+        self.sticky_seconds = getattr(settings, 'REPLICA_STICKY_SECONDS', 5)
+        self.shared_cache = is_shared_cache()
+
+    def credential_key(self, request):
+        credential = request.META.get('HTTP_AUTHORIZATION') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        if not credential or not self.shared_cache:
+            return None
+        return 'replica-pin:' + hashlib.sha256(credential.encode()).hexdigest()
+
+    def pinned(self, request):
+        if request.get_signed_cookie(self.pin_cookie, None, salt=self.pin_salt, max_age=self.sticky_seconds):
+            return True
+        key = request._replica_pin_key
+        return key is not None and bool(cache.get(key))
+
+    def before(self, request):
+        if not self.enabled:
+            return None
+        request._replica_pin_key = self.credential_key(request)
+        safe = request.method in self.safe_methods
+        return db_routers.read_from_replica(safe and not self.pinned(request))
+
+    def after(self, token):
+        if token is not None:
+            db_routers.reset(token)
+
+    def process(self, request, response):
+        if not self.enabled or request.method in self.safe_methods or response.status_code >= 400:
+            return response
+        response.set_signed_cookie(
+            self.pin_cookie, '1', salt=self.pin_salt, max_age=self.sticky_seconds,
+            secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax',
+        )
+        if request._replica_pin_key is not None:
+            cache.set(request._replica_pin_key, True, self.sticky_seconds)
+        return response
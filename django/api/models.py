@@ -1,11 +1,22 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+import hashlib
+import os
 import random
 import string
 
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 
+from django.core.files.base import ContentFile
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Greatest, Now, Upper
+from django.utils import timezone
+
+from .imaging import dhash, hash_bands, make_thumbnail, read_metadata
+
 class User(AbstractUser):
     ROLE_CHOICES = [
         ('admin', 'Admin'),
@@ -18,8 +29,20 @@ class User(AbstractUser):
     full_name = models.CharField(max_length=100, blank=True, null=True)
     phone_number = models.CharField(max_length=15, blank=True, null=True)
     profile_photo = models.ImageField(upload_to='profile_photos/', blank=True, null=True)
+    # SHA-256 of the photo; versions its immutable URL (see api/media_urls.py)
+    profile_photo_hash = models.CharField(max_length=64, blank=True, default='', editable=False)
     employee_id = models.CharField(max_length=20, unique=True, blank=True, null=True)  # New field
 
+    class Meta:
+        # Case-insensitive admin search compares UPPER(column); see UserAdmin
+        indexes = [
+            models.Index(Upper('username'), name='user_username_upper'),
+            models.Index(Upper('email'), name='user_email_upper'),
+            models.Index(Upper('employee_id'), name='user_employee_id_upper'),
+            models.Index(Upper('full_name'), name='user_full_name_upper'),
+            models.Index(Upper('phone_number'), name='user_phone_number_upper'),
+        ]
+
     @property
     def is_admin(self):
         return self.role == 'admin'
@@ -40,18 +63,53 @@ class User(AbstractUser):
                 last_id = 0
             self.employee_id = f'EP-ID-{last_id + 1:04d}'
 
+        # Hash a newly assigned photo before it is stored
+        if not self.profile_photo:
+            self.profile_photo_hash = ''
+        elif not self.profile_photo._committed or (not self.profile_photo_hash and kwargs.get('update_fields') is None):
+            try:
+                self.profile_photo_hash = file_hash(self.profile_photo)
+            except OSError:
+                self.profile_photo_hash = ''
+
         super().save(*args, **kwargs)
 
+def file_hash(file):
+    """SHA-256 hex digest of an uploaded or stored file, read in chunks."""
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+class LiveManager(models.Manager):
+    """Default manager that hides soft-deleted rows until the reaper removes them."""
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
 class MediaBatch(models.Model):
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='media_batches')
     referral_id = models.CharField(max_length=15, unique=True, editable=False)
     title = models.CharField(max_length=255)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Denormalized text used by the search index (see api/search.py)
+    search_document = models.TextField(editable=False, blank=True, default='')
+    # Counters kept in step with Media inserts, deletes and moves; see
+    # adjust_counters() and the reconcile_batch_counters command
+    media_count = models.PositiveIntegerField(default=0, editable=False)
+    total_bytes = models.BigIntegerField(default=0, editable=False)
+    last_media_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # Set by soft deletes; api/reaper.py removes the row and its files later
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False, db_index=True)
+
+    objects = LiveManager()
+    all_objects = models.Manager()
     
     def save(self, *args, **kwargs):
         if not self.referral_id:
             # Generate a unique referral ID in format REF-ID-000001
-            last_batch = MediaBatch.objects.order_by('-id').first()
+            last_batch = MediaBatch.all_objects.order_by('-id').first()
             if last_batch and last_batch.referral_id and last_batch.referral_id.startswith('REF-ID-'):
                 try:
                     last_number = int(last_batch.referral_id[7:])
@@ -62,7 +120,27 @@ class MediaBatch(models.Model):
                 new_number = 1
             
             self.referral_id = f'REF-ID-{new_number:06d}'
+        self.search_document = self.build_search_document()
         super().save(*args, **kwargs)
+
+    def build_search_document(self):
+        return ' '.join(filter(None, [self.referral_id, self.title]))
+
+    @classmethod
+    def adjust_counters(cls, batch_id, count, size, media_at=None, using=None):
+        """
+        Atomically add ``count`` files and ``size`` bytes to a batch's
+        counters. Callers run this in the same transaction as the Media change.
+        """
+        if batch_id is None or (not count and not size and media_at is None):
+            return
+        updates = {
+            'media_count': F('media_count') + count,
+            'total_bytes': F('total_bytes') + size,
+        }
+        if media_at is not None:
+            updates['last_media_at'] = Greatest(Coalesce('last_media_at', Value(media_at)), Value(media_at))
+        cls.all_objects.using(using).filter(pk=batch_id).update(**updates)
     
     def __str__(self):
         return f"{self.title} ({self.referral_id})"
@@ -72,16 +150,238 @@ class Media(models.Model):
     batch = models.ForeignKey(MediaBatch, on_delete=models.CASCADE, related_name='media_files', null=True, blank=True)
     file = models.FileField(upload_to='uploaded_media/')
     file_data = models.BinaryField(editable=False, blank=True, null=True)
+    file_size = models.BigIntegerField(default=0, editable=False)
+    thumbnail = models.ImageField(upload_to='thumbnails/', editable=False, blank=True, null=True)
     title = models.CharField(max_length=255, blank=True, null=True)
-    uploaded_at = models.DateTimeField(auto_now_add=True)
+    uploaded_at = models.DateTimeField(auto_now_add=True, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Denormalized text used by the search index (see api/search.py)
+    search_document = models.TextField(editable=False, blank=True, default='')
+    # SHA-256 of the original; versions the immutable file URLs (see api/media_urls.py)
+    content_hash = models.CharField(max_length=64, blank=True, default='', editable=False)
+    # 64-bit difference hash and its 16-bit bands for near-duplicate lookups (see api/dedup.py)
+    perceptual_hash = models.BigIntegerField(null=True, blank=True, editable=False)
+    phash_band_0 = models.IntegerField(null=True, blank=True, editable=False, db_index=True)
+    phash_band_1 = models.IntegerField(null=True, blank=True, editable=False, db_index=True)
+    phash_band_2 = models.IntegerField(null=True, blank=True, editable=False, db_index=True)
+    phash_band_3 = models.IntegerField(null=True, blank=True, editable=False, db_index=True)
+    duplicate_of = models.ForeignKey('self', on_delete=models.SET_NULL, related_name='near_duplicates', null=True, blank=True)
+    # Read from the image header at ingest (see imaging.read_metadata); width and height are upright
+    captured_at = models.DateTimeField(null=True, blank=True, editable=False, db_index=True)
+    width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    orientation = models.PositiveSmallIntegerField(null=True, blank=True, editable=False)
+    camera = models.CharField(max_length=255, blank=True, default='', editable=False, db_index=True)
+    latitude = models.FloatField(null=True, blank=True, editable=False)
+    longitude = models.FloatField(null=True, blank=True, editable=False)
+    # Set by soft deletes; api/reaper.py removes the row and its files later
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False, db_index=True)
+
+    objects = LiveManager()
+    all_objects = models.Manager()
+
+    class Meta:
+        # The orphan file GC looks files up by name
+        indexes = [
+            models.Index(fields=['file']),
+            models.Index(fields=['thumbnail']),
+            # Gallery filters and orderings (see api/filters.py)
+            models.Index(fields=['owner', 'captured_at']),
+            models.Index(fields=['width', 'height']),
+            models.Index(fields=['height']),
+            models.Index(fields=['file_size']),
+            models.Index(fields=['title']),
+            models.Index(fields=['latitude', 'longitude']),
+        ]
+
+    moved_from_batch_id = None
 
     def save(self, *args, **kwargs):
+        self.moved_from_batch_id = None
+        # A newly assigned file on an existing row replaces everything derived from the old one
+        replaced = not self._state.adding and self.file and not self.file._committed
+        if replaced:
+            self.reset_file_data()
         # Save binary content of the file to file_data
         if self.file and not self.file_data:
             self.file.seek(0)
             self.file_data = self.file.read()
-        super().save(*args, **kwargs)
+        if (self._state.adding or replaced) and self.file_data:
+            self.process_file_data(bytes(self.file_data))
+        self.set_hash_bands()
+        self.search_document = self.build_search_document()
+
+        using = kwargs.get('using') or 'default'
+        with transaction.atomic(using=using):
+            if self._state.adding:
+                super().save(*args, **kwargs)
+                MediaBatch.adjust_counters(self.batch_id, 1, self.file_size, self.uploaded_at, using=using)
+                return
+
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and not {'batch', 'batch_id', 'file_size'} & set(update_fields):
+                super().save(*args, **kwargs)
+                return
+
+            # Moving to another batch (or a size change) shifts the counters
+            previous = Media.all_objects.using(using).select_for_update().filter(pk=self.pk).values('batch_id', 'file_size').first()
+            # The batch left behind, for the post_save handlers in api/signals.py
+            self.moved_from_batch_id = previous['batch_id'] if previous and previous['batch_id'] != self.batch_id else None
+            super().save(*args, **kwargs)
+            if previous and (previous['batch_id'] != self.batch_id or previous['file_size'] != self.file_size):
+                MediaBatch.adjust_counters(previous['batch_id'], -1, -previous['file_size'], using=using)
+                MediaBatch.adjust_counters(self.batch_id, 1, self.file_size, self.uploaded_at, using=using)
+
+    def process_file_data(self, data):
+        """
+        Derive the size, image metadata, perceptual hash and thumbnail from the
+        original bytes. Runs at ingest and when the file is replaced;
+        ``backfill_media`` covers older rows.
+        """
+        self.file_size = len(data)
+        if not self.content_hash:
+            self.content_hash = hashlib.sha256(data).hexdigest()
+        if self.width is None:
+            self.set_metadata(read_metadata(data))
+        if self.perceptual_hash is None:
+            self.perceptual_hash = dhash(data)
+        if not self.thumbnail:
+            thumbnail = make_thumbnail(data)
+            if thumbnail:
+                name = os.path.splitext(os.path.basename(self.file.name))[0] + '.jpg'
+                self.thumbnail.save(name, ContentFile(thumbnail), save=False)
+
+    def reset_file_data(self):
+        """Forget the stored bytes and everything derived from them."""
+        self.file_data = None
+        self.content_hash = ''
+        self.perceptual_hash = None
+        self.thumbnail = None
+        for field in self.METADATA_FIELDS:
+            setattr(self, field, self._meta.get_field(field).get_default())
+
+    METADATA_FIELDS = ['captured_at', 'width', 'height', 'orientation', 'camera', 'latitude', 'longitude']
+
+    def set_metadata(self, metadata):
+        for field in self.METADATA_FIELDS:
+            if field in metadata:
+                setattr(self, field, metadata[field])
+
+    def set_hash_bands(self):
+        bands = hash_bands(self.perceptual_hash) if self.perceptual_hash is not None else [None] * 4
+        self.phash_band_0, self.phash_band_1, self.phash_band_2, self.phash_band_3 = bands
+
+    def build_search_document(self):
+        file_name = os.path.basename(self.file.name) if self.file else ''
+        return ' '.join(filter(None, [self.title, file_name]))
 
     def __str__(self):
         return self.title if self.title else self.file.name
+
+class IdempotencyKey(models.Model):
+    """
+    A request made with an ``Idempotency-Key`` header and, once it finished,
+    its response. See api/idempotency.py.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=255)
+    # Hash of the method, path and form fields; a reused key must match it
+    fingerprint = models.CharField(max_length=64)
+    # Both stay null while the original request is still running
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_idempotency_key_per_user'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}:{self.key}"
+
+class ChangeEvent(models.Model):
+    """
+    One change to a Media or MediaBatch, for the change feed (see
+    api/changefeed.py). The id is the feed cursor.
+    """
+    KIND_CHOICES = (
+        ('media', 'Media'),
+        ('batch', 'Batch'),
+    )
+    ACTION_CHOICES = (
+        ('created', 'Created'),
+        ('updated', 'Updated'),
+        ('deleted', 'Deleted'),
+    )
+
+    # Whose feed the event belongs to; staff roles see every owner. Not a real
+    # foreign key so events of a user being deleted can still be written.
+    owner = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    object_id = models.BigIntegerField()
+    batch_id = models.BigIntegerField(null=True, blank=True)
+    # Database time, so readers can tell settled events apart (see changefeed.fetch_events)
+    created_at = models.DateTimeField(db_default=Now(), db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'id']),
+        ]
+
+    def __str__(self):
+        return f"{self.id}: {self.kind} {self.object_id} {self.action}"
+
+class ThrottleBucket(models.Model):
+    """
+    Token bucket of one throttle scope and client, shared by every worker.
+    Only changed with single conditional UPDATEs; see api/throttling.py.
+    """
+    key = models.CharField(max_length=255, unique=True)
+    tokens = models.FloatField()
+    # Unix time of the last refill
+    updated = models.FloatField(db_index=True)
+
+    def __str__(self):
+        return f"{self.key}: {self.tokens:.1f}"
+
+class ConcurrencySlot(models.Model):
+    """
+    A running request holding a ``CONCURRENCY_LIMITS`` slot. Slots of a
+    crashed worker stop counting after ``CONCURRENCY_SLOT_TIMEOUT``.
+    """
+    key = models.CharField(max_length=255)
+    acquired_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['key', 'acquired_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.key} since {self.acquired_at}"
+
+class RequestProfile(models.Model):
+    """
+    A request a staff user asked to have profiled, with its pstats dump,
+    collapsed stacks and SQL/serializer report. See api/profiling.py.
+    """
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=2000)
+    status_code = models.PositiveSmallIntegerField()
+    duration_ms = models.FloatField()
+    query_count = models.PositiveIntegerField(default=0)
+    query_ms = models.FloatField(default=0)
+    # marshal-ed pstats data, as written by pstats.Stats.dump_stats
+    stats = models.BinaryField()
+    # One "frame;frame;frame count" line per sampled stack, for flamegraph tools
+    stacks = models.TextField(blank=True, default='')
+    # {"queries": [...], "serializer_fields": [...]}
+    report = models.JSONField(default=dict)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration_ms:.0f}ms)"
@@ -33,4 +33,14 @@ class IsOwnerOrStaff(permissions.BasePermission):
         # Check if the object has an owner field and if the user is the owner
         return hasattr(obj, 'owner') and obj.owner == request.user
         
-        return False
\ No newline at end of file
+        return False
+
+    @staticmethod
+    def scope_queryset(request, queryset):
+        """
+        The objects in ``queryset`` that ``request.user`` may edit, so bulk
+        operations can check every object with one query.
+        """
+        if request.user.role in ['admin', 'editor']:
+            return queryset
+        return queryset.filter(owner=request.user)
\ No newline at end of file
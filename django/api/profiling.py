@@ -0,0 +1,373 @@
+"""
+On-demand profiling of single requests for staff users.
+
+A request with an ``X-Profile: 1`` header or a ``?profile=1`` query flag,
+made by an active staff user, runs under ``cProfile`` while a sampler thread
+records its stacks every ``PROFILING_SAMPLE_INTERVAL`` seconds. Every SQL
+statement is timed through ``connection.execute_wrapper`` and every field
+rendered by a DRF ``Serializer`` is timed too. The result is stored as a
+``RequestProfile`` (pstats dump, collapsed stacks for flamegraph tools, a
+JSON report) and listed in the admin; the response carries its id in
+``X-Profile-Id`` and the totals in ``Server-Timing``.
+
+Requests without the flag only pay for the header and query string check,
+and ``PROFILING_ENABLED = False`` removes the middleware altogether. The
+serializer instrumentation is only installed while a profile is running.
+
+One request per process is profiled at a time: ``cProfile`` allows a single
+active profiler per interpreter from Python 3.12, so a flagged request that
+arrives while another is being profiled gets a 409 instead. Under ASGI the
+event loop thread and the request's sync thread are profiled (on 3.12+ the
+one profiler sees both). Other requests' coroutines running on the same loop meanwhile
+show up in the profile too; the SQL and serializer timings are this
+request's only. Work handed to another pool (the async views' CPU
+executor) and streaming response bodies, produced after the profile ends,
+are not included.
+"""
+import cProfile
+import contextvars
+import io
+import logging
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import JsonResponse
+from rest_framework import serializers
+from rest_framework.exceptions import APIException
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from .filters import TRUE_VALUES
+from .middleware import AsyncCapableMiddleware
+from .models import RequestProfile
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'HTTP_X_PROFILE'
+QUERY_PARAM = 'profile'
+
+# The profile collecting serializer field timings in this context
+active_session = contextvars.ContextVar('active_profile_session', default=None)
+
+_original_to_representation = serializers.Serializer.to_representation
+_instrument_lock = threading.Lock()
+_instrumented = 0
+
+# Held while a request of this process is being profiled
+_profile_lock = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def profile_requested(request):
+    """True when the request asks to be profiled. Cheap enough for every request."""
+    if request.META.get(HEADER, '').lower() in TRUE_VALUES:
+        return True
+    return (f'{QUERY_PARAM}=' in request.META.get('QUERY_STRING', '')
+            and request.GET.get(QUERY_PARAM, '').lower() in TRUE_VALUES)
+
+
+def profiling_user(request):
+    """
+    The active staff user behind ``request``, or None. Token clients are
+    authenticated here already, since DRF only does so inside the view.
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        drf_request = Request(request, authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+        try:
+            user = drf_request.user
+        except APIException:
+            return None
+    return user if user.is_active and user.is_staff else None
+
+
+def timed_to_representation(self, instance):
+    """``Serializer.to_representation`` that times each field while a profile runs."""
+    session = active_session.get()
+    if session is None:
+        return _original_to_representation(self, instance)
+    ret = {}
+    prefix = type(self).__name__
+    for field in self._readable_fields:
+        start = time.perf_counter()
+        try:
+            attribute = field.get_attribute(instance)
+        except SkipField:
+            continue
+        check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+        ret[field.field_name] = None if check_for_none is None else field.to_representation(attribute)
+        # Inclusive: a nested serializer's fields are counted in its parent field too
+        session.record_field(f'{prefix}.{field.field_name}', time.perf_counter() - start)
+    return ret
+
+
+def instrument_serializers(enable):
+    """Install the timed ``to_representation`` while at least one profile runs."""
+    global _instrumented
+    with _instrument_lock:
+        _instrumented += 1 if enable else -1
+        serializers.Serializer.to_representation = (
+            timed_to_representation if _instrumented else _original_to_representation
+        )
+
+
+def _frame_label(code):
+    filename = code.co_filename
+    if 'site-packages' + os.sep in filename:
+        filename = filename.split('site-packages' + os.sep, 1)[1]
+    elif filename.startswith(str(settings.BASE_DIR)):
+        filename = os.path.relpath(filename, settings.BASE_DIR)
+    return f'{code.co_name} ({filename}:{code.co_firstlineno})'
+
+
+class StackSampler(threading.Thread):
+    """Counts the stacks of the registered threads every ``interval`` seconds."""
+
+    def __init__(self, interval):
+        super().__init__(name='request-profiler', daemon=True)
+        self.interval = interval
+        self.idents = set()
+        self.counts = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for ident in tuple(self.idents):
+                frame = frames.get(ident)
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                if labels:
+                    stack = ';'.join(reversed(labels))
+                    self.counts[stack] = self.counts.get(stack, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(self.counts.items()))
+
+
+class ProfileSession:
+    """
+    Everything recorded for one profiled request. ``begin``/``end`` run once,
+    in the thread or coroutine that handles the request; ``attach``/``detach``
+    run in every thread that executes its code.
+    """
+
+    def __init__(self):
+        self.threads = {}
+        self.profiles = []
+        self.token = None
+        self.instrumented = False
+        self.started = None
+        self.duration = 0.0
+        self.queries = []
+        self.query_count = 0
+        self.query_time = 0.0
+        self.fields = {}
+        self.max_queries = _setting('PROFILING_MAX_QUERIES', 1000)
+        self.sampler = StackSampler(_setting('PROFILING_SAMPLE_INTERVAL', 0.005))
+
+    def begin(self):
+        self.token = active_session.set(self)
+        instrument_serializers(True)
+        self.instrumented = True
+        self.sampler.start()
+        self.started = time.perf_counter()
+
+    def end(self):
+        """Undo whatever ``begin`` got done, even if it failed halfway."""
+        if self.started is not None:
+            self.duration = time.perf_counter() - self.started
+        if self.sampler.ident is not None:
+            self.sampler.stop()
+        if self.instrumented:
+            self.instrumented = False
+            instrument_serializers(False)
+        if self.token is not None:
+            active_session.reset(self.token)
+            self.token = None
+
+    def attach(self):
+        ident = threading.get_ident()
+        stack = ExitStack()
+        self.threads[ident] = (None, stack)
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(self.record_query))
+        self.sampler.idents.add(ident)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+: the profile enabled in another thread covers this one
+            return
+        self.threads[ident] = (profile, stack)
+        self.profiles.append(profile)
+
+    def detach(self):
+        """Undo whatever ``attach`` got done in this thread, if anything."""
+        ident = threading.get_ident()
+        profile, stack = self.threads.pop(ident, (None, None))
+        if profile is not None:
+            profile.disable()
+        self.sampler.idents.discard(ident)
+        if stack is not None:
+            stack.close()
+
+    def record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.query_count += 1
+            self.query_time += duration
+            # Parameters are left out: they may hold credentials or personal data
+            if len(self.queries) < self.max_queries:
+                self.queries.append({
+                    'alias': context['connection'].alias,
+                    'sql': sql,
+                    'many': many,
+                    'duration_ms': round(duration * 1000, 3),
+                })
+
+    def record_field(self, name, duration):
+        calls, total = self.fields.get(name, (0, 0.0))
+        self.fields[name] = (calls + 1, total + duration)
+
+    def stats(self):
+        """The merged pstats of every attached thread, or None."""
+        merged = None
+        for profile in self.profiles:
+            try:
+                merged = pstats.Stats(profile) if merged is None else merged.add(profile)
+            except TypeError:
+                # Nothing ran while this thread was profiled
+                continue
+        return merged
+
+    def save(self, request, response):
+        """Store the profile and point the response at it. Returns the response."""
+        stats = self.stats()
+        summary = io.StringIO()
+        if stats is not None:
+            stats.stream = summary
+            stats.sort_stats('cumulative').print_stats(40)
+        report = {
+            'queries': self.queries,
+            'queries_truncated': self.query_count > len(self.queries),
+            'serializer_fields': [
+                {'field': name, 'calls': calls, 'total_ms': round(total * 1000, 3)}
+                for name, (calls, total) in sorted(self.fields.items(), key=lambda item: item[1][1], reverse=True)
+            ],
+            'functions': summary.getvalue(),
+        }
+        try:
+            profile = RequestProfile.objects.create(
+                user=request.user if getattr(request, 'user', None) and request.user.is_authenticated else None,
+                method=request.method,
+                path=request.get_full_path()[:2000],
+                status_code=response.status_code,
+                duration_ms=self.duration * 1000,
+                query_count=self.query_count,
+                query_ms=self.query_time * 1000,
+                stats=marshal.dumps(stats.stats) if stats is not None else b'',
+                stacks=self.sampler.collapsed(),
+                report=report,
+            )
+            trim_profiles()
+        except Exception as e:
+            logger.error(f"Could not store request profile: {str(e)}")
+            return response
+
+        response['X-Profile-Id'] = str(profile.pk)
+        response['Server-Timing'] = (
+            f'db;dur={self.query_time * 1000:.1f};desc="{self.query_count} queries", '
+            f'total;dur={self.duration * 1000:.1f}'
+        )
+        return response
+
+
+def trim_profiles():
+    """Keep only the newest ``PROFILING_KEEP`` profiles."""
+    keep = _setting('PROFILING_KEEP', 200)
+    oldest_kept = RequestProfile.objects.order_by('-id').values_list('id', flat=True)[keep - 1:keep].first()
+    if oldest_kept is not None:
+        RequestProfile.objects.filter(id__lt=oldest_kept).delete()
+
+
+def profile_busy():
+    return JsonResponse(
+        {'detail': 'Another request is being profiled in this process. Try again shortly.'},
+        status=409,
+    )
+
+
+class ProfilingMiddleware(AsyncCapableMiddleware):
+    """Profile the requests staff users flag with ``X-Profile`` or ``?profile=1``."""
+
+    def __init__(self, get_response):
+        if not _setting('PROFILING_ENABLED', True):
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not profile_requested(request) or profiling_user(request) is None:
+            return self.get_response(request)
+
+        if not _profile_lock.acquire(blocking=False):
+            return profile_busy()
+        session = ProfileSession()
+        try:
+            try:
+                session.begin()
+                session.attach()
+                response = self.get_response(request)
+            finally:
+                session.detach()
+                session.end()
+        finally:
+            _profile_lock.release()
+        return session.save(request, response)
+
+    async def __acall__(self, request):
+        if not profile_requested(request) or await sync_to_async(profiling_user)(request) is None:
+            return await self.get_response(request)
+
+        if not _profile_lock.acquire(blocking=False):
+            return profile_busy()
+        session = ProfileSession()
+        try:
+            try:
+                session.begin()
+                # Sync views and the ORM run in this request's thread-sensitive thread
+                await sync_to_async(session.attach)()
+                session.attach()
+                response = await self.get_response(request)
+            finally:
+                session.detach()
+                await sync_to_async(session.detach)()
+                session.end()
+        finally:
+            _profile_lock.release()
+        return await sync_to_async(session.save)(request, response)
@@ -0,0 +1,70 @@
+"""
+Background removal of soft-deleted media and batches.
+
+``reap()`` hard-deletes soft-deleted rows in short chunked transactions; the
+``remove_media_files`` signal unlinks each file once its chunk commits. It
+runs from the ``reap_deleted`` management command (cron or ``--loop``) and,
+unless ``MEDIA_REAPER_IN_PROCESS`` is False, in a daemon thread kicked off
+after every soft delete.
+"""
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from .models import Media, MediaBatch
+
+logger = logging.getLogger(__name__)
+
+REAP_CHUNK_SIZE = 500
+
+_running = threading.Lock()
+
+
+def _reap_model(model, chunk_size, max_chunks):
+    removed = chunks = 0
+    while max_chunks is None or chunks < max_chunks:
+        with transaction.atomic():
+            pks = list(
+                model.all_objects.filter(deleted_at__isnull=False)
+                .select_for_update(skip_locked=True)
+                .order_by('pk').values_list('pk', flat=True)[:chunk_size]
+            )
+            if not pks:
+                break
+            model.all_objects.filter(pk__in=pks).delete()
+        removed += len(pks)
+        chunks += 1
+    return removed
+
+
+def reap(chunk_size=REAP_CHUNK_SIZE, max_chunks=None):
+    """
+    Remove soft-deleted media, then soft-deleted batches. Returns
+    ``(media_removed, batches_removed)``.
+    """
+    media = _reap_model(Media, chunk_size, max_chunks)
+    batches = _reap_model(MediaBatch, chunk_size, max_chunks)
+    if media or batches:
+        logger.info(f"Reaped {media} media and {batches} batches")
+    return media, batches
+
+
+def reap_in_background():
+    """Start one reaper pass in a daemon thread unless one is already running."""
+    if not getattr(settings, 'MEDIA_REAPER_IN_PROCESS', True):
+        return
+    if not _running.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            reap()
+        except Exception:
+            logger.exception('Media reaper failed')
+        finally:
+            connections.close_all()
+            _running.release()
+
+    threading.Thread(target=run, name='media-reaper', daemon=True).start()
@@ -0,0 +1,211 @@
+"""
+Full-text and prefix search over media batches and media.
+
+Every searchable model keeps a denormalized ``search_document`` column that is
+rebuilt on save. On PostgreSQL that column is covered by a GIN ``tsvector``
+expression index and a trigram index, so the index follows the row without any
+extra bookkeeping. On SQLite the documents are mirrored into FTS5 tables by the
+signal handlers in ``api/signals.py``. Other backends fall back to ``icontains``.
+"""
+import logging
+import re
+
+from django.db import DatabaseError, connections
+from django.db.models import BooleanField, FloatField
+from django.db.models.expressions import RawSQL
+
+from .models import Media, MediaBatch
+
+logger = logging.getLogger(__name__)
+
+SEARCHABLE_MODELS = (MediaBatch, Media)
+
+# Reference codes are matched by prefix on their own indexed columns
+CODE_PATTERN = re.compile(r'^(REF|EP)-ID-[0-9]*$', re.IGNORECASE)
+CODE_FIELDS = {
+    MediaBatch: {'REF': 'referral_id', 'EP': 'owner__employee_id'},
+    Media: {'REF': 'batch__referral_id', 'EP': 'owner__employee_id'},
+}
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# Trigram indexes only help for substrings of at least three characters
+MIN_TRIGRAM_LENGTH = 3
+
+# SQLite aliases whose FTS5 tables are known to exist
+_fts_ready = set()
+
+
+def fts_table(model):
+    return f'{model._meta.db_table}_fts'
+
+
+def tsvector_sql(model):
+    # Must stay identical to the indexed expression created below
+    return f"to_tsvector('simple', {model._meta.db_table}.search_document)"
+
+
+def install_search_indexes(using='default'):
+    """
+    Create the backend specific search structures. Safe to run repeatedly;
+    called after every ``migrate``.
+    """
+    connection = connections[using]
+    statements = []
+    if connection.vendor == 'postgresql':
+        statements.append('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for model in SEARCHABLE_MODELS:
+            table = model._meta.db_table
+            statements += [
+                f"CREATE INDEX IF NOT EXISTS {table}_search_tsv "
+                f"ON {table} USING gin (to_tsvector('simple', search_document))",
+                f"CREATE INDEX IF NOT EXISTS {table}_search_trgm "
+                f"ON {table} USING gin (search_document gin_trgm_ops)",
+            ]
+    elif connection.vendor == 'sqlite':
+        for model in SEARCHABLE_MODELS:
+            table, fts = model._meta.db_table, fts_table(model)
+            statements += [
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(document, tokenize='unicode61')",
+                f"INSERT INTO {fts}(rowid, document) SELECT id, search_document FROM {table} "
+                f"WHERE id NOT IN (SELECT rowid FROM {fts})",
+            ]
+
+    failed = False
+    with connection.cursor() as cursor:
+        for statement in statements:
+            try:
+                cursor.execute(statement)
+            except DatabaseError as e:
+                failed = True
+                logger.warning(f"Could not create search index ({statement}): {str(e)}")
+    if connection.vendor == 'sqlite' and not failed:
+        _fts_ready.add(using)
+
+
+def _sqlite_fts_available(using):
+    if using in _fts_ready:
+        return True
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN (%s, %s)",
+            [fts_table(model) for model in SEARCHABLE_MODELS]
+        )
+        if cursor.fetchone()[0] == len(SEARCHABLE_MODELS):
+            _fts_ready.add(using)
+            return True
+    return False
+
+
+def index_object(instance, using='default'):
+    """
+    Bring the SQLite FTS5 row for ``instance`` up to date. PostgreSQL indexes
+    the column directly, so there is nothing to do there.
+    """
+    if connections[using].vendor != 'sqlite' or not _sqlite_fts_available(using):
+        return
+    table = fts_table(type(instance))
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE rowid = %s', [instance.pk])
+        cursor.execute(
+            f'INSERT INTO {table}(rowid, document) VALUES (%s, %s)',
+            [instance.pk, instance.search_document]
+        )
+
+
+def unindex_object(instance, using='default'):
+    if connections[using].vendor != 'sqlite' or not _sqlite_fts_available(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {fts_table(type(instance))} WHERE rowid = %s', [instance.pk])
+
+
+def reindex_objects(model, pks, using='default'):
+    """Set-based ``index_object`` for rows changed with ``update()``."""
+    if not pks or connections[using].vendor != 'sqlite' or not _sqlite_fts_available(using):
+        return
+    table, fts = model._meta.db_table, fts_table(model)
+    placeholders = ', '.join(['%s'] * len(pks))
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {fts} WHERE rowid IN ({placeholders})', list(pks))
+        cursor.execute(
+            f'INSERT INTO {fts}(rowid, document) SELECT id, search_document FROM {table} WHERE id IN ({placeholders})',
+            list(pks)
+        )
+
+
+def rebuild_fts(model, using='default'):
+    if connections[using].vendor != 'sqlite' or not _sqlite_fts_available(using):
+        return
+    table, fts = model._meta.db_table, fts_table(model)
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {fts}')
+        cursor.execute(f'INSERT INTO {fts}(rowid, document) SELECT id, search_document FROM {table}')
+
+
+def _prefix_range(field, prefix):
+    # A range scan uses the plain b-tree index on every backend, unlike LIKE
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return {f'{field}__gte': prefix, f'{field}__lt': upper}
+
+
+def _code_search(queryset, code):
+    field = CODE_FIELDS[queryset.model][code.split('-', 1)[0]]
+    return queryset.filter(**_prefix_range(field, code)).order_by(field, '-id')
+
+
+def _postgres_search(queryset, query, tokens):
+    model = queryset.model
+    vector = tsvector_sql(model)
+    tsquery = ' & '.join(f'{token}:*' for token in tokens)
+    match_sql = f"{vector} @@ to_tsquery('simple', %s)"
+    params = [tsquery]
+    if len(query) >= MIN_TRIGRAM_LENGTH:
+        # Substring matches (e.g. "00042") are served by the trigram index
+        match_sql = f"({match_sql} OR {model._meta.db_table}.search_document ILIKE %s)"
+        params.append('%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    return queryset.filter(
+        RawSQL(match_sql, params, output_field=BooleanField())
+    ).annotate(
+        search_rank=RawSQL(f"ts_rank({vector}, to_tsquery('simple', %s))", [tsquery], output_field=FloatField())
+    ).order_by('-search_rank', '-id')
+
+
+def _sqlite_search(queryset, tokens):
+    model = queryset.model
+    table, fts = model._meta.db_table, fts_table(model)
+    match = ' '.join('"%s"*' % token.replace('"', '""') for token in tokens)
+    return queryset.filter(
+        pk__in=RawSQL(f'SELECT rowid FROM {fts} WHERE {fts} MATCH %s', [match])
+    ).annotate(
+        # bm25() is lower-is-better
+        search_rank=RawSQL(
+            f'(SELECT bm25({fts}) FROM {fts} WHERE {fts} MATCH %s AND {fts}.rowid = {table}.id)',
+            [match], output_field=FloatField()
+        )
+    ).order_by('search_rank', '-id')
+
+
+def search_queryset(queryset, query):
+    """
+    Filter ``queryset`` (of MediaBatch or Media) down to rows matching
+    ``query`` and order them by relevance. ``REF-ID-``/``EP-ID-`` codes are
+    matched by prefix; everything else goes through the full-text index.
+    """
+    query = (query or '').strip()
+    if CODE_PATTERN.match(query):
+        return _code_search(queryset, query.upper())
+
+    tokens = TOKEN_PATTERN.findall(query.lower())
+    if not tokens:
+        return queryset.none()
+
+    using = queryset.db
+    vendor = connections[using].vendor
+    if vendor == 'postgresql':
+        return _postgres_search(queryset, query, tokens)
+    if vendor == 'sqlite' and _sqlite_fts_available(using):
+        return _sqlite_search(queryset, tokens)
+
+    for token in tokens:
+        queryset = queryset.filter(search_document__icontains=token)
+    return queryset.order_by('-id')
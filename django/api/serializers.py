@@ -1,11 +1,17 @@
 from rest_framework import serializers
+from django.core.files.storage import default_storage
+from django.db.models import CharField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, NullIf
 from .models import Media, User, MediaBatch
+from .fragments import CachedListSerializer, CachedRepresentationMixin
+from .media_urls import media_file_url, profile_photo_url, thumbnail_url, versioned_url
 import logging
 
 logger = logging.getLogger(__name__)
 
-class MediaSerializer(serializers.ModelSerializer):
+class MediaSerializer(CachedRepresentationMixin, serializers.ModelSerializer):
     file_url = serializers.SerializerMethodField()
+    thumbnail_url = serializers.SerializerMethodField()
     batch_referral_id = serializers.CharField(write_only=True, required=False)
     batch_title = serializers.CharField(write_only=True, required=False)
 
@@ -15,18 +21,32 @@ class MediaSerializer(serializers.ModelSerializer):
             'id',
             'file',
             'file_url',
+            'thumbnail_url',
             'owner',
             'batch',
             'title',
             'uploaded_at',
             'batch_referral_id',
-            'batch_title'
+            'batch_title',
+            'duplicate_of',
+            'captured_at',
+            'width',
+            'height',
+            'orientation',
+            'camera',
+            'latitude',
+            'longitude',
         ]
-        read_only_fields = ['owner', 'uploaded_at']
+        read_only_fields = ['owner', 'uploaded_at', 'duplicate_of']
+        list_serializer_class = CachedListSerializer
 
     def get_file_url(self, obj):
         request = self.context.get('request')
-        return request.build_absolute_uri(obj.file.url) if obj.file and request else None
+        return media_file_url(request, obj) if request else None
+
+    def get_thumbnail_url(self, obj):
+        request = self.context.get('request')
+        return thumbnail_url(request, obj) if request else None
 
     def create(self, validated_data):
         request = self.context.get('request')
@@ -62,13 +82,14 @@ class MediaSerializer(serializers.ModelSerializer):
         media_instance.save()
         return media_instance
 
-class MediaBatchSerializer(serializers.ModelSerializer):
+class MediaBatchSerializer(CachedRepresentationMixin, serializers.ModelSerializer):
     owner = serializers.SerializerMethodField()
     images = MediaSerializer(many=True, read_only=True, source='media_files')
 
     class Meta:
         model = MediaBatch
         fields = ['id', 'referral_id', 'title', 'created_at', 'owner', 'images']
+        list_serializer_class = CachedListSerializer
 
     def get_owner(self, obj):
         return {
@@ -81,10 +102,54 @@ class MediaBatchSerializer(serializers.ModelSerializer):
         media_files = obj.media_files.all()
         return [{
             'id': media.id,
-            'url': request.build_absolute_uri(media.file.url) if media.file else None
+            'url': media_file_url(request, media)
         } for media in media_files]
 
-class UserSerializer(serializers.ModelSerializer):
+class MediaBatchSummarySerializer(CachedRepresentationMixin, serializers.ModelSerializer):
+    """
+    Fixed-size representation of a batch for listings. The images themselves
+    are paged from ``batches/<id>/media/``. Querysets must go through
+    ``setup_queryset`` first.
+    """
+    owner = serializers.SerializerMethodField()
+    cover_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = MediaBatch
+        fields = ['id', 'referral_id', 'title', 'created_at', 'owner', 'media_count', 'total_bytes', 'last_media_at', 'cover_url']
+        list_serializer_class = CachedListSerializer
+
+    @staticmethod
+    def setup_queryset(queryset):
+        # The first image's thumbnail (or the original if it has none) is the cover
+        covers = Media.objects.filter(batch=OuterRef('pk')).order_by('pk')
+        cover = covers.annotate(
+            cover=Coalesce(NullIf('thumbnail', Value('')), 'file', output_field=CharField())
+        ).values('cover')[:1]
+        return queryset.select_related('owner').annotate(
+            cover_file=Subquery(cover),
+            cover_id=Subquery(covers.values('pk')[:1]),
+            cover_hash=Subquery(covers.values('content_hash')[:1]),
+        )
+
+    def get_owner(self, obj):
+        return {
+            'username': obj.owner.username,
+            'id': obj.owner.id
+        }
+
+    def get_cover_url(self, obj):
+        if not obj.cover_file:
+            return None
+        request = self.context.get('request')
+        kind = 'thumbnail' if obj.cover_file.startswith(Media.thumbnail.field.upload_to) else 'file'
+        url = versioned_url(request, kind, obj.cover_id, obj.cover_hash, obj.cover_file)
+        if url:
+            return url
+        url = default_storage.url(obj.cover_file)
+        return request.build_absolute_uri(url) if request else url
+
+class UserSerializer(CachedRepresentationMixin, serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
     profile_photo = serializers.SerializerMethodField()
     employee_id = serializers.CharField(read_only=True)  # Add this line
@@ -102,14 +167,10 @@ class UserSerializer(serializers.ModelSerializer):
             'role',
             'password'
         ]
+        list_serializer_class = CachedListSerializer
 
     def get_profile_photo(self, obj):
-        if obj.profile_photo:
-            request = self.context.get('request')
-            if request:
-                return request.build_absolute_uri(obj.profile_photo.url)
-            return obj.profile_photo.url
-        return None
+        return profile_photo_url(self.context.get('request'), obj)
 
     def create(self, validated_data):
         user = User.objects.create_user(
@@ -0,0 +1,127 @@
+import logging
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Media, MediaBatch, User
+from . import changefeed, search
+from .fragments import bump_versions
+from .bulk import counters_suspended
+
+logger = logging.getLogger(__name__)
+
+
+# Keep the search index in step with individual saves and deletes
+@receiver(post_save, sender=MediaBatch)
+@receiver(post_save, sender=Media)
+def update_search_index(sender, instance, using, **kwargs):
+    search.index_object(instance, using=using)
+
+
+@receiver(post_delete, sender=MediaBatch)
+@receiver(post_delete, sender=Media)
+def remove_from_search_index(sender, instance, using, **kwargs):
+    search.unindex_object(instance, using=using)
+
+
+@receiver(post_delete, sender=Media)
+def decrement_batch_counters(sender, instance, using, origin=None, **kwargs):
+    # Runs inside the deletion transaction. Skipped when the batch itself is
+    # being deleted, or when api.bulk is already accounting for the rows.
+    # Soft-deleted rows were already taken off the counters.
+    if instance.deleted_at is not None or counters_suspended():
+        return
+    if isinstance(origin, MediaBatch) or getattr(origin, 'model', None) is MediaBatch:
+        return
+    MediaBatch.adjust_counters(instance.batch_id, -1, -instance.file_size, using=using)
+
+
+@receiver(post_delete, sender=Media)
+def remove_media_files(sender, instance, using, **kwargs):
+    # Unlink the original and thumbnail once the row is really gone
+    names = [f.name for f in (instance.file, instance.thumbnail) if f]
+    storage = instance.file.storage
+    if names:
+        transaction.on_commit(lambda: delete_files(storage, names), using=using)
+
+
+def delete_files(storage, names):
+    for name in names:
+        try:
+            storage.delete(name)
+        except OSError as e:
+            logger.warning(f"Could not delete {name}: {str(e)}")
+
+
+# Cached serializer output (api/fragments.py). A batch's representation
+# includes its media, cover and owner, so those changes bump it too.
+@receiver(post_save, sender=Media)
+@receiver(post_delete, sender=Media)
+def bump_media_fragments(sender, instance, using, **kwargs):
+    bump_versions(Media, [instance.pk], using=using)
+    bump_versions(MediaBatch, [instance.batch_id], using=using)
+
+
+@receiver(post_save, sender=MediaBatch)
+@receiver(post_delete, sender=MediaBatch)
+def bump_batch_fragments(sender, instance, using, **kwargs):
+    bump_versions(MediaBatch, [instance.pk], using=using)
+
+
+@receiver(post_save, sender=User)
+def bump_user_fragments(sender, instance, using, update_fields=None, **kwargs):
+    bump_versions(User, [instance.pk], using=using)
+    if update_fields is None or 'username' in update_fields:
+        # Batches show their owner's username
+        owned = MediaBatch.all_objects.using(using).filter(owner=instance).values_list('pk', flat=True)
+        bump_versions(MediaBatch, list(owned), using=using)
+
+
+@receiver(post_delete, sender=User)
+def forget_user_fragments(sender, instance, using, **kwargs):
+    bump_versions(User, [instance.pk], using=using)
+
+
+# Change feed (api/changefeed.py). Rows hidden by a soft delete were reported
+# then, and media removed with their batch are implied by the batch event.
+@receiver(post_save, sender=Media)
+def record_media_change(sender, instance, created, using, **kwargs):
+    action = 'created' if created else 'updated'
+    changefeed.record('media', action, [(instance.pk, instance.batch_id, instance.owner_id)], using=using)
+
+
+@receiver(post_save, sender=Media)
+def record_batch_left(sender, instance, using, **kwargs):
+    # The media event names the new batch; the one it left changed too
+    if instance.moved_from_batch_id is None:
+        return
+    bump_versions(MediaBatch, [instance.moved_from_batch_id], using=using)
+    owner_id = MediaBatch.all_objects.using(using).filter(pk=instance.moved_from_batch_id).values_list('owner_id', flat=True).first()
+    if owner_id is not None:
+        changefeed.record('batch', 'updated', [(instance.moved_from_batch_id, instance.moved_from_batch_id, owner_id)], using=using)
+
+
+@receiver(post_delete, sender=Media)
+def record_media_deletion(sender, instance, using, origin=None, **kwargs):
+    if instance.deleted_at is not None or counters_suspended():
+        return
+    if isinstance(origin, MediaBatch) or getattr(origin, 'model', None) is MediaBatch:
+        return
+    changefeed.record('media', 'deleted', [(instance.pk, instance.batch_id, instance.owner_id)], using=using)
+
+
+@receiver(post_save, sender=MediaBatch)
+def record_batch_change(sender, instance, created, using, **kwargs):
+    action = 'created' if created else 'updated'
+    changefeed.record('batch', action, [(instance.pk, instance.pk, instance.owner_id)], using=using)
+
+
+@receiver(post_delete, sender=MediaBatch)
+def record_batch_deletion(sender, instance, using, **kwargs):
+    if instance.deleted_at is None:
+        changefeed.record('batch', 'deleted', [(instance.pk, instance.pk, instance.owner_id)], using=using)
+
+
+def install_search_indexes(sender, using='default', **kwargs):
+    search.install_search_indexes(using=using)
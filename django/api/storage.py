@@ -0,0 +1,540 @@
+"""
+Object storage for uploads, thumbnails, profile photos and exports, so any
+number of app nodes can serve the same files.
+
+``ObjectStorage`` is a Django storage over an object store client:
+
+- ``GCSObjectStore``, a Google Cloud Storage bucket (``google-cloud-storage``)
+- ``LocalObjectStore``, a stand-in in a local directory with the same
+  semantics, for development, tests and single-node setups
+
+Objects are written once and never changed. Every saved file gets a fresh
+random suffix, so a name is never reused for other content, even after a
+delete. Files larger than ``STORAGE_PART_SIZE`` are uploaded as parts on
+``STORAGE_UPLOAD_THREADS`` threads and assembled by the store.
+
+Reads go through ``DiskLRUCache``, a size-bounded directory on each node
+shared by its worker processes. Hot originals and thumbnails are served
+from local disk after the first fetch. A cached file never goes stale,
+since names are never reused. Small files are written through to the cache
+when saved.
+
+backend/storage.py builds ``STORAGES`` from the environment.
+"""
+import hashlib
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone as dt_timezone
+from urllib.parse import quote, urljoin
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, SuspiciousFileOperation
+from django.core.files import File
+from django.core.files.storage import Storage
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+
+# Multipart uploads in progress, inside the store
+UPLOADS_PREFIX = '.uploads/'
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _walk(directory, skip=None):
+    # Streams directory entries so huge trees are never listed in memory
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.path == skip:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    yield from _walk(entry.path, skip)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat()
+                    yield entry.path, st.st_size, st.st_mtime
+    except FileNotFoundError:
+        return
+
+
+class LocalObjectStore:
+    """
+    Object store in a local directory: flat keys, whole-object writes made
+    visible atomically, and multipart uploads assembled on completion.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.uploads = os.path.join(self.root, UPLOADS_PREFIX.rstrip('/'))
+
+    def _path(self, key):
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep) or path.startswith(self.uploads + os.sep):
+            raise SuspiciousFileOperation(f'{key} is outside the object store')
+        return path
+
+    def _replace(self, path, write):
+        # Staged next to the uploads so readers never see a partial object
+        os.makedirs(self.uploads, exist_ok=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        staged = os.path.join(self.uploads, f'{uuid.uuid4().hex}.tmp')
+        try:
+            with open(staged, 'wb') as f:
+                write(f)
+            os.replace(staged, path)
+        except BaseException:
+            try:
+                os.remove(staged)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def put(self, key, data):
+        self._replace(self._path(key), lambda f: f.write(data))
+
+    def download(self, key, fileobj):
+        with open(self._path(key), 'rb') as f:
+            shutil.copyfileobj(f, fileobj, COPY_BUFFER_SIZE)
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def stat(self, key):
+        """``(size, modified)`` of ``key``, modified as a POSIX timestamp."""
+        st = os.stat(self._path(key))
+        return st.st_size, st.st_mtime
+
+    def list(self, prefix=''):
+        """Yield ``(key, size, modified)`` for every object whose key starts with ``prefix``."""
+        for path, size, modified in _walk(os.path.join(self.root, os.path.dirname(prefix)), skip=self.uploads):
+            key = os.path.relpath(path, self.root).replace(os.sep, '/')
+            if key.startswith(prefix):
+                yield key, size, modified
+
+    def start_upload(self, key):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.uploads, upload_id))
+        return upload_id
+
+    def upload_part(self, upload_id, number, data):
+        with open(os.path.join(self.uploads, upload_id, f'{number:05d}'), 'wb') as f:
+            f.write(data)
+
+    def complete_upload(self, upload_id, key, count):
+        def assemble(f):
+            for number in range(1, count + 1):
+                with open(os.path.join(self.uploads, upload_id, f'{number:05d}'), 'rb') as part:
+                    shutil.copyfileobj(part, f, COPY_BUFFER_SIZE)
+        self._replace(self._path(key), assemble)
+        self.abort_upload(upload_id)
+
+    def abort_upload(self, upload_id):
+        shutil.rmtree(os.path.join(self.uploads, upload_id), ignore_errors=True)
+
+
+class GCSObjectStore:
+    """
+    A Google Cloud Storage bucket. Multipart uploads are parallel composite
+    uploads: each part is its own object until they are composed. Missing
+    objects raise ``FileNotFoundError`` and every other API, auth or
+    transport failure ``OSError``, like the local store and the file system.
+    """
+    # Sources a single compose request accepts
+    COMPOSE_LIMIT = 32
+
+    def __init__(self, bucket, project=None):
+        try:
+            from google.api_core.exceptions import GoogleAPIError, NotFound
+            from google.auth.exceptions import GoogleAuthError
+            from google.cloud import storage
+            from requests import RequestException
+        except ImportError:
+            raise ImproperlyConfigured('STORAGE_BACKEND=gcs needs the google-cloud-storage package')
+        self.not_found = NotFound
+        self.failures = (GoogleAPIError, GoogleAuthError, RequestException)
+        self.bucket = storage.Client(project=project).bucket(bucket)
+
+    @contextmanager
+    def errors(self, key):
+        try:
+            yield
+        except self.not_found:
+            raise FileNotFoundError(key)
+        except self.failures as e:
+            raise OSError(f'{key}: {str(e)}') from e
+
+    def put(self, key, data):
+        with self.errors(key):
+            self.bucket.blob(key).upload_from_string(data, content_type=mimetypes.guess_type(key)[0])
+
+    def download(self, key, fileobj):
+        with self.errors(key):
+            self.bucket.blob(key).download_to_file(fileobj)
+
+    def exists(self, key):
+        with self.errors(key):
+            return self.bucket.blob(key).exists()
+
+    def delete(self, key):
+        try:
+            with self.errors(key):
+                self.bucket.blob(key).delete()
+        except FileNotFoundError:
+            pass
+
+    def stat(self, key):
+        with self.errors(key):
+            blob = self.bucket.get_blob(key)
+        if blob is None:
+            raise FileNotFoundError(key)
+        return blob.size, blob.updated.timestamp()
+
+    def list(self, prefix=''):
+        with self.errors(prefix):
+            for blob in self.bucket.list_blobs(prefix=prefix):
+                if not blob.name.startswith(UPLOADS_PREFIX):
+                    yield blob.name, blob.size, blob.updated.timestamp()
+
+    def _part(self, upload_id, number):
+        return self.bucket.blob(f'{UPLOADS_PREFIX}{upload_id}/{number:05d}')
+
+    def start_upload(self, key):
+        return uuid.uuid4().hex
+
+    def upload_part(self, upload_id, number, data):
+        with self.errors(upload_id):
+            self._part(upload_id, number).upload_from_string(data)
+
+    def complete_upload(self, upload_id, key, count):
+        sources = [self._part(upload_id, number) for number in range(1, count + 1)]
+        with self.errors(key):
+            # Fold longer lists through intermediate objects
+            level = 0
+            while len(sources) > self.COMPOSE_LIMIT:
+                merged = []
+                for i in range(0, len(sources), self.COMPOSE_LIMIT):
+                    blob = self.bucket.blob(f'{UPLOADS_PREFIX}{upload_id}/merged-{level}-{i:05d}')
+                    blob.compose(sources[i:i + self.COMPOSE_LIMIT])
+                    merged.append(blob)
+                sources, level = merged, level + 1
+            target = self.bucket.blob(key)
+            target.content_type = mimetypes.guess_type(key)[0]
+            target.compose(sources)
+        self.abort_upload(upload_id)
+
+    def abort_upload(self, upload_id):
+        with self.errors(upload_id):
+            for blob in self.bucket.list_blobs(prefix=f'{UPLOADS_PREFIX}{upload_id}/'):
+                try:
+                    blob.delete()
+                except self.not_found:
+                    pass
+
+
+class DiskLRUCache:
+    """
+    Size-bounded cache of objects in a local directory, shared by the
+    processes of a node. Files are replaced atomically and every hit bumps
+    the file's mtime. Going over ``max_bytes`` evicts the least recently
+    used files down to 90%. A reader that still holds an evicted file keeps
+    reading it. ``max_bytes=0`` turns caching off.
+    """
+    LOW_WATERMARK = 0.9
+    # Downloads in flight in other processes are left alone for this long
+    STALE_DOWNLOAD_SECONDS = 60 * 60
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def open(self, key, fetch):
+        """
+        An open binary file with the content of ``key``, fetched with
+        ``fetch(key, fileobj)`` on a miss. Raises what ``fetch`` raises.
+        """
+        if not self.max_bytes:
+            handle = tempfile.TemporaryFile()
+            fetch(key, handle)
+            handle.seek(0)
+            return handle
+
+        path = self._path(key)
+        try:
+            handle = open(path, 'rb')
+        except FileNotFoundError:
+            pass
+        else:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return handle
+
+        handle = self._store(path, lambda f: fetch(key, f))
+        self._added(os.fstat(handle.fileno()).st_size)
+        return handle
+
+    def put(self, key, data):
+        """Cache ``data`` as the content of ``key``."""
+        if not self.max_bytes or len(data) > self.max_bytes:
+            return
+        self._store(self._path(key), lambda f: f.write(data)).close()
+        self._added(len(data))
+
+    def _store(self, path, write):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        staged = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(staged, 'wb') as f:
+                write(f)
+            # Opened before it is visible, so an eviction cannot take it away
+            handle = open(staged, 'rb')
+            os.replace(staged, path)
+        except BaseException:
+            try:
+                os.remove(staged)
+            except FileNotFoundError:
+                pass
+            raise
+        return handle
+
+    def size(self, key):
+        """Size of the cached copy of ``key``, or None."""
+        try:
+            return os.path.getsize(self._path(key))
+        except OSError:
+            return None
+
+    def discard(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _added(self, size):
+        with self._lock:
+            # Other processes add files too; the estimate is corrected on every eviction
+            self._size = self.evict() if self._size is None else self._size + size
+            if self._size > self.max_bytes:
+                self._size = self.evict()
+
+    def evict(self):
+        """Remove least recently used files until under the low watermark. Returns the bytes left."""
+        now = time.time()
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if file_name.endswith('.tmp'):
+                    if now - st.st_mtime > self.STALE_DOWNLOAD_SECONDS:
+                        self._remove(path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return total
+        entries.sort()
+        target = self.max_bytes * self.LOW_WATERMARK
+        for _, size, path in entries:
+            if total <= target:
+                break
+            self._remove(path)
+            total -= size
+        return total
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def read_cache(directory=None, max_bytes=None):
+    """The process-wide cache for ``directory`` (``STORAGE_CACHE_DIR``)."""
+    directory = directory or _setting('STORAGE_CACHE_DIR', os.path.join(settings.MEDIA_ROOT, '.cache'))
+    with _caches_lock:
+        if directory not in _caches:
+            if max_bytes is None:
+                max_bytes = _setting('STORAGE_CACHE_MAX_BYTES', 1024 * 1024 * 1024)
+            _caches[directory] = DiskLRUCache(directory, max_bytes)
+        return _caches[directory]
+
+
+@deconstructible(path='api.storage.ObjectStorage')
+class ObjectStorage(Storage):
+    """
+    Django storage on an object store (``backend`` ``gcs`` or ``local``),
+    with reads through the node's ``DiskLRUCache``. Keys are ``prefix``
+    followed by the file name. ``unique_names=False`` keeps names as given
+    and overwrites; use it only where a name always maps to one content,
+    like the export artifacts.
+    """
+
+    def __init__(self, backend='local', bucket=None, project=None, root=None, prefix='', base_url=None,
+                 unique_names=True, cache_dir=None, cache_max_bytes=None, part_size=None, upload_threads=None):
+        self.backend = backend
+        self.bucket = bucket
+        self.project = project
+        self.root = root
+        self.prefix = prefix
+        self.base_url = base_url
+        self.unique_names = unique_names
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.part_size = part_size or _setting('STORAGE_PART_SIZE', 8 * 1024 * 1024)
+        self.upload_threads = upload_threads or _setting('STORAGE_UPLOAD_THREADS', 4)
+        self._client = None
+
+    @property
+    def client(self):
+        # Created on first use, so importing settings never needs the SDK
+        if self._client is None:
+            if self.backend == 'gcs':
+                if not self.bucket:
+                    raise ImproperlyConfigured('STORAGE_BACKEND=gcs needs STORAGE_BUCKET')
+                self._client = GCSObjectStore(self.bucket, self.project)
+            elif self.backend == 'local':
+                self._client = LocalObjectStore(self.root or os.path.join(settings.MEDIA_ROOT, 'object-store'))
+            else:
+                raise ImproperlyConfigured(f'Unknown object storage backend {self.backend!r}')
+        return self._client
+
+    @property
+    def cache(self):
+        return read_cache(self.cache_dir, self.cache_max_bytes)
+
+    def _key(self, name):
+        return self.prefix + name.replace('\\', '/')
+
+    def _open(self, name, mode='rb'):
+        if any(flag in mode for flag in 'wa+'):
+            raise ValueError('Stored objects are read-only; save a new file instead')
+        return File(self.cache.open(self._key(name), self.client.download), name=name)
+
+    def _save(self, name, content):
+        key = self._key(name)
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        first = content.read(self.part_size)
+        if len(first) < self.part_size:
+            self.client.put(key, first)
+            self.cache.put(key, first)
+            return name
+        self._upload_parts(key, first, content)
+        return name
+
+    def _upload_parts(self, key, first, content):
+        upload_id = self.client.start_upload(key)
+        try:
+            with ThreadPoolExecutor(self.upload_threads, thread_name_prefix='storage-upload') as pool:
+                pending = set()
+                number, data = 1, first
+                while data:
+                    # Read ahead at most two parts per thread
+                    if len(pending) >= self.upload_threads * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    pending.add(pool.submit(self.client.upload_part, upload_id, number, data))
+                    number += 1
+                    data = content.read(self.part_size)
+                for future in pending:
+                    future.result()
+            self.client.complete_upload(upload_id, key, number - 1)
+        except BaseException:
+            self.client.abort_upload(upload_id)
+            raise
+
+    def get_available_name(self, name, max_length=None):
+        if not self.unique_names:
+            return name
+        name = name.replace('\\', '/')
+        directory, file_name = os.path.split(name)
+        file_root, file_ext = os.path.splitext(file_name)
+        available = os.path.join(directory, self.get_alternative_name(file_root, file_ext))
+        if max_length and len(available) > max_length:
+            overflow = len(available) - max_length
+            file_root = file_root[:-overflow]
+            if not file_root:
+                raise SuspiciousFileOperation(f'Storage can not find an available filename for "{name}".')
+            available = os.path.join(directory, self.get_alternative_name(file_root, file_ext))
+        return available
+
+    def delete(self, name):
+        key = self._key(name)
+        self.client.delete(key)
+        self.cache.discard(key)
+
+    def exists(self, name):
+        return self.client.exists(self._key(name))
+
+    def size(self, name):
+        key = self._key(name)
+        cached = self.cache.size(key)
+        return cached if cached is not None else self.client.stat(key)[0]
+
+    def url(self, name):
+        base_url = self.base_url or _setting('STORAGE_PUBLIC_URL', '') or settings.MEDIA_URL
+        return urljoin(base_url, quote(name.replace('\\', '/')))
+
+    def get_modified_time(self, name):
+        modified = datetime.fromtimestamp(self.client.stat(self._key(name))[1], tz=dt_timezone.utc)
+        return modified if settings.USE_TZ else timezone.make_naive(modified)
+
+    def listdir(self, path):
+        prefix = self._key(path.rstrip('/') + '/' if path else '')
+        directories, files = set(), []
+        for key, _, _ in self.client.list(prefix):
+            head, _, tail = key[len(prefix):].partition('/')
+            if tail:
+                directories.add(head)
+            else:
+                files.append(head)
+        return sorted(directories), sorted(files)
+
+    def list_files(self, prefix=''):
+        """Yield ``(name, size, modified)`` for files whose name starts with ``prefix``."""
+        for key, size, modified in self.client.list(self._key(prefix)):
+            yield key[len(self.prefix):], size, modified
+
+
+def list_files(storage, prefix):
+    """
+    Yield ``(name, size, modified)`` for the files under ``prefix`` of any
+    storage, ``modified`` as a POSIX timestamp.
+    """
+    if hasattr(storage, 'list_files'):
+        yield from storage.list_files(prefix)
+        return
+    for path, size, modified in _walk(storage.path(prefix)):
+        yield os.path.relpath(path, storage.location).replace(os.sep, '/'), size, modified
@@ -1,3 +1,330 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.admin.sites import site
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db.models import Count, Sum
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+
+from . import changefeed
+from .bulk import bulk_move_media, soft_delete_batches, soft_delete_media
+from .dedup import MAX_DISTANCE, find_near_duplicates
+from .models import IdempotencyKey, Media, MediaBatch, User
+from .reaper import reap
+from .storage import DiskLRUCache
+
+
+def png(color, size=(40, 30)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class MediaFilesTestCase(TestCase):
+    """Keeps uploaded files in a temporary MEDIA_ROOT."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, MEDIA_REAPER_IN_PROCESS=False)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user(username='owner', password='x')
+
+    def upload(self, batch, name='a.bin', data=b'x' * 10):
+        return Media.objects.create(owner=self.user, batch=batch, file=SimpleUploadedFile(name, data))
+
+
+class BatchCounterTests(MediaFilesTestCase):
+    def assertCountersExact(self, *batches):
+        for batch in batches:
+            batch.refresh_from_db()
+            live = Media.objects.filter(batch=batch).aggregate(count=Count('pk'), size=Sum('file_size'))
+            self.assertEqual(batch.media_count, live['count'], f'media_count of {batch}')
+            self.assertEqual(batch.total_bytes, live['size'] or 0, f'total_bytes of {batch}')
+
+    def test_create(self):
+        batch = MediaBatch.objects.create(owner=self.user, title='a')
+        self.upload(batch, data=b'x' * 10)
+        self.upload(batch, data=b'x' * 25)
+        self.assertCountersExact(batch)
+        self.assertEqual(batch.total_bytes, 35)
+
+    def test_move_with_save(self):
+        source = MediaBatch.objects.create(owner=self.user, title='a')
+        target = MediaBatch.objects.create(owner=self.user, title='b')
+        media = self.upload(source)
+        media.batch = target
+        media.save()
+        self.assertCountersExact(source, target)
+        self.assertEqual((source.media_count, target.media_count), (0, 1))
+
+    def test_bulk_move(self):
+        source = MediaBatch.objects.create(owner=self.user, title='a')
+        target = MediaBatch.objects.create(owner=self.user, title='b')
+        media = [self.upload(source, data=b'x' * (i + 1)) for i in range(3)]
+        self.upload(target)
+        moved = bulk_move_media(Media.objects.filter(pk__in=[m.pk for m in media[:2]]), target)
+        self.assertEqual(moved, 2)
+        self.assertCountersExact(source, target)
+
+    def test_soft_delete_and_reap(self):
+        batch = MediaBatch.objects.create(owner=self.user, title='a')
+        kept = self.upload(batch, data=b'x' * 10)
+        deleted = self.upload(batch, data=b'x' * 20)
+        soft_delete_media(Media.objects.filter(pk=deleted.pk))
+        self.assertCountersExact(batch)
+        # Counters were adjusted by the soft delete; the hard delete must not do it again
+        self.assertEqual(reap(), (1, 0))
+        self.assertFalse(Media.all_objects.filter(pk=deleted.pk).exists())
+        self.assertCountersExact(batch)
+        self.assertEqual((batch.media_count, batch.total_bytes), (1, kept.file_size))
+
+    def test_reap_batch(self):
+        batch = MediaBatch.objects.create(owner=self.user, title='a')
+        self.upload(batch)
+        soft_delete_batches(MediaBatch.objects.filter(pk=batch.pk))
+        self.assertEqual(reap(), (1, 1))
+        self.assertFalse(MediaBatch.all_objects.filter(pk=batch.pk).exists())
+
+
+@override_settings(CHANGE_FEED_SETTLE_SECONDS=0, CHANGE_FEED_POLL_INTERVAL=0)
+class ChangeFeedTests(MediaFilesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = User.objects.create_user(username='other', password='x')
+        self.staff = User.objects.create_user(username='staff', password='x', role='viewer')
+
+    def changes(self, user, cursor):
+        client = APIClient(SERVER_NAME='localhost')
+        client.force_authenticate(user)
+        response = client.get('/api/changes/', {'cursor': cursor, 'timeout': 0})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_cursor_returns_only_later_events(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            batch = MediaBatch.objects.create(owner=self.user, title='a')
+        cursor = self.changes(self.user, 0)['cursor']
+        with self.captureOnCommitCallbacks(execute=True):
+            media = self.upload(batch)
+
+        feed = self.changes(self.user, cursor)
+        self.assertEqual([(e['kind'], e['action'], e['object_id']) for e in feed['events']],
+                         [('media', 'created', media.pk)])
+        self.assertEqual(feed['cursor'], feed['events'][-1]['id'])
+        self.assertEqual(self.changes(self.user, feed['cursor'])['events'], [])
+
+    def test_visibility(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            MediaBatch.objects.create(owner=self.user, title='mine')
+            MediaBatch.objects.create(owner=self.other, title='theirs')
+
+        self.assertEqual([e['object_id'] for e in self.changes(self.user, 0)['events']],
+                         list(MediaBatch.objects.filter(owner=self.user).values_list('pk', flat=True)))
+        self.assertEqual(len(self.changes(self.staff, 0)['events']), 2)
+
+    def test_move_reports_source_batch(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            source = MediaBatch.objects.create(owner=self.user, title='a')
+            target = MediaBatch.objects.create(owner=self.user, title='b')
+            media = self.upload(source)
+        cursor = changefeed.latest_event_id()
+        with self.captureOnCommitCallbacks(execute=True):
+            bulk_move_media(Media.objects.filter(pk=media.pk), target)
+
+        events = {(e['kind'], e['action'], e['object_id']) for e in self.changes(self.user, cursor)['events']}
+        self.assertEqual(events, {('media', 'updated', media.pk), ('batch', 'updated', source.pk)})
+
+    def test_unsettled_events_are_held_back(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            MediaBatch.objects.create(owner=self.user, title='a')
+        with self.settings(CHANGE_FEED_SETTLE_SECONDS=60):
+            self.assertEqual(changefeed.fetch_events(self.user.pk, 0), ([], True))
+        events, settling = changefeed.fetch_events(self.user.pk, 0)
+        self.assertEqual((len(events), settling), (1, False))
+
+
+class VersionedUrlTests(MediaFilesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient(SERVER_NAME='localhost')
+        self.client.force_authenticate(self.user)
+        self.media = self.upload(MediaBatch.objects.create(owner=self.user, title='a'), 'a.png', png('red'))
+
+    def file_path(self):
+        url = self.client.get(f'/api/media/{self.media.pk}/').json()['file_url']
+        return url.split('localhost', 1)[1]
+
+    def test_old_url_404s_after_file_change(self):
+        old = self.file_path()
+        self.assertEqual(self.client.get(old).status_code, 200)
+
+        response = self.client.patch(f'/api/media/{self.media.pk}/', {'file': SimpleUploadedFile('b.png', png('blue'))},
+                                     format='multipart')
+        self.assertEqual(response.status_code, 200)
+        new = self.file_path()
+
+        self.assertNotEqual(old, new)
+        self.assertEqual(self.client.get(old).status_code, 404)
+        response = self.client.get(new)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), png('blue'))
+
+    def test_wrong_file_name_404s(self):
+        path = self.file_path()
+        self.assertEqual(self.client.get(path.rsplit('/', 1)[0] + '/other.png').status_code, 404)
+
+
+@override_settings(IDEMPOTENCY_WAIT_SECONDS=0)
+class IdempotencyTests(MediaFilesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.batch = MediaBatch.objects.create(owner=self.user, title='a')
+        self.client = APIClient(SERVER_NAME='localhost')
+        self.client.force_authenticate(self.user)
+
+    def upload_with_key(self, key, name='a.bin'):
+        return self.client.post(f'/api/batches/{self.batch.pk}/images/',
+                                {'images': [SimpleUploadedFile(name, b'x' * 10)]},
+                                format='multipart', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_the_stored_response(self):
+        first = self.upload_with_key('k1')
+        self.assertEqual(first.status_code, 200)
+        retry = self.upload_with_key('k1')
+        self.assertEqual((retry.status_code, retry.json()), (200, first.json()))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(Media.objects.filter(batch=self.batch).count(), 1)
+
+    def test_key_reused_for_a_different_request_is_422(self):
+        self.upload_with_key('k1', 'a.bin')
+        response = self.upload_with_key('k1', 'other.bin')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Media.objects.filter(batch=self.batch).count(), 1)
+
+    def test_key_in_progress_is_409(self):
+        self.upload_with_key('k1')
+        # As if the original request were still running
+        IdempotencyKey.objects.filter(key='k1').update(response_status=None, response_body=None)
+        response = self.upload_with_key('k1')
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(Media.objects.filter(batch=self.batch).count(), 1)
+
+    def test_abandoned_key_is_taken_over(self):
+        self.upload_with_key('k1')
+        IdempotencyKey.objects.filter(key='k1').update(
+            response_status=None, response_body=None, created_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(self.upload_with_key('k1').status_code, 200)
+        self.assertEqual(Media.objects.filter(batch=self.batch).count(), 2)
+
+    def test_unclaimable_key_is_409(self):
+        with mock.patch('api.idempotency._claim', return_value=(None, False)):
+            response = self.upload_with_key('k1')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(Media.objects.filter(batch=self.batch).exists())
+
+
+class NearDuplicateTests(MediaFilesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.batch = MediaBatch.objects.create(owner=self.user, title='a')
+        self.base = 0x0123456789abcdef
+
+    def add(self, phash):
+        media = self.upload(self.batch)
+        media.perceptual_hash = phash
+        media.save()
+        return media
+
+    def test_every_distance_up_to_max_is_found(self):
+        # Spread the flipped bits over every band so no band matches exactly
+        bits = [i * 16 + j for j in range(3) for i in range(4)][:MAX_DISTANCE]
+        expected = []
+        for distance in range(1, MAX_DISTANCE + 1):
+            expected.append((distance, self.add(self.base ^ sum(1 << bit for bit in bits[:distance])).pk))
+        self.add(self.base ^ ((1 << 32) - 1))
+        found = find_near_duplicates(Media.objects.all(), self.base, MAX_DISTANCE)
+        self.assertEqual(found, expected)
+
+    def test_max_distance_above_limit_is_400(self):
+        media = self.add(self.base)
+        client = APIClient(SERVER_NAME='localhost')
+        client.force_authenticate(self.user)
+        url = f'/api/media/{media.pk}/duplicates/'
+        self.assertEqual(client.get(url, {'max_distance': MAX_DISTANCE}).status_code, 200)
+        self.assertEqual(client.get(url, {'max_distance': MAX_DISTANCE + 1}).status_code, 400)
+        self.assertEqual(client.get(url, {'max_distance': 'x'}).status_code, 400)
+
+
+class UserAdminSearchTests(TestCase):
+    def setUp(self):
+        User.objects.create_user(username='Alice', email='Alice@Example.com', password='x', full_name='Alice Smith')
+        User.objects.create_user(username='bob', email='bob@example.com', password='x', phone_number='555')
+
+    def search(self, term):
+        queryset, _ = site._registry[User].get_search_results(None, User.objects.all(), term)
+        return sorted(queryset.values_list('username', flat=True))
+
+    def test_prefix_and_exact_ignore_case(self):
+        self.assertEqual(self.search('al'), ['Alice'])
+        self.assertEqual(self.search('ALICE@example.com'), ['Alice'])
+        self.assertEqual(self.search('alice@example'), [])
+        self.assertEqual(self.search('ep-id-'), ['Alice', 'bob'])
+        self.assertEqual(self.search('555'), ['bob'])
+
+
+class DiskLRUCacheTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.cache = DiskLRUCache(self.directory, max_bytes=1000)
+
+    def put(self, key, age):
+        self.cache.put(key, b'x' * 300)
+        # Make the access order explicit instead of relying on timestamp resolution
+        path = self.cache._path(key)
+        if os.path.exists(path):
+            then = time.time() - age
+            os.utime(path, (then, then))
+
+    def test_evicts_least_recently_used_below_low_watermark(self):
+        self.put('a', age=30)
+        self.put('b', age=20)
+        self.put('c', age=10)
+        # A hit makes 'a' the most recently used
+        with self.cache.open('a', fetch=None) as f:
+            self.assertEqual(len(f.read()), 300)
+
+        self.put('d', age=0)
+
+        self.assertEqual(self.cache.size('b'), None)
+        self.assertEqual(self.cache.size('a'), 300)
+        self.assertEqual(self.cache.size('c'), 300)
+        self.assertEqual(self.cache.size('d'), 300)
+
+    def test_miss_fetches_and_caches(self):
+        fetched = []
+
+        def fetch(key, fileobj):
+            fetched.append(key)
+            fileobj.write(b'content')
+
+        for _ in range(2):
+            with self.cache.open('k', fetch) as f:
+                self.assertEqual(f.read(), b'content')
+        self.assertEqual(fetched, ['k'])
+
+    def test_oversized_put_is_not_cached(self):
+        self.cache.put('big', b'x' * 2000)
+        self.assertEqual(self.cache.size('big'), None)
@@ -0,0 +1,212 @@
+"""
+Admission control for the expensive endpoints.
+
+``UploadRateThrottle`` and ``ExportRateThrottle`` are DRF throttles backed
+by a token bucket per user: a rate of ``30/hour`` allows a burst of 30
+requests and refills one token every two minutes. They are attached to the
+upload and export views only, so ordinary reads never touch the buckets. ``concurrency_limit`` caps how many
+requests of one kind run at once, per user and in total, and
+``limit_upload_size`` turns away oversized uploads from ``Content-Length``
+before the body is read. All of them answer with a 429 (or 411/413) right
+away instead of queueing behind busy workers.
+
+Buckets and slots are database rows (``ThrottleBucket``, ``ConcurrencySlot``)
+so every worker enforces the same limits. A bucket is only changed by one
+conditional UPDATE that refills it and takes a token, so concurrent requests
+can't both spend the last one. ``purge_throttle_state`` drops idle buckets.
+"""
+import time
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import Greatest, Least
+from django.db.models.lookups import GreaterThanOrEqual
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.throttling import SimpleRateThrottle
+
+from .models import ConcurrencySlot, ThrottleBucket
+
+# A crashed worker's concurrency slot is given back after this long
+CONCURRENCY_SLOT_TIMEOUT = 10 * 60
+
+
+class UserTokenBucketThrottle(SimpleRateThrottle):
+    """
+    Token bucket per user (or per client address for anonymous requests).
+    Rates come from ``REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'][scope]``;
+    subclasses set the scope.
+    """
+    scope = 'user'
+
+    def get_cache_key(self, request, view):
+        if request.user and request.user.is_authenticated:
+            ident = request.user.pk
+        else:
+            ident = self.get_ident(request)
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        now = time.time()
+        refill = self.num_requests / self.duration
+        buckets = ThrottleBucket.objects.using(DEFAULT_DB_ALIAS)
+        available = Least(
+            Value(float(self.num_requests)),
+            F('tokens') + Greatest(Value(now) - F('updated'), Value(0.0)) * Value(refill),
+            output_field=FloatField(),
+        )
+        for _ in range(2):
+            if buckets.filter(GreaterThanOrEqual(available, 1.0), key=self.key).update(
+                    tokens=available - 1, updated=Greatest(F('updated'), Value(now))):
+                return True
+            bucket = buckets.filter(key=self.key).values_list('tokens', 'updated').first()
+            if bucket is not None:
+                tokens, updated = bucket
+                tokens = min(self.num_requests, tokens + max(now - updated, 0) * refill)
+                self.retry_after = max(1 - tokens, 0) / refill
+                return False
+            try:
+                with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                    buckets.create(key=self.key, tokens=self.num_requests - 1, updated=now)
+                return True
+            except IntegrityError:
+                # Another request created it first; take a token from that one
+                continue
+        return False
+
+    def wait(self):
+        return getattr(self, 'retry_after', None)
+
+
+class UploadRateThrottle(UserTokenBucketThrottle):
+    scope = 'uploads'
+
+
+class ExportRateThrottle(UserTokenBucketThrottle):
+    scope = 'exports'
+
+
+def purge_throttle_state(older_than=timedelta(days=1)):
+    """
+    Delete buckets untouched for ``older_than`` (they are full again) and
+    slots left behind by crashed workers. Returns the number deleted.
+    """
+    buckets, _ = ThrottleBucket.objects.filter(updated__lt=time.time() - older_than.total_seconds()).delete()
+    cutoff = timezone.now() - timedelta(seconds=CONCURRENCY_SLOT_TIMEOUT)
+    slots, _ = ConcurrencySlot.objects.filter(acquired_at__lt=cutoff).delete()
+    return buckets + slots
+
+
+def _acquire(key, limit):
+    """
+    Hold a slot of ``key`` unless ``limit`` are held already. Returns the
+    slot's id, or None. The row is committed before counting, so of two
+    racing requests the later count sees both; at worst both give up.
+    """
+    slots = ConcurrencySlot.objects.using(DEFAULT_DB_ALIAS)
+    slot = slots.create(key=key)
+    cutoff = timezone.now() - timedelta(seconds=CONCURRENCY_SLOT_TIMEOUT)
+    if slots.filter(key=key, acquired_at__gte=cutoff).count() > limit:
+        _release(slot.pk)
+        return None
+    return slot.pk
+
+
+def _release(slot_id):
+    ConcurrencySlot.objects.using(DEFAULT_DB_ALIAS).filter(pk=slot_id).delete()
+
+
+def acquire_slots(scope, user):
+    """
+    Take a ``CONCURRENCY_LIMITS[scope]`` slot for ``user`` and a global one.
+    Returns the slot ids to hand to ``release_slots``, or None when over a cap.
+    """
+    limits = getattr(settings, 'CONCURRENCY_LIMITS', {}).get(scope, {})
+    slots = []
+    if limits.get('user'):
+        slots.append((f'concurrency_{scope}_user_{user.pk}', limits['user']))
+    if limits.get('total'):
+        slots.append((f'concurrency_{scope}_total', limits['total']))
+
+    acquired = []
+    for key, limit in slots:
+        slot_id = _acquire(key, limit)
+        if slot_id is None:
+            release_slots(acquired)
+            return None
+        acquired.append(slot_id)
+    return acquired
+
+
+def release_slots(slot_ids):
+    if slot_ids:
+        ConcurrencySlot.objects.using(DEFAULT_DB_ALIAS).filter(pk__in=slot_ids).delete()
+
+
+def concurrency_rejected():
+    return Response(
+        {'detail': 'Too many requests of this kind are running. Try again shortly.'},
+        status=status.HTTP_429_TOO_MANY_REQUESTS,
+        headers={'Retry-After': str(getattr(settings, 'CONCURRENCY_RETRY_AFTER', 5))},
+    )
+
+
+def concurrency_limit(scope):
+    """
+    Allow at most ``CONCURRENCY_LIMITS[scope]['user']`` requests per user and
+    ``['total']`` overall to run the view at the same time. Apply it inside
+    ``@api_view`` (or with ``method_decorator``) so the user is known.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            acquired = acquire_slots(scope, request.user)
+            if acquired is None:
+                return concurrency_rejected()
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                release_slots(acquired)
+        return wrapper
+    return decorator
+
+
+def upload_size_error(length):
+    """
+    Why a request body of ``length`` (the raw Content-Length header) may not
+    be accepted, as ``(status, detail)``, or None when it is fine.
+    """
+    if not length:
+        return status.HTTP_411_LENGTH_REQUIRED, 'Content-Length is required for uploads'
+    try:
+        length = int(length)
+    except ValueError:
+        return status.HTTP_400_BAD_REQUEST, 'Invalid Content-Length'
+    max_bytes = getattr(settings, 'UPLOAD_MAX_BYTES', None)
+    if max_bytes and length > max_bytes:
+        return status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, f'Upload is larger than the {max_bytes} byte limit'
+    return None
+
+
+def limit_upload_size(view):
+    """
+    Reject uploads larger than ``UPLOAD_MAX_BYTES`` using ``Content-Length``
+    alone. DRF parses the body lazily, so nothing has been read yet.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        error = upload_size_error(request.META.get('CONTENT_LENGTH'))
+        if error:
+            return Response({'detail': error[1]}, status=error[0])
+        return view(request, *args, **kwargs)
+    return wrapper
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from . import views
+from . import async_views, media_urls, views
 from django.conf import settings
 from django.conf.urls.static import static
 from .views import get_current_user, reset_password
@@ -30,6 +30,23 @@ urlpatterns = [
     path('media/add-to-batch/', views.add_to_batch, name='add-to-batch'),
     path('batches/<int:batch_id>/export-pdf/', views.export_batch_pdf, name='export-batch-pdf'),
     path('batches/<int:batch_id>/images/', views.batch_images, name='batch-images'),
+
+    # Search
+    path('search/', views.search, name='search'),
+
+    # Immutable, content-versioned files (api/media_urls.py)
+    path('files/media/<int:pk>/<str:version>/<str:filename>', media_urls.serve_file, {'kind': 'file'}, name='media-file'),
+    path('files/thumbnails/<int:pk>/<str:version>/<str:filename>', media_urls.serve_file, {'kind': 'thumbnail'}, name='media-thumbnail'),
+    path('files/profile-photos/<int:pk>/<str:version>/<str:filename>', media_urls.serve_file, {'kind': 'profile_photo'}, name='profile-photo'),
+
+    # Change feed (api/changefeed.py)
+    path('changes/', views.changes, name='changes'),
+
+    # Async variants for the ASGI deployment (api/async_views.py)
+    path('async/upload/', async_views.upload_media, name='async-media-upload'),
+    path('async/media/<int:pk>/download/', async_views.download_media, name='async-media-download'),
+    path('async/batches/<int:batch_id>/export-pdf/', async_views.export_batch_pdf, name='async-export-batch-pdf'),
+    path('async/changes/stream/', async_views.change_stream, name='async-change-stream'),
 ]
 
 if settings.DEBUG:
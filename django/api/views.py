@@ -1,5 +1,5 @@
 from rest_framework import viewsets, permissions, status
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, action, throttle_classes
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -8,12 +8,24 @@ from django.contrib.auth import authenticate, update_session_auth_hash
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.middleware.csrf import get_token
-from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from rest_framework import generics
+from rest_framework.pagination import PageNumberPagination
+from django.db import transaction
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 
 from .models import Media, User, MediaBatch
-from .serializers import MediaSerializer, UserSerializer, MediaBatchSerializer
+from .serializers import MediaSerializer, UserSerializer, MediaBatchSerializer, MediaBatchSummarySerializer
+from .search import search_queryset
+from .bulk import bulk_move_media, bulk_set_title, soft_delete_media, soft_delete_batches
+from .reaper import reap_in_background
+from .idempotency import idempotent
+from .throttling import (
+    UploadRateThrottle, ExportRateThrottle, concurrency_limit, limit_upload_size,
+)
+from . import changefeed
+from .filters import MediaMetadataFilter, filter_media, order_media
+from .dedup import DuplicateDetector, find_near_duplicates, batch_duplicate_groups, check_max_distance, DEFAULT_MAX_DISTANCE
 import logging
 from .permissions import IsAdminUser, IsViewerUser, IsEditorUser
 from django.contrib.auth.tokens import default_token_generator
@@ -74,6 +86,41 @@ def reset_password(request, user_id):
 
 logger = logging.getLogger(__name__)
 
+# Largest id list accepted by the bulk endpoints
+BULK_MAX_IDS = 5000
+BULK_MEDIA_ACTIONS = ('move', 'set_title', 'delete')
+
+def parse_bulk_ids(request, model):
+    """
+    Validate the ``ids`` list of a bulk request and return a queryset of the
+    objects. Staff may act on anything; other users only on what they own.
+    Raises ValueError for a malformed list and PermissionError when any id is
+    missing or not permitted, checked with a single COUNT query.
+    """
+    ids = request.data.get('ids')
+    if not isinstance(ids, list) or not ids or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        raise ValueError('ids must be a non-empty list of integers')
+    ids = set(ids)
+    if len(ids) > BULK_MAX_IDS:
+        raise ValueError(f'At most {BULK_MAX_IDS} ids per request')
+
+    queryset = IsOwnerOrStaff.scope_queryset(request, model.objects.filter(pk__in=ids))
+    if queryset.count() != len(ids):
+        raise PermissionError('Some items do not exist or you do not have permission to change them')
+    return queryset
+
+def bulk_delete_response(request, model, soft_delete):
+    try:
+        queryset = parse_bulk_ids(request, model)
+    except ValueError as e:
+        return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except PermissionError as e:
+        return Response({'detail': str(e)}, status=status.HTTP_403_FORBIDDEN)
+
+    deleted = soft_delete(queryset)
+    transaction.on_commit(reap_in_background)
+    return Response({'deleted': deleted}, status=status.HTTP_202_ACCEPTED)
+
 # Media ViewSet
 @method_decorator(csrf_exempt, name='dispatch')
 class MediaViewSet(viewsets.ModelViewSet):
@@ -81,6 +128,8 @@ class MediaViewSet(viewsets.ModelViewSet):
     serializer_class = MediaSerializer
     permission_classes = [IsAuthenticated]
     parser_classes = (MultiPartParser, FormParser)
+    # Metadata filters and ?ordering= (see api/filters.py)
+    filter_backends = [MediaMetadataFilter]
 
     def get_permissions(self):
         if self.action == 'list' or self.action == 'retrieve':
@@ -105,6 +154,79 @@ class MediaViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
+    def perform_destroy(self, instance):
+        # Hide now; the reaper removes the row and file in the background
+        soft_delete_media(Media.objects.filter(pk=instance.pk))
+        transaction.on_commit(reap_in_background)
+
+    @action(detail=False, methods=['post'], url_path='bulk-delete', parser_classes=[JSONParser])
+    def bulk_delete(self, request):
+        return bulk_delete_response(request, Media, soft_delete_media)
+
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser])
+    def bulk(self, request):
+        """
+        Apply one action to many media in a single transaction:
+        ``{"ids": [...], "action": "move", "batch": <id>}``,
+        ``{"ids": [...], "action": "set_title", "title": "..."}`` or
+        ``{"ids": [...], "action": "delete"}``.
+        """
+        operation = request.data.get('action')
+        if operation not in BULK_MEDIA_ACTIONS:
+            return Response({'detail': f"action must be one of {', '.join(BULK_MEDIA_ACTIONS)}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            try:
+                queryset = parse_bulk_ids(request, Media)
+            except ValueError as e:
+                return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            except PermissionError as e:
+                return Response({'detail': str(e)}, status=status.HTTP_403_FORBIDDEN)
+
+            if operation == 'move':
+                batch_id = request.data.get('batch')
+                if not isinstance(batch_id, int) or isinstance(batch_id, bool):
+                    return Response({'detail': 'batch must be a batch id'}, status=status.HTTP_400_BAD_REQUEST)
+                batch = IsOwnerOrStaff.scope_queryset(request, MediaBatch.objects.filter(pk=batch_id)).first()
+                if batch is None:
+                    return Response({'detail': 'Batch not found or you do not have permission to change it'},
+                                    status=status.HTTP_403_FORBIDDEN)
+                updated = bulk_move_media(queryset, batch)
+            elif operation == 'set_title':
+                title = request.data.get('title')
+                if title is not None and (not isinstance(title, str) or len(title) > 255):
+                    return Response({'detail': 'title must be a string of at most 255 characters'},
+                                    status=status.HTTP_400_BAD_REQUEST)
+                updated = bulk_set_title(queryset, title or None)
+            else:
+                updated = soft_delete_media(queryset)
+                transaction.on_commit(reap_in_background)
+
+        return Response({'action': operation, 'updated': updated})
+
+    @action(detail=True, methods=['get'])
+    def duplicates(self, request, pk=None):
+        media = self.get_object()
+        if media.perceptual_hash is None:
+            return Response({'detail': 'No perceptual hash for this file'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            max_distance = int(request.query_params.get('max_distance', DEFAULT_MAX_DISTANCE))
+        except ValueError:
+            return Response({'detail': 'Invalid max_distance'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            check_max_distance(max_distance)
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Look inside the same batch or across the owner's whole library
+        if request.query_params.get('scope') == 'batch' and media.batch_id:
+            queryset = Media.objects.filter(batch_id=media.batch_id)
+        else:
+            queryset = Media.objects.filter(owner_id=media.owner_id)
+        matches = find_near_duplicates(queryset, media.perceptual_hash, max_distance, exclude_pk=media.pk)
+        return Response([{'id': pk, 'distance': distance} for distance, pk in matches])
+
 # Update MediaBatchViewSet permissions similarly
 class MediaBatchViewSet(viewsets.ModelViewSet):
     queryset = MediaBatch.objects.all()
@@ -258,10 +380,21 @@ class UserProfileView(APIView):
         serializer = UserSerializer(request.user, context={'request': request})
         return Response(serializer.data)
 
+class BatchMediaPagination(PageNumberPagination):
+    page_size = 30
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
 # Add MediaBatchViewSet
 class MediaBatchViewSet(viewsets.ModelViewSet):
     queryset = MediaBatch.objects.all()
     serializer_class = MediaBatchSerializer
+
+    def get_serializer_class(self):
+        # Listings carry counts and a cover image; images are paged from media/
+        if self.action in ['list', 'retrieve']:
+            return MediaBatchSummarySerializer
+        return MediaBatchSerializer
     
     def get_permissions(self):
         if self.action == 'list' or self.action == 'retrieve':
@@ -279,18 +412,50 @@ class MediaBatchViewSet(viewsets.ModelViewSet):
         user = self.request.user
         # Admin, editor, and viewer can see all batches
         if user.role in ['admin', 'editor', 'viewer']:
-            return MediaBatch.objects.all()
+            queryset = MediaBatch.objects.all()
         # Regular users can only see their own batches
-        return MediaBatch.objects.filter(owner=user)
+        else:
+            queryset = MediaBatch.objects.filter(owner=user)
+        if self.action in ['list', 'retrieve']:
+            queryset = MediaBatchSummarySerializer.setup_queryset(queryset)
+        return queryset
     
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
+    def perform_destroy(self, instance):
+        # Hide the batch and its media now; the reaper deletes them in chunks
+        soft_delete_batches(MediaBatch.objects.filter(pk=instance.pk))
+        transaction.on_commit(reap_in_background)
+
+    @action(detail=False, methods=['post'], url_path='bulk-delete')
+    def bulk_delete(self, request):
+        return bulk_delete_response(request, MediaBatch, soft_delete_batches)
+
+    @action(detail=True, methods=['get'])
+    def duplicates(self, request, pk=None):
+        batch = self.get_object()
+        return Response({'groups': batch_duplicate_groups(batch)})
+
+    @action(detail=True, methods=['get'])
+    def media(self, request, pk=None):
+        batch = self.get_object()
+        queryset = filter_media(batch.media_files.defer('file_data'), request.query_params)
+        queryset = order_media(queryset, request.query_params.get('ordering'))
+        paginator = BatchMediaPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = MediaSerializer(page, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
+
 # Update MediaUploadView to handle batch uploads
 class MediaUploadView(APIView):
     parser_classes = (MultiPartParser, FormParser)
     permission_classes = [IsAuthenticated]
+    throttle_classes = [UploadRateThrottle]
 
+    @method_decorator(limit_upload_size)
+    @method_decorator(concurrency_limit('uploads'))
+    @method_decorator(idempotent)
     def post(self, request, *args, **kwargs):
         logger.info(f"Received file upload request: {request.data}")
         
@@ -325,6 +490,10 @@ class MediaUploadView(APIView):
 # Add batch upload endpoint for multiple files
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@throttle_classes([UploadRateThrottle])
+@limit_upload_size
+@concurrency_limit('uploads')
+@idempotent
 def batch_upload(request):
     if 'files[]' not in request.FILES:
         return Response({'detail': 'No files uploaded'}, status=status.HTTP_400_BAD_REQUEST)
@@ -348,59 +517,90 @@ def batch_upload(request):
         batch.delete()
         return Response({'detail': 'Minimum 20 files required for batch upload'}, 
                         status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        detector = DuplicateDetector.from_request(request, batch)
+    except ValueError as e:
+        batch.delete()
+        return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     
     # Process all files (no maximum limit)
+    skipped = []
     for file in files:
-        media = Media.objects.create(
-            owner=request.user,
-            batch=batch,
-            file=file,
-            title=request.data.get('file_title', '')
-        )
+        media, duplicate = create_media(detector, owner=request.user, batch=batch, file=file,
+                                        title=request.data.get('file_title', ''))
+        if media is None:
+            skipped.append(duplicate)
+            continue
         uploaded_files.append(MediaSerializer(media, context={'request': request}).data)
     
     return Response({
         'batch': MediaBatchSerializer(batch, context={'request': request}).data,
-        'files': uploaded_files
+        'files': uploaded_files,
+        'skipped': skipped
     }, status=status.HTTP_201_CREATED)
 
+def create_media(detector, **fields):
+    """
+    Create a Media row unless ``detector`` says it is a near-duplicate to skip.
+    Returns ``(media, duplicate)`` where ``duplicate`` describes the match.
+    """
+    if detector is None:
+        return Media.objects.create(**fields), None
+
+    phash, duplicate_id, distance = detector.check(fields['file'])
+    duplicate = None
+    if duplicate_id is not None:
+        duplicate = {'name': fields['file'].name, 'duplicate_of': duplicate_id, 'distance': distance}
+        if detector.action == 'skip':
+            return None, duplicate
+        fields['duplicate_of_id'] = duplicate_id
+
+    media = Media.objects.create(perceptual_hash=phash, **fields)
+    detector.add(phash, media)
+    return media, duplicate
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@throttle_classes([UploadRateThrottle])
+@limit_upload_size
+@concurrency_limit('uploads')
+@idempotent
 def batch_images(request, batch_id):
     try:
         batch = MediaBatch.objects.get(id=batch_id)
         files = request.FILES.getlist('images')
+        detector = DuplicateDetector.from_request(request, batch)
         
+        skipped = []
         for file in files:
-            Media.objects.create(
+            media, duplicate = create_media(
+                detector,
                 file=file,
                 owner=request.user,
                 batch=batch,
                 title=file.name
             )
+            if media is None:
+                skipped.append(duplicate)
         
-        return Response({'message': 'Images added successfully'}, status=status.HTTP_200_OK)
+        return Response({'message': 'Images added successfully', 'skipped': skipped}, status=status.HTTP_200_OK)
     except MediaBatch.DoesNotExist:
         return Response({'error': 'Batch not found'}, status=status.HTTP_404_NOT_FOUND)
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 from django.http import FileResponse
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as RLImage, Table, TableStyle
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from PIL import Image
 from io import BytesIO
+from .exports import batch_pdf
 import os
 from django.conf import settings
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_media_batches(request):
-    batches = MediaBatch.objects.filter(owner=request.user)
-    serializer = MediaBatchSerializer(batches, many=True)
+    batches = MediaBatchSummarySerializer.setup_queryset(MediaBatch.objects.filter(owner=request.user))
+    serializer = MediaBatchSummarySerializer(batches, many=True, context={'request': request})
     return Response(serializer.data)
 
 @api_view(['POST'])
@@ -410,20 +610,29 @@ def add_to_batch(request):
     try:
         batch = MediaBatch.objects.get(id=batch_id, owner=request.user)
         files = request.FILES.getlist('files[]')
+        detector = DuplicateDetector.from_request(request, batch)
         
+        skipped = []
         for file in files:
-            Media.objects.create(
+            media, duplicate = create_media(
+                detector,
                 owner=request.user,
                 batch=batch,
                 file=file
             )
+            if media is None:
+                skipped.append(duplicate)
         
-        return Response({'message': 'Images added successfully'})
+        return Response({'message': 'Images added successfully', 'skipped': skipped})
     except MediaBatch.DoesNotExist:
         return Response({'error': 'Batch not found'}, status=404)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=400)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@throttle_classes([ExportRateThrottle])
+@concurrency_limit('exports')
 def export_batch_pdf(request, batch_id):
     try:
         batch = MediaBatch.objects.get(id=batch_id)
@@ -434,120 +643,20 @@ def export_batch_pdf(request, batch_id):
                           status=status.HTTP_403_FORBIDDEN)
         
         # Get all images in this batch
-        images = batch.media_files.all()
-        
-        if not images:
-            return Response({'detail': 'No images in this batch to export'}, 
+        media_files = list(batch.media_files.defer('file_data', 'search_document'))
+
+        if not media_files:
+            return Response({'detail': 'No images in this batch to export'},
                           status=status.HTTP_400_BAD_REQUEST)
-        
-        # Create a PDF file
-        # (Your existing PDF generation code here)
-        
-        # Set the content type explicitly for PDF
-        response = HttpResponse(content_type='application/pdf')
-        response['Content-Disposition'] = f'attachment; filename="{batch.title}_export.pdf"'
-        
-        # Your PDF generation logic here
-        buffer = BytesIO()
-        
-        # Create PDF
-        doc = SimpleDocTemplate(
-            buffer,
-            pagesize=letter,
-            rightMargin=72,
-            leftMargin=72,
-            topMargin=72,
-            bottomMargin=72
-        )
-        
-        elements = []
-        styles = getSampleStyleSheet()
-        
-        # Add title
-        title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=styles['Heading1'],
-            fontSize=24,
-            spaceAfter=30
-        )
-        elements.append(Paragraph(f"Batch Report", title_style))
-        
-        # Add batch information
-        elements.append(Paragraph(f"Batch ID: {batch.id}", styles['Heading2']))
-        elements.append(Paragraph(f"Title: {batch.title}", styles['Heading2']))
-        elements.append(Paragraph(f"Created: {batch.created_at.strftime('%Y-%m-%d %H:%M')}", styles['Normal']))
-        elements.append(Spacer(1, 12))
-        
-        # Add images
-        elements.append(Paragraph("Images:", styles['Heading2']))
-        elements.append(Spacer(1, 12))
-        
-        # Create image table
-        image_data = []
-        current_row = []
-        
-        for media in batch.media_files.all():
-            try:
-                # Get image path
-                img_path = media.file.path
-                img = Image.open(img_path)
-                
-                # Resize image for PDF
-                img.thumbnail((300, 300))
-                
-                # Save to temporary buffer
-                img_buffer = BytesIO()
-                img.save(img_buffer, format='JPEG')
-                img_buffer.seek(0)
-                
-                # Create image for PDF
-                img_for_pdf = RLImage(img_buffer, width=200, height=200)
-                
-                # Add image and details to table
-                current_row.append([
-                    img_for_pdf,
-                    Paragraph(f"File: {os.path.basename(media.file.name)}", styles['Normal']),
-                    Paragraph(f"Uploaded: {media.created_at.strftime('%Y-%m-%d')}", styles['Normal'])
-                ])
-                
-                if len(current_row) == 2:
-                    image_data.append(current_row)
-                    current_row = []
-                
-            except Exception as e:
-                print(f"Error processing image {media.file.name}: {str(e)}")
-                continue
-        
-        # Add remaining images
-        if current_row:
-            image_data.append(current_row)
-        
-        # Create table for images
-        for row in image_data:
-            table = Table(row, colWidths=[250, 250])
-            table.setStyle(TableStyle([
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                ('GRID', (0, 0), (-1, -1), 1, colors.black),
-                ('PADDING', (0, 0), (-1, -1), 6),
-            ]))
-            elements.append(table)
-            elements.append(Spacer(1, 12))
-        
-        # Build PDF
-        doc.build(elements)
-        buffer.seek(0)
-        
-        response = FileResponse(
-            buffer,
+
+        pdf = batch_pdf(batch, media_files)
+        return FileResponse(
+            BytesIO(pdf),
             as_attachment=True,
-            filename=f'batch_{batch.id}.pdf'
+            filename=f'batch_{batch.id}.pdf',
+            content_type='application/pdf'
         )
-        response['Content-Type'] = 'application/pdf'
-        response['Content-Disposition'] = f'attachment; filename="batch_{batch.id}.pdf"'
-        
-        return response
-        
+
     except MediaBatch.DoesNotExist:
         return Response(
             {'error': 'Batch not found'},
@@ -560,6 +669,73 @@ def export_batch_pdf(request, batch_id):
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
+# Search batches or media by title, file name or REF-ID-/EP-ID- code
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def search(request):
+    query = request.query_params.get('q', '').strip()
+    if not query:
+        return Response({'detail': 'Query parameter "q" is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    search_type = request.query_params.get('type', 'batches')
+    if search_type == 'batches':
+        queryset = MediaBatchSummarySerializer.setup_queryset(MediaBatch.objects.all())
+        serializer_class = MediaBatchSummarySerializer
+    elif search_type == 'media':
+        queryset = Media.objects.defer('file_data')
+        serializer_class = MediaSerializer
+    else:
+        return Response({'detail': 'Type must be "batches" or "media"'}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Admin, editor, and viewer can search everything; regular users only their own
+    if request.user.role not in ['admin', 'editor', 'viewer']:
+        queryset = queryset.filter(owner=request.user)
+
+    try:
+        page = max(int(request.query_params.get('page', 1)), 1)
+        page_size = min(max(int(request.query_params.get('page_size', SEARCH_PAGE_SIZE)), 1), SEARCH_MAX_PAGE_SIZE)
+    except ValueError:
+        return Response({'detail': 'Invalid page or page_size'}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Fetch one extra row to know whether there is a next page without a COUNT(*)
+    offset = (page - 1) * page_size
+    results = list(search_queryset(queryset, query)[offset:offset + page_size + 1])
+    has_next = len(results) > page_size
+
+    return Response({
+        'query': query,
+        'type': search_type,
+        'page': page,
+        'next': page + 1 if has_next else None,
+        'previous': page - 1 if page > 1 else None,
+        'results': serializer_class(results[:page_size], many=True, context={'request': request}).data,
+    })
+
+
+# Change feed (api/changefeed.py). Each waiting request holds a worker thread
+# under WSGI; the SSE stream in api/async_views.py does not.
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def changes(request):
+    """
+    Long-poll for Media and MediaBatch events after ``?cursor=``. Waits up
+    to ``?timeout=`` seconds (``CHANGE_FEED_LONG_POLL_TIMEOUT`` at most)
+    when there are none yet.
+    """
+    max_timeout = getattr(settings, 'CHANGE_FEED_LONG_POLL_TIMEOUT', 25)
+    try:
+        cursor = changefeed.parse_cursor(request.query_params.get('cursor'))
+        timeout = min(max(float(request.query_params.get('timeout', max_timeout)), 0), max_timeout)
+    except ValueError:
+        return Response({'detail': 'Invalid cursor or timeout'}, status=status.HTTP_400_BAD_REQUEST)
+
+    feed = changefeed.long_poll(changefeed.feed_owner(request.user), cursor, timeout)
+    feed['more'] = len(feed['events']) >= getattr(settings, 'CHANGE_FEED_BATCH_LIMIT', 500)
+    return Response(feed)
+
 
 class UserListView(generics.ListAPIView):
     queryset = User.objects.all()
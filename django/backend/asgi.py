@@ -2,6 +2,12 @@
 ASGI config for backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Run it with e.g. ``uvicorn backend.asgi:application`` to serve the async
+upload and download views in api/async_views.py without a worker per client.
+With several worker processes, preload it in the master so they share its
+memory::
+
+    gunicorn -k uvicorn.workers.UvicornWorker --preload 'backend.asgi:create_application(preload=True)'
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -13,4 +19,17 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after setup so the app registry is ready
+from api.asgi import reject_oversized_uploads  # noqa: E402
+
+
+def create_application(preload=False):
+    if preload:
+        from backend.preload import preload_for_fork
+        preload_for_fork()
+    return reject_oversized_uploads(django_application)
+
+
+application = create_application()
@@ -0,0 +1,39 @@
+"""
+Cache settings for the project.
+
+Fragment versions (api/fragments.py), replica pins (api/middleware.py) and
+anything else several workers must agree on need a cache every worker
+shares. The default per-process memory cache is only fit for a single
+worker; features that depend on a shared cache refuse to start on it (see
+api/caching.py).
+
+Every knob is an environment variable:
+
+    CACHE_URL                  redis://host:port/db for Redis, db://<table> for Django's
+                               database cache (run ``manage.py createcachetable`` once),
+                               or unset for a per-process memory cache
+    CACHE_KEY_PREFIX           Prefix of every key, for several deployments on one Redis ('')
+"""
+import os
+from urllib.parse import urlparse
+
+DEFAULT_CACHE_TABLE = 'django_cache'
+
+
+def caches_config(url):
+    """Build ``CACHES`` from ``CACHE_URL``."""
+    prefix = os.environ.get('CACHE_KEY_PREFIX', '')
+    if not url:
+        return {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+    scheme = urlparse(url).scheme
+    if scheme in ('redis', 'rediss'):
+        default = {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': url}
+    elif scheme == 'db':
+        default = {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': urlparse(url).netloc or DEFAULT_CACHE_TABLE,
+        }
+    else:
+        raise ValueError(f'Unsupported CACHE_URL scheme: {scheme!r}')
+    return {'default': {**default, 'KEY_PREFIX': prefix}}
@@ -0,0 +1,113 @@
+"""
+Database settings for the project.
+
+Connections are kept open between requests (``CONN_MAX_AGE``) and checked
+before reuse. SQLite runs in WAL mode with a busy timeout so concurrent
+uploads wait for the writer instead of failing with "database is locked".
+PostgreSQL can optionally use a psycopg 3 connection pool.
+
+Every knob is an environment variable:
+
+    DATABASE_URL               PostgreSQL (or any dj_database_url) URL; SQLite when unset
+    DATABASE_REPLICA_URLS      Comma separated read replica URLs, added as replica_1, replica_2, ...
+    DB_CONN_MAX_AGE            Seconds to keep a connection open, 0 to close per request (60)
+    DB_CONN_HEALTH_CHECKS      Ping a reused connection before handing it out (True)
+    DB_POOL                    Use a psycopg 3 connection pool on PostgreSQL (False); needs
+                               ``pip install "psycopg[binary,pool]"``
+    DB_POOL_MIN_SIZE           Connections the pool keeps open (2)
+    DB_POOL_MAX_SIZE           Connections the pool may open (10)
+    DB_POOL_TIMEOUT            Seconds to wait for a free pooled connection (10)
+    SQLITE_BUSY_TIMEOUT        Seconds a writer waits for the lock (20)
+    SQLITE_MMAP_SIZE           Bytes of the database file to memory-map (268435456)
+    SQLITE_CACHE_SIZE          Page cache size; negative values are KiB (-20000)
+    REPLICA_STICKY_SECONDS     Read from the primary this long after a client's write (5)
+
+Replicas can be tried locally with a second SQLite file, e.g.
+``DATABASE_REPLICA_URLS=sqlite:////tmp/replica.sqlite3`` followed by
+``manage.py migrate --database replica_1``; see api/db_routers.py.
+"""
+import os
+from importlib.util import find_spec
+
+import dj_database_url
+from django.core.exceptions import ImproperlyConfigured
+
+
+def env_bool(name, default):
+    return os.environ.get(name, str(default)) == 'True'
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def sqlite_options():
+    pragmas = [
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        f"PRAGMA mmap_size={env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)}",
+        f"PRAGMA cache_size={env_int('SQLITE_CACHE_SIZE', -20000)}",
+        'PRAGMA temp_store=MEMORY',
+    ]
+    return {
+        'timeout': env_int('SQLITE_BUSY_TIMEOUT', 20),
+        # Take the write lock at BEGIN so a reader can't deadlock upgrading to a writer
+        'transaction_mode': 'IMMEDIATE',
+        'init_command': ';'.join(pragmas),
+    }
+
+
+def postgres_pool_options():
+    return {
+        'min_size': env_int('DB_POOL_MIN_SIZE', 2),
+        'max_size': env_int('DB_POOL_MAX_SIZE', 10),
+        'timeout': env_int('DB_POOL_TIMEOUT', 10),
+    }
+
+
+def database_config(url=None, base_dir=None):
+    """
+    Build one ``DATABASES`` entry from ``url``, or a tuned SQLite database
+    in ``base_dir`` when no URL is given.
+    """
+    conn_max_age = env_int('DB_CONN_MAX_AGE', 60)
+    health_checks = env_bool('DB_CONN_HEALTH_CHECKS', True)
+
+    if url:
+        config = dj_database_url.parse(url, conn_max_age=conn_max_age, conn_health_checks=health_checks)
+    else:
+        config = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': base_dir / 'db.sqlite3',
+            'CONN_MAX_AGE': conn_max_age,
+            'CONN_HEALTH_CHECKS': health_checks,
+        }
+
+    options = config.setdefault('OPTIONS', {})
+    if config['ENGINE'] == 'django.db.backends.sqlite3':
+        options.update(sqlite_options())
+    elif config['ENGINE'] == 'django.db.backends.postgresql' and env_bool('DB_POOL', False):
+        # Django only pools with psycopg 3; requirements.txt ships psycopg2
+        if find_spec('psycopg') is None or find_spec('psycopg_pool') is None:
+            raise ImproperlyConfigured(
+                'DB_POOL=True needs psycopg 3 and its pool: pip install "psycopg[binary,pool]", '
+                'or unset DB_POOL to keep psycopg2 with persistent connections'
+            )
+        # Pooled connections are returned to the pool at the end of each
+        # request, so persistent connections must be off
+        options['pool'] = postgres_pool_options()
+        config['CONN_MAX_AGE'] = 0
+    return config
+
+
+def replica_databases(urls):
+    """
+    ``DATABASES`` entries for the comma separated replica ``urls``. Tests
+    mirror them to ``default`` so reads and writes see the same data.
+    """
+    replicas = {}
+    for i, url in enumerate(filter(None, (url.strip() for url in urls.split(','))), start=1):
+        config = database_config(url)
+        config['TEST'] = {'MIRROR': 'default'}
+        replicas[f'replica_{i}'] = config
+    return replicas
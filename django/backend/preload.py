@@ -0,0 +1,28 @@
+"""
+Preloading for forking servers such as ``gunicorn --preload``.
+
+Workers import the URLconf, the views and the PDF and imaging libraries
+lazily, which keeps a plain worker small but makes each one load its own
+copy once it needs them. ``preload_for_fork`` loads all of it in the master
+instead, so the forked workers share those pages copy-on-write.
+"""
+import gc
+import importlib
+
+from django.conf import settings
+
+
+def preload_for_fork():
+    from django.db import connections
+    from django.urls import get_resolver
+
+    # Importing the URLconf pulls in every view, serializer and model module
+    get_resolver().url_patterns
+    for module in getattr(settings, 'PRELOAD_MODULES', ()):
+        importlib.import_module(module)
+
+    # Connections must not be shared with the workers
+    connections.close_all()
+    # Keep the collector from touching (and so copying) the preloaded objects
+    gc.collect()
+    gc.freeze()
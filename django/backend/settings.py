@@ -1,6 +1,9 @@
 from pathlib import Path
 import os
-import dj_database_url
+
+from .cache import caches_config
+from .database import database_config, replica_databases
+from .storage import storages_config
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -28,6 +31,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',  # Must be first
+    'api.middleware.CompressionMiddleware',
+    'api.middleware.ReadReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -35,6 +40,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',  # Make sure this is present
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.profiling.ProfilingMiddleware',  # After authentication
 ]
 
 # CORS Configuration (for development)
@@ -60,19 +66,19 @@ TEMPLATES = [
 WSGI_APPLICATION = 'backend.wsgi.application'
 
 # Database
-# Use PostgreSQL in Docker, fallback to SQLite for local development
-database_url = os.environ.get('DATABASE_URL')
-if database_url:
-    DATABASES = {
-        'default': dj_database_url.config(default=database_url)
-    }
-else:
-    DATABASES = {
-        'default': {
-            'ENGINE': 'django.db.backends.sqlite3',
-            'NAME': BASE_DIR / 'db.sqlite3',
-        }
-    }
+# Use PostgreSQL in Docker, fallback to SQLite for local development.
+# Connection reuse, SQLite pragmas and pooling are configured in backend/database.py
+DATABASES = {
+    'default': database_config(os.environ.get('DATABASE_URL'), BASE_DIR)
+}
+DATABASES.update(replica_databases(os.environ.get('DATABASE_REPLICA_URLS', '')))
+
+# Shared by all workers unless CACHE_URL is unset; see backend/cache.py
+CACHES = caches_config(os.environ.get('CACHE_URL'))
+
+# Safe requests read from replicas; see api/db_routers.py
+DATABASE_ROUTERS = ['api.db_routers.ReplicaRouter']
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
 
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
@@ -110,6 +116,15 @@ os.makedirs(os.path.join(BASE_DIR, 'static'), exist_ok=True)
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# MEDIA_ROOT on this node, or an object store shared by every node with a
+# read cache on local disk; see backend/storage.py
+STORAGES = storages_config(MEDIA_ROOT)
+STORAGE_PUBLIC_URL = os.environ.get('STORAGE_PUBLIC_URL', '')
+STORAGE_CACHE_DIR = os.environ.get('STORAGE_CACHE_DIR', os.path.join(MEDIA_ROOT, '.cache'))
+STORAGE_CACHE_MAX_BYTES = int(os.environ.get('STORAGE_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+STORAGE_PART_SIZE = int(os.environ.get('STORAGE_PART_SIZE', 8 * 1024 * 1024))
+STORAGE_UPLOAD_THREADS = int(os.environ.get('STORAGE_UPLOAD_THREADS', 4))
+
 # Auth
 AUTH_USER_MODEL = 'api.User'
 
@@ -129,10 +144,84 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_RENDERER_CLASSES': [
         'rest_framework.renderers.JSONRenderer',
+        'api.renderers.MessagePackRenderer',  # Selected with Accept: application/msgpack
         'rest_framework.renderers.BrowsableAPIRenderer',  # Add this for browser interface
     ],
+    'DEFAULT_PARSER_CLASSES': [
+        'rest_framework.parsers.JSONParser',
+        'api.renderers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+    # Token buckets in the database for the upload and export views only
+    # (api/throttling.py); '30/hour' allows a burst of 30
+    'DEFAULT_THROTTLE_RATES': {
+        'uploads': os.environ.get('THROTTLE_RATE_UPLOADS', '120/hour'),
+        'exports': os.environ.get('THROTTLE_RATE_EXPORTS', '30/hour'),
+    },
 }
 
+# Requests of one kind that may run at once, per user and in total (api/throttling.py)
+CONCURRENCY_LIMITS = {
+    'uploads': {
+        'user': int(os.environ.get('CONCURRENCY_UPLOADS_PER_USER', 4)),
+        'total': int(os.environ.get('CONCURRENCY_UPLOADS_TOTAL', 16)),
+    },
+    'exports': {
+        'user': int(os.environ.get('CONCURRENCY_EXPORTS_PER_USER', 2)),
+        'total': int(os.environ.get('CONCURRENCY_EXPORTS_TOTAL', 8)),
+    },
+}
+CONCURRENCY_RETRY_AFTER = int(os.environ.get('CONCURRENCY_RETRY_AFTER', 5))
+
+# Uploads with a larger Content-Length are refused before the body is read
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', 512 * 1024 * 1024))
+
+# Cached serializer output (api/fragments.py); needs a shared cache (CACHE_URL)
+FRAGMENT_CACHE_ENABLED = os.environ.get('FRAGMENT_CACHE_ENABLED', 'False') == 'True'
+FRAGMENT_CACHE_TIMEOUT = int(os.environ.get('FRAGMENT_CACHE_TIMEOUT', 24 * 60 * 60))
+FRAGMENT_CACHE_LOCAL_SIZE = int(os.environ.get('FRAGMENT_CACHE_LOCAL_SIZE', 5000))
+
+# Loaded lazily by workers, but by the master when preloading (backend/preload.py)
+PRELOAD_MODULES = [
+    'PIL.Image',
+    'PIL.JpegImagePlugin',
+    'PIL.PngImagePlugin',
+    'reportlab.lib.styles',
+    'reportlab.platypus',
+]
+
+# Threads for image and PDF work in the async views (api/async_views.py); 0 means one per CPU
+ASYNC_CPU_WORKERS = int(os.environ.get('ASYNC_CPU_WORKERS', 0))
+
+# Response compression (api.middleware.CompressionMiddleware)
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+
+# Idempotency-Key handling for uploads (api/idempotency.py)
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+IDEMPOTENCY_WAIT_SECONDS = int(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 30))
+IDEMPOTENCY_PENDING_TIMEOUT = int(os.environ.get('IDEMPOTENCY_PENDING_TIMEOUT', 10 * 60))
+
+# Change feed of Media/MediaBatch events (api/changefeed.py). Each process polls
+# for other workers' events every CHANGE_FEED_POLL_INTERVAL seconds while
+# clients wait; 0 turns that off for single-process deployments.
+CHANGE_FEED_POLL_INTERVAL = float(os.environ.get('CHANGE_FEED_POLL_INTERVAL', 2))
+CHANGE_FEED_LONG_POLL_TIMEOUT = int(os.environ.get('CHANGE_FEED_LONG_POLL_TIMEOUT', 25))
+CHANGE_FEED_HEARTBEAT = int(os.environ.get('CHANGE_FEED_HEARTBEAT', 15))
+CHANGE_FEED_STREAM_SECONDS = int(os.environ.get('CHANGE_FEED_STREAM_SECONDS', 300))
+CHANGE_FEED_BATCH_LIMIT = int(os.environ.get('CHANGE_FEED_BATCH_LIMIT', 500))
+# Events are only handed out once they are this old, so one committed late
+# with a lower id can't be skipped by a reader's cursor
+CHANGE_FEED_SETTLE_SECONDS = float(os.environ.get('CHANGE_FEED_SETTLE_SECONDS', 1))
+CHANGE_FEED_RETENTION = int(os.environ.get('CHANGE_FEED_RETENTION', 7 * 24 * 60 * 60))
+
+# Staff-only request profiling with X-Profile: 1 or ?profile=1 (api/profiling.py).
+# False removes the middleware entirely.
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'True') == 'True'
+PROFILING_SAMPLE_INTERVAL = float(os.environ.get('PROFILING_SAMPLE_INTERVAL', 0.005))
+PROFILING_MAX_QUERIES = int(os.environ.get('PROFILING_MAX_QUERIES', 1000))
+PROFILING_KEEP = int(os.environ.get('PROFILING_KEEP', 200))
+
 # DJOSER Configuration (optional but useful)
 DJOSER = {
     'LOGIN_FIELD': 'username',
@@ -168,3 +257,7 @@ LOGGING = {
 }
 
 APPEND_SLASH = False
+
+# Run a reaper pass in a background thread after soft deletes (see api/reaper.py).
+# Set to False when `manage.py reap_deleted --loop` runs as its own process.
+MEDIA_REAPER_IN_PROCESS = os.environ.get('MEDIA_REAPER_IN_PROCESS', 'True') == 'True'
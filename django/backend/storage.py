@@ -0,0 +1,56 @@
+"""
+File storage settings for the project.
+
+Uploads, thumbnails and profile photos use the ``default`` storage. Batch
+PDFs are kept in the ``exports`` storage (see api/exports.py). With the
+``filesystem`` backend both live under ``MEDIA_ROOT`` on this node. The
+object store backends let several app nodes share them, each node reading
+through its own LRU disk cache (see api/storage.py).
+
+Every knob is an environment variable:
+
+    STORAGE_BACKEND            filesystem, gcs (Google Cloud Storage) or local (object store
+                               stand-in in a directory) (filesystem)
+    STORAGE_BUCKET             Bucket name (gcs)
+    STORAGE_PROJECT            Google Cloud project; the client's default when unset
+    STORAGE_LOCAL_ROOT         Directory of the local stand-in (<MEDIA_ROOT>/object-store)
+    STORAGE_PUBLIC_URL         Base URL for plain file URLs of objects without a hash (MEDIA_URL)
+    STORAGE_CACHE_DIR          Read cache directory on this node (<MEDIA_ROOT>/.cache)
+    STORAGE_CACHE_MAX_BYTES    Read cache size, 0 to turn it off (1073741824)
+    STORAGE_PART_SIZE          Files larger than this are uploaded in parts of this size (8388608)
+    STORAGE_UPLOAD_THREADS     Parts uploaded at once (4)
+"""
+import os
+
+STATICFILES_STORAGE = {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}
+
+
+def storages_config(media_root):
+    """Build ``STORAGES`` for ``STORAGE_BACKEND``."""
+    backend = os.environ.get('STORAGE_BACKEND', 'filesystem')
+    if backend == 'filesystem':
+        return {
+            'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+            'exports': {
+                'BACKEND': 'django.core.files.storage.FileSystemStorage',
+                'OPTIONS': {'location': os.path.join(media_root, 'exports')},
+            },
+            'staticfiles': STATICFILES_STORAGE,
+        }
+
+    options = {
+        'backend': backend,
+        'bucket': os.environ.get('STORAGE_BUCKET'),
+        'project': os.environ.get('STORAGE_PROJECT'),
+        'root': os.environ.get('STORAGE_LOCAL_ROOT', os.path.join(media_root, 'object-store')),
+    }
+    return {
+        'default': {'BACKEND': 'api.storage.ObjectStorage', 'OPTIONS': {**options, 'prefix': 'media/'}},
+        # A PDF's name is derived from its content, so it can be overwritten in place
+        'exports': {
+            'BACKEND': 'api.storage.ObjectStorage',
+            'OPTIONS': {**options, 'prefix': 'exports/', 'unique_names': False},
+        },
+        'staticfiles': STATICFILES_STORAGE,
+    }
+
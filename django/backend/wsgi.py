@@ -2,6 +2,10 @@
 WSGI config for backend project.
 
 It exposes the WSGI callable as a module-level variable named ``application``.
+Forking servers can preload the application in the master so workers share
+its memory, e.g.::
+
+    gunicorn --preload 'backend.wsgi:create_application(preload=True)'
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
@@ -13,4 +17,13 @@ from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_wsgi_application()
+
+def create_application(preload=False):
+    application = get_wsgi_application()
+    if preload:
+        from backend.preload import preload_for_fork
+        preload_for_fork()
+    return application
+
+
+application = create_application()
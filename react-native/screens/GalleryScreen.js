@@ -7,6 +7,7 @@ import * as ImagePicker from 'expo-image-picker';
 import AsyncStorage from '@react-native-async-storage/async-storage';
 import { Ionicons } from '@expo/vector-icons';
 import { API_URL } from '../utils/constants';
+import { getAuthHeaders, parseResponse } from '../utils/auth';
 import * as FileSystem from 'expo-file-system';
 import DateTimePicker from '@react-native-community/datetimepicker';
 import * as Print from 'expo-print';
@@ -20,6 +21,8 @@ export default function GalleryScreen() {
   const [error, setError] = useState('');
   const [batches, setBatches] = useState([]);
   const [selectedBatch, setSelectedBatch] = useState(null);
+  const [batchMediaNext, setBatchMediaNext] = useState(null);
+  const [loadingMedia, setLoadingMedia] = useState(false);
   const [modalVisible, setModalVisible] = useState(false);
   const [loading, setLoading] = useState(true);
 
@@ -144,14 +147,14 @@ export default function GalleryScreen() {
       }
 
       const response = await fetch(`${API_URL}/batches/`, {
-        headers: { Authorization: `Token ${token}` },
+        headers: await getAuthHeaders(),
       });
 
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
 
-      const data = await response.json();
+      const data = await parseResponse(response);
       console.log('Fetched batches:', data);
 
       setBatches(data || []);
@@ -172,12 +175,54 @@ export default function GalleryScreen() {
     fetchBatches();
   };
 
+  // Fetch one page of a batch's images; without a url the first page replaces the current images
+  const fetchBatchMedia = async (batchId, url = null) => {
+    setLoadingMedia(true);
+    try {
+      const response = await fetch(url || `${API_URL}/batches/${batchId}/media/`, {
+        headers: await getAuthHeaders(),
+      });
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
+
+      const page = await parseResponse(response);
+      setSelectedBatch(prev => prev && prev.id === batchId
+        ? { ...prev, images: url ? [...(prev.images || []), ...page.results] : page.results }
+        : prev);
+      setBatchMediaNext(page.next);
+      return page;
+    } catch (error) {
+      console.error('Error fetching batch images:', error);
+      setError('Failed to fetch batch images: ' + error.message);
+    } finally {
+      setLoadingMedia(false);
+    }
+  };
+
+  // Fetch every image of a batch, following the pages
+  const fetchAllBatchMedia = async (batchId) => {
+    let images = [];
+    let url = `${API_URL}/batches/${batchId}/media/?page_size=200`;
+    while (url) {
+      const response = await fetch(url, { headers: await getAuthHeaders() });
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
+      const page = await parseResponse(response);
+      images = images.concat(page.results);
+      url = page.next;
+    }
+    return images;
+  };
+
   // View a specific batch
   const handleViewBatch = (batch) => {
     console.log('Selected batch:', batch);
-    console.log('Batch images:', batch.images || []);
-    setSelectedBatch(batch);
+    setSelectedBatch({ ...batch, images: [] });
+    setBatchMediaNext(null);
     setModalVisible(true);
+    fetchBatchMedia(batch.id);
   };
 
   // Preview an image in full screen
@@ -259,7 +304,8 @@ export default function GalleryScreen() {
         if (selectedBatch) {
           const updatedBatch = {
             ...selectedBatch,
-            images: selectedBatch.images.filter(img => img.id !== imageId)
+            images: selectedBatch.images.filter(img => img.id !== imageId),
+            media_count: Math.max((selectedBatch.media_count || 1) - 1, 0)
           };
           setSelectedBatch(updatedBatch);
         }
@@ -315,11 +361,12 @@ export default function GalleryScreen() {
     try {
       setUploading(true);
 
-      // Get the selected batch
-      const batch = batches.find(b => b.id === batchId);
-      if (!batch) {
+      // Get the selected batch and all of its images
+      const summary = batches.find(b => b.id === batchId);
+      if (!summary) {
         throw new Error('Batch not found');
       }
+      const batch = { ...summary, images: await fetchAllBatchMedia(batchId) };
 
       // Create HTML content for the PDF
       let htmlContent = `
@@ -459,13 +506,14 @@ export default function GalleryScreen() {
         alert('Additional images uploaded successfully!');
         setSelectedImages([]);
         fetchBatches();
-        // Refresh the selected batch by fetching it again
+        // Refresh the selected batch summary and its first page of images
         const updatedResponse = await fetch(`${API_URL}/batches/${selectedBatch.id}/`, {
-          headers: { Authorization: `Token ${token}` },
+          headers: await getAuthHeaders(),
         });
         if (updatedResponse.ok) {
-          const updatedBatch = await updatedResponse.json();
-          setSelectedBatch(updatedBatch);
+          const updatedBatch = await parseResponse(updatedResponse);
+          setSelectedBatch({ ...updatedBatch, images: selectedBatch.images });
+          fetchBatchMedia(updatedBatch.id);
         }
         setPreviewBeforeUpload(false);
       } else {
@@ -506,7 +554,7 @@ export default function GalleryScreen() {
       <View style={styles.batchInfo}>
         <Text style={styles.referralId}>ID: {item.referral_id || 'N/A'}</Text>
         <Text style={styles.batchTitle}>Title: {item.title || 'Untitled'}</Text>
-        <Text style={styles.imageCount}>Images: {item.images?.length || 0}</Text>
+        <Text style={styles.imageCount}>Images: {item.media_count || 0}</Text>
         <Text style={styles.uploadedBy}>Uploaded by: {item.owner?.username || 'Unknown'}</Text>
       </View>
       <View style={styles.actionButtons}>
@@ -674,13 +722,13 @@ export default function GalleryScreen() {
                 <View style={styles.batchDetails}>
                   <Text style={styles.batchDetailText}>Title: {selectedBatch?.title || 'Untitled'}</Text>
                   <Text style={styles.batchDetailText}>Created: {selectedBatch?.created_at ? new Date(selectedBatch.created_at).toLocaleString() : 'Unknown'}</Text>
-                  <Text style={styles.batchDetailText}>Images: {selectedBatch?.images?.length || 0}</Text>
+                  <Text style={styles.batchDetailText}>Images: {selectedBatch?.media_count || 0}</Text>
                 </View>
 
                 <View style={styles.imageGrid}>
                   {selectedBatch?.images?.length > 0 ? (
                     selectedBatch.images.map((image, index) => {
-                      const imageUrl = image.file_url || image.url;
+                      const imageUrl = image.thumbnail_url || image.file_url || image.url;
                       return (
                         <View key={index} style={styles.imageContainer}>
                           <TouchableOpacity onPress={() => handleImagePreview(image)}>
@@ -702,10 +750,26 @@ export default function GalleryScreen() {
                         </View>
                       );
                     })
+                  ) : loadingMedia ? (
+                    <ActivityIndicator size="small" color="#007AFF" />
                   ) : (
                     <Text style={styles.noImagesText}>No images in this batch</Text>
                   )}
                 </View>
+
+                {batchMediaNext && (
+                  <TouchableOpacity
+                    style={styles.loadMoreButton}
+                    onPress={() => fetchBatchMedia(selectedBatch.id, batchMediaNext)}
+                    disabled={loadingMedia}
+                  >
+                    {loadingMedia ? (
+                      <ActivityIndicator size="small" color="#007AFF" />
+                    ) : (
+                      <Text style={styles.loadMoreText}>Load more images</Text>
+                    )}
+                  </TouchableOpacity>
+                )}
               </ScrollView>
 
               <View style={styles.modalFooter}>
@@ -1006,6 +1070,15 @@ const styles = StyleSheet.create({
     color: '#666',
     width: '100%',
   },
+  loadMoreButton: {
+    alignItems: 'center',
+    padding: 12,
+    marginVertical: 10,
+  },
+  loadMoreText: {
+    color: '#007AFF',
+    fontWeight: 'bold',
+  },
   modalFooter: {
     flexDirection: 'row',
     justifyContent: 'space-evenly',
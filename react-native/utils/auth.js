@@ -1,4 +1,5 @@
 import AsyncStorage from '@react-native-async-storage/async-storage';
+import { decode } from '@msgpack/msgpack';
 
 const TOKEN_KEY = 'authToken';
 
@@ -26,3 +27,29 @@ export const clearToken = async () => {
     console.error('Error clearing token:', error);
   }
 };
+
+// Set to true to receive API responses as MessagePack instead of JSON.
+// Accept-Encoding is left to the platform HTTP stack, which then also
+// decompresses the response; setting it by hand turns that off on Android.
+export const USE_MSGPACK = false;
+
+const MSGPACK_TYPE = 'application/msgpack';
+
+// Headers for authenticated API requests
+export const getAuthHeaders = async (extraHeaders = {}) => {
+  const token = await getToken();
+  return {
+    ...(token ? { Authorization: `Token ${token}` } : {}),
+    Accept: USE_MSGPACK ? `${MSGPACK_TYPE}, application/json;q=0.9` : 'application/json',
+    ...extraHeaders,
+  };
+};
+
+// Decode a response body as MessagePack or JSON depending on its Content-Type
+export const parseResponse = async (response) => {
+  const contentType = response.headers.get('Content-Type') || '';
+  if (contentType.includes(MSGPACK_TYPE)) {
+    return decode(new Uint8Array(await response.arrayBuffer()));
+  }
+  return response.json();
+};